@@ -0,0 +1,45 @@
+import argparse
+import random
+import sys
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT / "common/packages/metric-ingestion-models/src"))
+
+from metric_ingestion_models import DeviceMetricGroup, DeviceMetric, BINARY_CONTENT_TYPE, decode_group, decode_groups
+
+
+def make_bodies(count: int, metrics_per_group: int):
+    names = ["cpu_usage", "ram_usage", "disk_usage", "net_in", "net_out"]
+    groups = [DeviceMetricGroup(device_id=f"000-010-{i:04d}",
+                                metrics=[DeviceMetric(name=names[j % len(names)],
+                                                      timestamp=1_700_000_000.0 + i,
+                                                      value=random.random() * 100) for j in range(metrics_per_group)])
+              for i in range(count)]
+    return [group.model_dump_json().encode() for group in groups], [group.to_bytes() for group in groups]
+
+
+def measure(label: str, fn, messages: int, rounds: int):
+    best = float("inf")
+    for _ in range(rounds):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    print(f"{label:32s} {best / messages * 1e6:8.2f} us/msg {messages / best:12.0f} msg/s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Per message decode cost of DeviceMetricGroup")
+    parser.add_argument("--messages", type=int, default=500)
+    parser.add_argument("--metrics", type=int, default=3)
+    parser.add_argument("--rounds", type=int, default=20)
+    args = parser.parse_args()
+
+    json_bodies, binary_bodies = make_bodies(args.messages, args.metrics)
+    binary_types = [BINARY_CONTENT_TYPE] * len(binary_bodies)
+
+    print(f"{args.messages} messages x {args.metrics} metrics, best of {args.rounds}")
+    measure("json, one by one", lambda: [decode_group(body) for body in json_bodies], args.messages, args.rounds)
+    measure("json, bulk", lambda: decode_groups(json_bodies), args.messages, args.rounds)
+    measure("binary, bulk", lambda: decode_groups(binary_bodies, binary_types), args.messages, args.rounds)
@@ -0,0 +1,388 @@
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from collections import Counter
+from datetime import timedelta
+from pathlib import Path
+from typing import Awaitable, Callable, Dict, List, Optional, Sequence
+
+ROOT = Path(__file__).resolve().parents[1]
+for path in ("common/packages/metric-ingestion-models/src",
+             "common/packages/metric-ingestion/src",
+             "common/packages/event-exchange-rabbit-mq/src",
+             "services/ingestion-service",
+             "services/processor-service/app"):
+    sys.path.insert(0, str(ROOT / path))
+
+import httpx
+import psutil
+from event_exchange_rabbit_mq import ShardedTopology
+from metric_ingestion import MetricIngestionClient, IngestionSettings, CollectorSet
+from metric_ingestion.telemetry import LatencyHistogram
+
+from synthetic import PROFILES, parse_mix, pick_profiles
+
+
+class FleetStats(object):
+    def __init__(self):
+        self.uploads = LatencyHistogram()
+        self.statuses: Counter = Counter()
+        self.publish_to_persist = LatencyHistogram()
+        self.sample_to_persist = LatencyHistogram()
+        self.sample_to_alert = LatencyHistogram()
+        self.commits = LatencyHistogram()
+        self.loop_lag = LatencyHistogram()
+        self.persisted_groups: int = 0
+        self.persisted_samples: int = 0
+        self.batches: int = 0
+        self.peak_rss: int = 0
+        self.peak_depth: int = 0
+
+
+# Times every upload of the fleet on its way through the wrapped transport.
+class TimedTransport(httpx.AsyncBaseTransport):
+    def __init__(self, transport: httpx.AsyncBaseTransport, stats: FleetStats):
+        self.transport = transport
+        self.stats = stats
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        start = time.perf_counter()
+        response = await self.transport.handle_async_request(request)
+        self.stats.uploads.record(time.perf_counter() - start)
+        self.stats.statuses[response.status_code] += 1
+        return response
+
+    async def aclose(self):
+        # shared by the whole fleet, a device going away must not close it
+        pass
+
+
+class InProcessMessage(object):
+    def __init__(self, broker: "InProcessBroker", routing_key: str, delivery_tag: int, body: bytes,
+                 content_type: str, published_at: float):
+        self.broker = broker
+        self.routing_key = routing_key
+        self.delivery_tag = delivery_tag
+        self.message_id = None
+        self.body = body
+        self.content_type = content_type
+        self.published_at = published_at
+        self.on_settle: Optional[Callable[[], None]] = None
+
+    def _settle(self):
+        if self.on_settle is not None:
+            self.on_settle()
+            self.on_settle = None
+
+    async def ack(self):
+        self.broker.acked += 1
+        self.broker.stats.publish_to_persist.record(time.perf_counter() - self.published_at)
+        self._settle()
+
+    async def nack(self, requeue: bool = True):
+        self._settle()
+        if requeue:
+            self.broker.requeued += 1
+            self.broker.queues[self.routing_key].put_nowait(self)
+        else:
+            self.broker.rejected += 1
+
+    async def reject(self, requeue: bool = False):
+        await self.nack(requeue=requeue)
+
+
+# Stand-in for RabbitMQ, one asyncio queue per shard of the topology. It is
+# what the ingestion api publishes to (publish_batch, is_blocked) and what the
+# processor's consumer takes deliveries from, through InProcessClaimer. Over
+# max_depth queued messages it reports itself blocked, like a broker under a
+# memory alarm, and the api's admission control turns uploads away.
+class InProcessBroker(object):
+    def __init__(self, topology: ShardedTopology, stats: FleetStats, max_depth: int = 1_000_000):
+        self.topology = topology
+        self.stats = stats
+        self.max_depth = max_depth
+        self.queues: Dict[str, asyncio.Queue] = {topology.routing_key(shard): asyncio.Queue()
+                                                 for shard in range(topology.shards)}
+        self.published: int = 0
+        self.acked: int = 0
+        self.requeued: int = 0
+        self.rejected: int = 0
+        self._tags = itertools.count(1)
+
+    def depth(self) -> int:
+        return sum(queue.qsize() for queue in self.queues.values())
+
+    def is_blocked(self) -> bool:
+        return self.depth() >= self.max_depth
+
+    async def publish_batch(self,
+                            bodies: Sequence[bytes],
+                            routing_keys: Sequence[str],
+                            content_type: str = "application/json") -> int:
+        published_at = time.perf_counter()
+        for body, routing_key in zip(bodies, routing_keys):
+            self.queues[routing_key].put_nowait(InProcessMessage(self, routing_key, next(self._tags), body,
+                                                                 content_type, published_at))
+        self.published += len(bodies)
+        self.stats.peak_depth = max(self.stats.peak_depth, self.depth())
+        # a real publish waits on the socket and the confirms, give the loop back at least once
+        await asyncio.sleep(0)
+        return len(bodies)
+
+
+# Hands the consumer every shard of the in-process broker, each with its own
+# prefetch window, the way ShardClaimer does for one replica owning them all.
+class InProcessClaimer(object):
+    def __init__(self,
+                 broker: InProcessBroker,
+                 on_message: Callable[[InProcessMessage], Awaitable[None]],
+                 prefetch_count: int = 500):
+        self.broker = broker
+        self.on_message = on_message
+        self.prefetch_count = prefetch_count
+        self._handlers = set()
+        self._stopping = asyncio.Event()
+
+    async def _deliver(self, queue: asyncio.Queue):
+        unacked = asyncio.Semaphore(self.prefetch_count)
+        while True:
+            await unacked.acquire()
+            message = await queue.get()
+            message.on_settle = unacked.release
+            handler = asyncio.create_task(self.on_message(message))
+            self._handlers.add(handler)
+            handler.add_done_callback(self._handlers.discard)
+
+    async def run(self):
+        deliveries = [asyncio.create_task(self._deliver(queue)) for queue in self.broker.queues.values()]
+        try:
+            await self._stopping.wait()
+        finally:
+            for delivery in deliveries:
+                delivery.cancel()
+            if self._handlers:
+                await asyncio.gather(*self._handlers, return_exceptions=True)
+
+    async def depths(self) -> Dict[int, int]:
+        return {shard: self.broker.queues[self.broker.topology.routing_key(shard)].qsize()
+                for shard in range(self.broker.topology.shards)}
+
+    def stop(self):
+        self._stopping.set()
+
+
+async def watch_resources(stats: FleetStats, interval: float = 0.25):
+    # a late wake up is loop lag; when it climbs the simulator itself is the bottleneck
+    process = psutil.Process()
+    while True:
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        stats.loop_lag.record(max(time.perf_counter() - start - interval, 0.0))
+        stats.peak_rss = max(stats.peak_rss, process.memory_info().rss)
+
+
+async def run_device(client: MetricIngestionClient, delay: float):
+    await asyncio.sleep(delay)
+    await client.start_expose()
+
+
+async def simulate(args) -> Dict[str, float]:
+    # the processor reads its database from the environment on import
+    os.environ["DATABASE_URL"] = args.database_url
+    import main as processor
+    from alerts import AlertDispatcher
+    from consumer import MetricConsumer
+    import app.main as ingestion
+    from app.admission import AdmissionController
+    from app.config import GlobalSetting
+
+    stats = FleetStats()
+
+    class RecordingDispatcher(AlertDispatcher):
+        def submit(self, alert) -> bool:
+            queued = super().submit(alert)
+            if queued and alert.timestamp:
+                stats.sample_to_alert.record(time.time() - alert.timestamp)
+            return queued
+
+    # alerts go to a stand-in Telegram that answers at once; the real rate limit
+    # would only leave the digests queued at the end of the run
+    telegram = httpx.AsyncClient(base_url="http://telegram.invalid",
+                                 transport=httpx.MockTransport(lambda request: httpx.Response(200, json={"ok": True})))
+    processor.alert_dispatcher = RecordingDispatcher(client=telegram,
+                                                     dedup_window=processor.ALERT_DEDUP_WINDOW,
+                                                     digest_max_alerts=processor.ALERT_DIGEST_MAX,
+                                                     digest_max_delay=processor.ALERT_DIGEST_DELAY,
+                                                     rate_per_second=args.alert_rate,
+                                                     burst=processor.ALERT_BURST)
+
+    async def commit(groups):
+        start = time.perf_counter()
+        await processor.commit_batch(groups)
+        persisted_at = time.time()
+        stats.commits.record(time.perf_counter() - start)
+        stats.batches += 1
+        stats.persisted_groups += len(groups)
+        for group in groups:
+            for metric in group.metrics:
+                stats.sample_to_persist.record(persisted_at - metric.timestamp)
+                stats.persisted_samples += 1
+
+    await processor.initdb()
+    await processor.metric_store.setup()
+    await processor.rollup_writer.setup()
+    await processor.alert_dispatcher.start()
+
+    topology = ShardedTopology(exchange_name=GlobalSetting.METRICS_EXCHANGE,
+                               queue_prefix=GlobalSetting.METRICS_QUEUE_PREFIX,
+                               shards=GlobalSetting.METRICS_SHARDS)
+    consumer = MetricConsumer(url=os.getenv("RABBITMQ_URL", GlobalSetting.RABBITMQ_URL),
+                              decode=processor.decode_messages,
+                              commit=commit,
+                              prefetch_count=processor.PREFETCH_COUNT,
+                              max_in_flight=processor.MAX_IN_FLIGHT,
+                              batch_max_size=processor.BATCH_MAX_SIZE,
+                              batch_max_delay=processor.BATCH_MAX_DELAY,
+                              topology=topology,
+                              claim_interval=processor.SHARD_CLAIM_INTERVAL)
+
+    broker = None
+    if args.broker == "memory":
+        broker = InProcessBroker(topology, stats, max_depth=args.max_depth)
+        ingestion.app.state.publisher = broker
+        # time runs compressed, under load the suggested interval keeps its ratio to the device cadence
+        ingestion.app.state.admission = AdmissionController(
+            max_in_flight=GlobalSetting.ADMISSION_MAX_IN_FLIGHT,
+            max_per_device=GlobalSetting.ADMISSION_MAX_PER_DEVICE,
+            base_interval=args.batch_delay,
+            max_interval=args.batch_delay * GlobalSetting.SUGGESTED_INTERVAL_MAX / GlobalSetting.SUGGESTED_INTERVAL_MIN,
+            target_publish_latency=GlobalSetting.TARGET_PUBLISH_LATENCY,
+            quiet_pressure=GlobalSetting.SUGGESTED_INTERVAL_PRESSURE,
+            is_blocked=broker.is_blocked)
+        consuming = asyncio.create_task(consumer.consume(InProcessClaimer(broker, consumer.on_message,
+                                                                          prefetch_count=processor.PREFETCH_COUNT)))
+        lifespan = None
+    else:
+        lifespan = ingestion.app.router.lifespan_context(ingestion.app)
+        await lifespan.__aenter__()
+        consuming = asyncio.create_task(consumer.run())
+
+    transport = TimedTransport(httpx.ASGITransport(app=ingestion.app), stats)
+    profiles = pick_profiles(args.devices, parse_mix(args.mix), seed=args.seed)
+    clients = [MetricIngestionClient(IngestionSettings(device_id=f"sim-{index:06d}",
+                                                       ingestion_endpoint="http://ingestion/ingest/metrics",
+                                                       interval_time=timedelta(seconds=args.interval),
+                                                       wire_format=args.wire_format,
+                                                       batch_max_records=args.batch_records,
+                                                       batch_max_delay=timedelta(seconds=args.batch_delay),
+                                                       compression=None if args.no_gzip else "gzip"),
+                                     collectors=CollectorSet(collectors=[PROFILES[profile](seed=args.seed + index)]),
+                                     transport=transport)
+               for index, profile in enumerate(profiles)]
+
+    process = psutil.Process()
+    cpu_start = sum(process.cpu_times()[:2])
+    watcher = asyncio.create_task(watch_resources(stats))
+    start = time.perf_counter()
+
+    # devices come up spread over the ramp, not all sampling on the same tick
+    spread = random.Random(args.seed)
+    devices = [asyncio.create_task(run_device(client, spread.uniform(0, args.ramp))) for client in clients]
+    await asyncio.sleep(args.duration)
+    for client in clients:
+        await client.stop_expose()
+    await asyncio.gather(*devices, return_exceptions=True)
+    ingested_in = time.perf_counter() - start
+    delivered = sum(client.sent for client in clients)
+
+    deadline = time.perf_counter() + args.drain_timeout
+    while stats.persisted_groups < delivered and time.perf_counter() < deadline:
+        await asyncio.sleep(0.1)
+    persisted_in = time.perf_counter() - start
+
+    consumer.stop()
+    await consuming
+    await processor.alert_dispatcher.close()
+    await telegram.aclose()
+    if lifespan is not None:
+        await lifespan.__aexit__(None, None, None)
+    watcher.cancel()
+    cpu_seconds = sum(process.cpu_times()[:2]) - cpu_start
+
+    results = {"devices": args.devices,
+               "duration_s": ingested_in,
+               "delivered_records": delivered,
+               "dropped_records": sum(client.dropped for client in clients),
+               "ingest_records_per_sec": delivered / ingested_in,
+               "uploads": stats.uploads.count,
+               "uploads_refused": stats.statuses[429],
+               "upload_p50_ms": stats.uploads.quantile(0.50) * 1e3,
+               "upload_p99_ms": stats.uploads.quantile(0.99) * 1e3,
+               "persisted_records": stats.persisted_groups,
+               "persisted_samples": stats.persisted_samples,
+               "persist_records_per_sec": stats.persisted_groups / persisted_in,
+               "commit_batches": stats.batches,
+               "commit_p50_ms": stats.commits.quantile(0.50) * 1e3,
+               "commit_p99_ms": stats.commits.quantile(0.99) * 1e3,
+               "sample_to_persist_p50_ms": stats.sample_to_persist.quantile(0.50) * 1e3,
+               "sample_to_persist_p95_ms": stats.sample_to_persist.quantile(0.95) * 1e3,
+               "sample_to_persist_p99_ms": stats.sample_to_persist.quantile(0.99) * 1e3,
+               "alerts": stats.sample_to_alert.count,
+               "alert_messages": processor.alert_dispatcher.sent_messages,
+               "sample_to_alert_p50_ms": stats.sample_to_alert.quantile(0.50) * 1e3,
+               "sample_to_alert_p95_ms": stats.sample_to_alert.quantile(0.95) * 1e3,
+               "sample_to_alert_p99_ms": stats.sample_to_alert.quantile(0.99) * 1e3,
+               "cpu_cores": cpu_seconds / persisted_in,
+               "peak_rss_mb": stats.peak_rss / (1 << 20),
+               "loop_lag_p99_ms": stats.loop_lag.quantile(0.99) * 1e3}
+    if broker is not None:
+        # publish to persist leaves out the time samples wait in the device buffers
+        results.update({"publish_to_persist_p50_ms": stats.publish_to_persist.quantile(0.50) * 1e3,
+                        "publish_to_persist_p95_ms": stats.publish_to_persist.quantile(0.95) * 1e3,
+                        "publish_to_persist_p99_ms": stats.publish_to_persist.quantile(0.99) * 1e3,
+                        "peak_queue_depth": stats.peak_depth,
+                        "requeued_messages": broker.requeued})
+    return results
+
+
+def report(results: Dict[str, float]):
+    for label, value in results.items():
+        print(f"{label:32s} {value:14.2f}" if isinstance(value, float) else f"{label:32s} {value:14d}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Simulated device fleet driving ingestion -> broker -> processor in one process")
+    parser.add_argument("--devices", type=int, default=1000)
+    parser.add_argument("--duration", type=float, default=60, help="seconds the fleet keeps sampling")
+    parser.add_argument("--ramp", type=float, default=5, help="seconds over which the devices come up")
+    parser.add_argument("--interval", type=float, default=1.0, help="seconds between samples of a device")
+    parser.add_argument("--mix", default="steady=0.85,spiky=0.1,flapping=0.05", help=f"profiles out of {sorted(PROFILES)}")
+    parser.add_argument("--wire-format", choices=["json", "binary"], default="binary")
+    parser.add_argument("--batch-records", type=int, default=10, help="records per upload of a device")
+    parser.add_argument("--batch-delay", type=float, default=5.0, help="seconds a device holds records at most")
+    parser.add_argument("--no-gzip", action="store_true")
+    parser.add_argument("--broker", choices=["memory", "amqp"], default="memory",
+                        help="amqp publishes and consumes through RABBITMQ_URL")
+    parser.add_argument("--max-depth", type=int, default=1_000_000, help="queued messages before the in-process broker blocks")
+    parser.add_argument("--database-url", default=None, help="defaults to a fresh SQLite file")
+    parser.add_argument("--alert-rate", type=float, default=100.0, help="alert messages per second to the stand-in Telegram")
+    parser.add_argument("--drain-timeout", type=float, default=60.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", dest="json_path", default=None, help="also write the results to this file")
+    args = parser.parse_args()
+
+    if args.database_url is None:
+        args.database_url = f"sqlite+aiosqlite:///{tempfile.mkdtemp(prefix='fleet-')}/fleet.db"
+
+    print(f"{args.devices} devices, {args.duration:.0f}s, {args.broker} broker, {args.database_url}")
+    results = asyncio.run(simulate(args))
+    report(results)
+    if args.json_path:
+        with open(args.json_path, "w") as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,273 @@
+import argparse
+import asyncio
+import gc
+import json
+import math
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple, Union
+
+ROOT = Path(__file__).resolve().parents[1]
+for path in ("common/packages/metric-ingestion-models/src",
+             "common/packages/event-exchange-rabbit-mq/src",
+             "services/ingestion-service",
+             "services/processor-service/app"):
+    sys.path.insert(0, str(ROOT / path))
+
+BASELINE_PATH = Path(__file__).resolve().parent / "baselines" / "hotpath.json"
+
+
+# One measured operation of the per message hot path. fn handles `ops` items
+# per call (messages, records, alerts), the result is items per second. reset
+# runs untimed before every call, for cases whose cost grows with what
+# earlier calls left behind.
+class Case(object):
+    def __init__(self,
+                 name: str,
+                 ops: int,
+                 fn: Callable[[], Union[None, Awaitable[None]]],
+                 is_async: bool = False,
+                 reset: Optional[Callable[[], Awaitable[None]]] = None):
+        self.name = name
+        self.ops = ops
+        self.fn = fn
+        self.is_async = is_async
+        self.reset = reset
+
+
+class FakeExchange(object):
+    async def publish(self, message, routing_key: str, timeout: Optional[float] = None):
+        return None
+
+
+class FakeChannel(object):
+    # what MetricPublisher borrows from its pool, with the broker round trip taken out
+    def __init__(self):
+        self.exchange = FakeExchange()
+
+    async def get_exchange(self, name: str, ensure: bool = True) -> FakeExchange:
+        return self.exchange
+
+    async def close(self):
+        pass
+
+
+def build_cases(messages: int, metrics: int) -> Tuple[List[Case], Callable[[], Awaitable[None]], Callable[[], Awaitable[None]]]:
+    import httpx
+    from aio_pika.pool import Pool
+    from metric_ingestion_models import BINARY_CONTENT_TYPE, NDJSON_CONTENT_TYPE, decode_groups
+    from metric_ingestion_models.codec import frame
+
+    from db import async_engine, initdb, save_batch, DeviceStatus
+    from timeseries import TimeSeriesStore
+    from rollups import RollupWriter, RESOLUTIONS
+    from rules import RuleEngine
+    from alerts import Alert, format_digest
+
+    import app.main as ingestion
+    from app.admission import AdmissionController
+    from app.framing import NDJSONFramer, LengthPrefixedFramer
+    from app.publisher import MetricPublisher
+    from event_exchange_rabbit_mq import ShardedTopology
+
+    from decoding import make_bodies
+
+    json_bodies, binary_bodies = make_bodies(messages, metrics)
+    binary_types = [BINARY_CONTENT_TYPE] * len(binary_bodies)
+    groups = decode_groups(json_bodies)
+    statuses = [DeviceStatus.Normal] * len(groups)
+    rule_engine = RuleEngine.from_path(None)
+    alerts = [Alert(device_id=group.device_id, metric_name=metric.name, value=metric.value, timestamp=metric.timestamp)
+              for group in groups[:20] for metric in group.metrics[:1]]
+
+    ndjson_body = b"\n".join(json_bodies) + b"\n"
+    binary_body = b"".join(frame(body) for body in binary_bodies)
+    chunk = 1 << 16
+
+    def framed(framer, body: bytes):
+        for start in range(0, len(body), chunk):
+            framer.feed(body[start:start + chunk])
+        framer.close()
+
+    topology = ShardedTopology()
+    publisher = MetricPublisher(url="amqp://unused", topology=topology)
+
+    async def open_fake_channel():
+        return FakeChannel()
+
+    publisher._channel_pool = Pool(open_fake_channel, max_size=publisher.pool_size)
+    routing_keys = [topology.routing_key_for(group.device_id) for group in groups]
+
+    ingestion.app.state.publisher = publisher
+    # big enough that the measurement never hits a refusal
+    ingestion.app.state.admission = AdmissionController(max_in_flight=1 << 20, max_per_device=1 << 20)
+    api = httpx.AsyncClient(transport=httpx.ASGITransport(app=ingestion.app), base_url="http://ingestion")
+
+    metric_store = TimeSeriesStore(async_engine)
+    rollup_writer = RollupWriter(async_engine)
+
+    async def setup_database():
+        await initdb()
+        await metric_store.setup()
+        await rollup_writer.setup()
+
+    async def empty_tables():
+        # every call inserts into the same tables, left to grow they make each round slower than the last
+        tables = ["alerts", f"{metric_store.table}_default", *metric_store._known.values(),
+                  *(f"metrics_rollup_{resolution}" for resolution in RESOLUTIONS)]
+        async with async_engine.begin() as conn:
+            for table in tables:
+                await conn.exec_driver_sql(f"DELETE FROM {table}")
+
+    async def post(body: bytes, content_type: str):
+        response = await api.post("/ingest/metrics", content=body, headers={"Content-Type": content_type})
+        response.raise_for_status()
+
+    rows = list(zip(groups, statuses))
+    cases = [
+        Case("decode json", messages, lambda: decode_groups(json_bodies)),
+        Case("decode binary", messages, lambda: decode_groups(binary_bodies, binary_types)),
+        Case("encode json", messages, lambda: [group.model_dump_json() for group in groups]),
+        Case("encode binary", messages, lambda: [group.to_bytes() for group in groups]),
+        Case("rules evaluate", messages, lambda: rule_engine.evaluate(groups).statuses()),
+        Case("rules critical alerts", messages, lambda: rule_engine.evaluate(groups).critical_alerts()),
+        Case("alert digest format", len(alerts), lambda: format_digest(alerts)),
+        Case("ingest frame ndjson", messages, lambda: framed(NDJSONFramer(), ndjson_body)),
+        Case("ingest frame binary", messages, lambda: framed(LengthPrefixedFramer(), binary_body)),
+        Case("ingest publish, fake channel", messages,
+             lambda: publisher.publish_batch(json_bodies, routing_keys), is_async=True),
+        Case("ingest endpoint ndjson", messages, lambda: post(ndjson_body, NDJSON_CONTENT_TYPE), is_async=True),
+        Case("ingest endpoint binary", messages, lambda: post(binary_body, BINARY_CONTENT_TYPE), is_async=True),
+        Case("save batch sqlite", messages, lambda: save_batch(rows), is_async=True, reset=empty_tables),
+        Case("save batch sqlite, series+rollups", messages,
+             lambda: save_batch(rows, store=metric_store, rollups=rollup_writer), is_async=True, reset=empty_tables),
+    ]
+    return cases, setup_database, api.aclose
+
+
+def measure(runner: asyncio.Runner, case: Case, rounds: int, min_time: float) -> float:
+    def once() -> float:
+        if case.reset is not None:
+            runner.run(case.reset())
+        start = time.perf_counter()
+        if case.is_async:
+            runner.run(case.fn())
+        else:
+            case.fn()
+        return time.perf_counter() - start
+
+    # like timeit, no collector pauses inside a timed round, they would depend on what ran before
+    gc.collect()
+    gc.disable()
+    try:
+        # the first call warms caches up and sizes the round, fast cases repeat until a round is long enough to time
+        repeat = max(1, math.ceil(min_time / max(once(), 1e-9)))
+        best = float("inf")
+        for _ in range(rounds):
+            best = min(best, sum(once() for _ in range(repeat)) / repeat)
+    finally:
+        gc.enable()
+    return case.ops / best
+
+
+def run_suite(args, baseline: Optional[Dict[str, float]] = None) -> Dict[str, float]:
+    # the processor's db module reads its database from the environment on import
+    os.environ["DATABASE_URL"] = args.database_url or f"sqlite+aiosqlite:///{tempfile.mkdtemp(prefix='hotpath-')}/hotpath.db"
+    random.seed(args.seed)
+
+    results: Dict[str, float] = {}
+    with asyncio.Runner() as runner:
+        cases, setup_database, close = runner.run(_build(args))
+        runner.run(setup_database())
+        for case in cases:
+            if args.only and not any(pattern in case.name for pattern in args.only):
+                continue
+            ops_per_sec = measure(runner, case, args.rounds, args.min_time)
+            # a busy neighbour can spoil every round of a measurement, a case under the bar
+            # is measured again before it fails the gate
+            for _ in range(args.retries if baseline and case.name in baseline else 0):
+                if ops_per_sec >= baseline[case.name] * (1 - args.threshold):
+                    break
+                ops_per_sec = max(ops_per_sec, measure(runner, case, args.rounds, args.min_time))
+            results[case.name] = ops_per_sec
+            print(f"{case.name:36s} {1e6 / ops_per_sec:10.2f} us/op {ops_per_sec:14.0f} ops/s")
+        runner.run(close())
+    return results
+
+
+async def _build(args):
+    # built on the runner's loop, the httpx client and the engine pool stay bound to it
+    return build_cases(args.messages, args.metrics)
+
+
+def save(results: Dict[str, float], path: Path, args):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "w") as f:
+        json.dump({"python": platform.python_version(),
+                   "machine": platform.machine(),
+                   "messages": args.messages,
+                   "metrics": args.metrics,
+                   "ops_per_sec": results}, f, indent=2)
+        f.write("\n")
+    print(f"Baseline written to {path}")
+
+
+def load_baseline(path: Path) -> Dict[str, float]:
+    if not path.exists():
+        # ops/s only compare on one machine, so no baseline ships with the repo
+        sys.exit(f"No baseline at {path}, record one on this machine first with `hotpath.py save`")
+    with open(path) as f:
+        return json.load(f)["ops_per_sec"]
+
+
+def compare(results: Dict[str, float], baseline: Dict[str, float], threshold: float) -> bool:
+    regressed = []
+    print(f"\n{'case':36s} {'baseline':>12s} {'current':>12s} {'change':>8s}")
+    for name, current in results.items():
+        before = baseline.get(name)
+        if before is None:
+            print(f"{name:36s} {'-':>12s} {current:12.0f} {'new':>8s}")
+            continue
+        change = current / before - 1
+        flag = ""
+        if change < -threshold:
+            regressed.append(name)
+            flag = "  REGRESSED"
+        print(f"{name:36s} {before:12.0f} {current:12.0f} {change:+8.1%}{flag}")
+
+    if regressed:
+        print(f"\n{len(regressed)} case(s) slower than the baseline by more than {threshold:.0%}: {', '.join(regressed)}")
+        return False
+    print(f"\nNo case slower than the baseline by more than {threshold:.0%}")
+    return True
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Per message hot path of the ingestion and processor services")
+    parser.add_argument("command", choices=["run", "save", "compare"],
+                        help="run prints ops/s, save also writes the baseline, compare fails on regressions")
+    parser.add_argument("--baseline", type=Path, default=BASELINE_PATH,
+                        help="recorded by save on this machine, not shipped with the repo")
+    parser.add_argument("--threshold", type=float, default=0.15, help="tolerated ops/s drop, 0.15 is 15%%")
+    parser.add_argument("--messages", type=int, default=200)
+    parser.add_argument("--metrics", type=int, default=3)
+    parser.add_argument("--rounds", type=int, default=10)
+    parser.add_argument("--retries", type=int, default=2, help="extra measurements of a case before compare fails it")
+    parser.add_argument("--min-time", type=float, default=0.1, help="seconds a timed round lasts at least")
+    parser.add_argument("--only", nargs="*", default=None, help="cases whose name contains any of these")
+    parser.add_argument("--database-url", default=None, help="defaults to a fresh SQLite file")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    print(f"{args.messages} messages x {args.metrics} metrics, best of {args.rounds}")
+    if args.command == "compare":
+        baseline = load_baseline(args.baseline)
+        sys.exit(0 if compare(run_suite(args, baseline), baseline, args.threshold) else 1)
+    results = run_suite(args)
+    if args.command == "save":
+        save(results, args.baseline, args)
@@ -0,0 +1,88 @@
+import math
+import random
+from typing import Dict, List, Optional, Type
+
+from metric_ingestion import Collector
+from metric_ingestion_models import DeviceMetric
+
+# cpu_usage and ram_usage, the metrics the processor's default rules look at
+SYNTHETIC_METRICS = ("cpu_usage", "ram_usage")
+
+
+# Synthetic load of one virtual device, a value per metric per sample. The
+# profiles mimic what a fleet looks like to the rule engine: most devices
+# idle along, some spike now and then, a few sit on a threshold and flap.
+class SyntheticCollector(Collector):
+    name = "synthetic"
+    profile: str = ""
+
+    def __init__(self, seed: Optional[int] = None, metrics=SYNTHETIC_METRICS):
+        self.random = random.Random(seed)
+        self.metrics = metrics
+        self.samples: int = 0
+
+    def value(self, metric: str) -> float:
+        raise NotImplementedError
+
+    def collect(self, ts: float) -> List[DeviceMetric]:
+        self.samples += 1
+        return [DeviceMetric(name=metric, timestamp=ts, value=round(min(max(self.value(metric), 0.0), 100.0), 2))
+                for metric in self.metrics]
+
+
+class SteadyCollector(SyntheticCollector):
+    profile = "steady"
+
+    def __init__(self, seed: Optional[int] = None, metrics=SYNTHETIC_METRICS):
+        super().__init__(seed, metrics)
+        self.levels: Dict[str, float] = {metric: self.random.uniform(10, 45) for metric in metrics}
+
+    def value(self, metric: str) -> float:
+        return self.random.gauss(self.levels[metric], 3)
+
+
+class SpikyCollector(SteadyCollector):
+    profile = "spiky"
+
+    def __init__(self, seed: Optional[int] = None, metrics=SYNTHETIC_METRICS, spike_probability: float = 0.02):
+        super().__init__(seed, metrics)
+        self.spike_probability = spike_probability
+
+    def value(self, metric: str) -> float:
+        if self.random.random() < self.spike_probability:
+            return self.random.uniform(85, 100)
+        return super().value(metric)
+
+
+class FlappingCollector(SyntheticCollector):
+    profile = "flapping"
+
+    def __init__(self, seed: Optional[int] = None, metrics=SYNTHETIC_METRICS, period: int = 10):
+        super().__init__(seed, metrics)
+        self.period = period
+        self.phase = self.random.uniform(0, 2 * math.pi)
+
+    def value(self, metric: str) -> float:
+        # a slow wave around the critical threshold, crossing it twice a period
+        return 80 + 8 * math.sin(self.phase + 2 * math.pi * self.samples / self.period) + self.random.gauss(0, 1)
+
+
+PROFILES: Dict[str, Type[SyntheticCollector]] = {collector.profile: collector
+                                                 for collector in (SteadyCollector, SpikyCollector, FlappingCollector)}
+
+
+def parse_mix(mix: str) -> Dict[str, float]:
+    # "steady=0.8,spiky=0.15,flapping=0.05"
+    weights: Dict[str, float] = {}
+    for part in mix.split(","):
+        profile, _, weight = part.partition("=")
+        profile = profile.strip()
+        if profile not in PROFILES:
+            raise ValueError(f"Unknown profile {profile}, available: {sorted(PROFILES)}")
+        weights[profile] = float(weight or 1)
+    return weights
+
+
+def pick_profiles(count: int, mix: Dict[str, float], seed: int = 0) -> List[str]:
+    picker = random.Random(seed)
+    return picker.choices(list(mix), weights=list(mix.values()), k=count)
@@ -1,2 +1,6 @@
-def hello() -> str:
-    return "Hello from event-exchange-rabbit-mq!"
+from event_exchange_rabbit_mq.models.enumerations import ExchangeType, DeliveryMode
+from event_exchange_rabbit_mq.topology import ShardedTopology
+from event_exchange_rabbit_mq.claimer import ShardClaimer
+
+
+__all__ = ["ExchangeType", "DeliveryMode", "ShardedTopology", "ShardClaimer"]
@@ -0,0 +1,158 @@
+import asyncio
+import math
+import os
+import socket
+import zlib
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+from aio_pika import Channel
+from aio_pika.abc import AbstractChannel, AbstractIncomingMessage, AbstractRobustConnection
+from aio_pika.exceptions import ChannelClosed
+
+from event_exchange_rabbit_mq.topology import ShardedTopology
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+async def _ignore(message: AbstractIncomingMessage):
+    pass
+
+
+# Claims shard queues of a ShardedTopology for one consumer process. A shard
+# is held through an exclusive consumer on its own channel, so the broker
+# guarantees one owner per shard and per device ordering. Only shards whose
+# queue shows no consumer are tried, so a claim is refused only when another
+# process got there first. Every process also sits on the members queue,
+# whose consumer count gives the fair share, ceil(shards / members). Over the
+# share a process hands shards back, under it picks up free ones, so a new
+# replica takes load off the others and a dead one's shards are picked up
+# once the broker drops its connection.
+class ShardClaimer(object):
+    def __init__(self,
+                 connection: AbstractRobustConnection,
+                 topology: ShardedTopology,
+                 on_message: Callable[[AbstractIncomingMessage], Awaitable[None]],
+                 on_release: Optional[Callable[[int], Awaitable[None]]] = None,
+                 prefetch_count: int = 500,
+                 claim_interval: float = 5.0,
+                 max_shards: Optional[int] = None):
+        self.connection = connection
+        self.topology = topology
+        self.on_message = on_message
+        self.on_release = on_release
+        self.prefetch_count = prefetch_count
+        self.claim_interval = claim_interval
+        self.max_shards = max_shards
+
+        # start at a different shard in every process, so claims don't all collide on shard 0
+        self._offset = zlib.crc32(f"{socket.gethostname()}:{os.getpid()}".encode()) % topology.shards
+        self._held: Dict[int, Tuple[AbstractChannel, str]] = {}
+        self._control: Optional[AbstractChannel] = None
+        self._stopping = asyncio.Event()
+
+    @property
+    def shards(self) -> List[int]:
+        return sorted(self._held)
+
+    async def depths(self) -> Dict[int, int]:
+        # ready messages per held shard, asked on the control channel so a
+        # failed declaration never takes a consuming channel down
+        depths: Dict[int, int] = {}
+        if self._control is None or self._control.is_closed:
+            return depths
+        for shard in self.shards:
+            queue = await self._control.declare_queue(self.topology.queue_name(shard), passive=True)
+            depths[shard] = queue.declaration_result.message_count
+        return depths
+
+    async def _members(self) -> int:
+        queue = await self._control.declare_queue(self.topology.members_queue, passive=True)
+        return max(queue.declaration_result.consumer_count, 1)
+
+    def _fair_share(self, members: int) -> int:
+        share = math.ceil(self.topology.shards / members)
+        return min(share, self.max_shards) if self.max_shards else share
+
+    async def _is_free(self, shard: int) -> bool:
+        queue = await self._control.declare_queue(self.topology.queue_name(shard), passive=True)
+        return queue.declaration_result.consumer_count == 0
+
+    async def _claim(self, shard: int) -> bool:
+        # a plain channel, a robust one would be reopened by aio-pika after the broker refuses
+        # the claim, and after a reconnect rebalance claims again instead of restoring it
+        channel = await Channel(self.connection)
+        try:
+            await channel.set_qos(prefetch_count=self.prefetch_count)
+            queue = await self.topology.declare_queue(channel, shard)
+            consumer_tag = await queue.consume(self.on_message, exclusive=True)
+        except ChannelClosed:
+            # ACCESS_REFUSED, another consumer holds the shard; the broker closed the channel already
+            if not channel.is_closed:
+                await channel.close()
+            return False
+        self._held[shard] = (channel, consumer_tag)
+        logger.info(f"Claimed shard {shard}")
+        return True
+
+    async def _release(self, shard: int):
+        channel, consumer_tag = self._held.pop(shard)
+        if channel.is_closed:
+            return
+        try:
+            queue = await channel.get_queue(self.topology.queue_name(shard), ensure=False)
+            await queue.cancel(consumer_tag)
+            # whatever was delivered before the cancel is settled before the channel goes,
+            # closing it first would requeue messages already on their way to the database
+            if self.on_release is not None:
+                await self.on_release(shard)
+        finally:
+            await channel.close()
+        logger.info(f"Released shard {shard}")
+
+    async def rebalance(self):
+        for shard in [shard for shard, (channel, _) in self._held.items() if channel.is_closed]:
+            logger.warning(f"Lost shard {shard}, its channel closed")
+            self._held.pop(shard)
+
+        share = self._fair_share(await self._members())
+        while len(self._held) > share:
+            await self._release(max(self._held))
+
+        for step in range(self.topology.shards):
+            if len(self._held) >= share:
+                break
+            shard = (self._offset + step) % self.topology.shards
+            if shard not in self._held and await self._is_free(shard):
+                await self._claim(shard)
+
+    async def _open_control(self):
+        self._control = await self.connection.channel()
+        # every shard queue exists before _is_free asks for one passively
+        await self.topology.declare(self._control)
+        members = await self._control.declare_queue(self.topology.members_queue, durable=True)
+        await members.consume(_ignore)
+
+    async def run(self):
+        await self._open_control()
+        try:
+            while not self._stopping.is_set():
+                try:
+                    if self._control.is_closed:
+                        await self._open_control()
+                    await self.rebalance()
+                except ChannelClosed as err:
+                    logger.warning(f"Shard rebalance failed: {err!r}")
+                try:
+                    await asyncio.wait_for(self._stopping.wait(), timeout=self.claim_interval)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            for shard in list(self._held):
+                await self._release(shard)
+            if not self._control.is_closed:
+                await self._control.close()
+
+    def stop(self):
+        self._stopping.set()
@@ -0,0 +1,49 @@
+import zlib
+from typing import List
+
+from aio_pika.abc import AbstractChannel, AbstractExchange, AbstractQueue
+
+from event_exchange_rabbit_mq.models.enumerations import ExchangeType
+
+
+# N durable shard queues behind one direct exchange. A message goes to the
+# shard picked by a hash of its device id, so all of a device's messages sit
+# in one queue, in publish order, whoever consumes it. crc32 rather than
+# hash(): the mapping has to be the same in every process and every release.
+class ShardedTopology(object):
+    def __init__(self, exchange_name: str = "metrics.sharded", queue_prefix: str = "metrics.shard", shards: int = 16):
+        if shards <= 0:
+            raise ValueError("shards must be positive")
+        self.exchange_name = exchange_name
+        self.queue_prefix = queue_prefix
+        self.shards = shards
+
+    def shard_of(self, device_id: str) -> int:
+        return zlib.crc32(device_id.encode()) % self.shards
+
+    def routing_key(self, shard: int) -> str:
+        return f"{self.queue_prefix}.{shard}"
+
+    def routing_key_for(self, device_id: str) -> str:
+        return self.routing_key(self.shard_of(device_id))
+
+    def queue_name(self, shard: int) -> str:
+        return f"{self.queue_prefix}.{shard}"
+
+    @property
+    def members_queue(self) -> str:
+        # never gets a message, its consumer count is the number of live consumers
+        return f"{self.queue_prefix}.members"
+
+    async def declare_exchange(self, channel: AbstractChannel) -> AbstractExchange:
+        return await channel.declare_exchange(self.exchange_name, ExchangeType.Direct, durable=True)
+
+    async def declare_queue(self, channel: AbstractChannel, shard: int) -> AbstractQueue:
+        exchange = await self.declare_exchange(channel)
+        queue = await channel.declare_queue(self.queue_name(shard), durable=True)
+        await queue.bind(exchange, routing_key=self.routing_key(shard))
+        return queue
+
+    async def declare(self, channel: AbstractChannel) -> List[AbstractQueue]:
+        # declarations are idempotent, publishers and consumers both run this on start up
+        return [await self.declare_queue(channel, shard) for shard in range(self.shards)]
@@ -0,0 +1,192 @@
+import asyncio
+import itertools
+import zlib
+from types import SimpleNamespace
+from typing import Dict, List, Tuple
+
+import pytest
+from aio_pika.exceptions import ChannelClosed
+
+from event_exchange_rabbit_mq import ShardedTopology, ShardClaimer
+from event_exchange_rabbit_mq import claimer as claimer_module
+
+_tags = itertools.count()
+
+
+# Just enough of a broker for the claimer: queues, their consumers and the
+# exclusive consumer refusal; a closed channel takes its consumers with it.
+class Broker(object):
+    def __init__(self):
+        self.consumers: Dict[str, List[Tuple["FakeChannel", str, bool]]] = {}
+
+    def connection(self) -> "FakeConnection":
+        return FakeConnection(self)
+
+
+class FakeQueue(object):
+    def __init__(self, channel: "FakeChannel", name: str):
+        self.channel = channel
+        self.name = name
+
+    @property
+    def declaration_result(self):
+        return SimpleNamespace(consumer_count=len(self.channel.broker.consumers.get(self.name, [])), message_count=0)
+
+    async def bind(self, exchange, routing_key: str):
+        pass
+
+    async def consume(self, callback, exclusive: bool = False) -> str:
+        held = self.channel.broker.consumers.setdefault(self.name, [])
+        if held and (exclusive or any(taken for _, _, taken in held)):
+            await self.channel.close()
+            raise ChannelClosed(403, "ACCESS_REFUSED")
+        tag = f"ctag-{next(_tags)}"
+        held.append((self.channel, tag, exclusive))
+        return tag
+
+    async def cancel(self, consumer_tag: str):
+        held = self.channel.broker.consumers[self.name]
+        held[:] = [entry for entry in held if entry[1] != consumer_tag]
+
+
+class FakeChannel(object):
+    def __init__(self, broker: Broker):
+        self.broker = broker
+        self.is_closed = False
+
+    async def set_qos(self, prefetch_count: int):
+        pass
+
+    async def declare_exchange(self, name, kind, durable=False):
+        return name
+
+    async def declare_queue(self, name: str, durable: bool = False, passive: bool = False) -> FakeQueue:
+        return FakeQueue(self, name)
+
+    async def get_queue(self, name: str, ensure: bool = False) -> FakeQueue:
+        return FakeQueue(self, name)
+
+    async def close(self):
+        self.is_closed = True
+        for held in self.broker.consumers.values():
+            held[:] = [entry for entry in held if entry[0] is not self]
+
+
+class FakeConnection(object):
+    def __init__(self, broker: Broker):
+        self.broker = broker
+
+    async def channel(self) -> FakeChannel:
+        return FakeChannel(self.broker)
+
+
+@pytest.fixture(autouse=True)
+def plain_channels(monkeypatch):
+    # the claimer opens its shard channels with aio_pika.Channel(connection)
+    monkeypatch.setattr(claimer_module, "Channel", lambda connection: connection.channel())
+
+
+async def nothing(message):
+    pass
+
+
+async def started(broker: Broker, topology: ShardedTopology, **kwargs) -> ShardClaimer:
+    claimer = ShardClaimer(broker.connection(), topology, on_message=nothing, **kwargs)
+    await claimer._open_control()
+    return claimer
+
+
+def owners(broker: Broker, topology: ShardedTopology) -> Dict[int, int]:
+    return {shard: len(broker.consumers.get(topology.queue_name(shard), [])) for shard in range(topology.shards)}
+
+
+def test_a_device_always_routes_to_the_same_shard():
+    topology = ShardedTopology(queue_prefix="metrics.shard", shards=16)
+    assert topology.shard_of("device-1") == zlib.crc32(b"device-1") % 16
+    assert topology.routing_key_for("device-1") == topology.queue_name(topology.shard_of("device-1"))
+    shards = {topology.shard_of(f"device-{index}") for index in range(1000)}
+    assert shards == set(range(16))
+    with pytest.raises(ValueError):
+        ShardedTopology(shards=0)
+
+
+def test_replicas_split_the_shards_and_each_has_one_owner():
+    async def scenario():
+        broker, topology = Broker(), ShardedTopology(shards=16)
+        first = await started(broker, topology)
+        await first.rebalance()
+        assert first.shards == list(range(16))
+
+        second = await started(broker, topology)
+        third = await started(broker, topology)
+        for _ in range(2):
+            for claimer in (first, second, third):
+                await claimer.rebalance()
+        # ceil(16 / 3) each at most, every shard held by exactly one of them
+        assert all(len(claimer.shards) <= 6 for claimer in (first, second, third))
+        assert set(owners(broker, topology).values()) == {1}
+
+    asyncio.run(scenario())
+
+
+def test_the_shards_of_a_dead_replica_are_picked_up():
+    async def scenario():
+        broker, topology = Broker(), ShardedTopology(shards=8)
+        survivor = await started(broker, topology)
+        doomed = await started(broker, topology)
+        for claimer in (survivor, doomed, survivor):
+            await claimer.rebalance()
+        assert len(survivor.shards) == 4 and len(doomed.shards) == 4
+
+        # the broker drops every channel of a dead connection
+        for channel, _ in list(doomed._held.values()) + [(doomed._control, None)]:
+            await channel.close()
+        await survivor.rebalance()
+        assert survivor.shards == list(range(8))
+
+    asyncio.run(scenario())
+
+
+def test_a_refused_claim_is_not_held():
+    async def scenario():
+        broker, topology = Broker(), ShardedTopology(shards=4)
+        winner = await started(broker, topology)
+        loser = await started(broker, topology)
+        assert await winner._claim(2)
+        # the consumer count said free, another process got there in between
+        assert not await loser._claim(2)
+        assert 2 not in loser.shards and owners(broker, topology)[2] == 1
+
+    asyncio.run(scenario())
+
+
+def test_handed_back_shards_are_settled_before_their_channel_closes():
+    async def scenario():
+        broker, topology = Broker(), ShardedTopology(shards=4)
+        released = []
+
+        async def on_release(shard: int):
+            channel, _ = released_from[shard]
+            released.append((shard, channel.is_closed))
+
+        first = await started(broker, topology, on_release=on_release)
+        await first.rebalance()
+        released_from = dict(first._held)
+
+        second = await started(broker, topology)
+        await first.rebalance()
+        assert len(first.shards) == 2
+        assert sorted(released) == [(2, False), (3, False)]
+        assert all(channel.is_closed for shard, (channel, _) in released_from.items() if shard in (2, 3))
+
+    asyncio.run(scenario())
+
+
+def test_max_shards_caps_the_share():
+    async def scenario():
+        broker, topology = Broker(), ShardedTopology(shards=8)
+        claimer = await started(broker, topology, max_shards=3)
+        await claimer.rebalance()
+        assert len(claimer.shards) == 3
+
+    asyncio.run(scenario())
@@ -1,4 +1,8 @@
-from metric_ingestion_models.models import DeviceInformation, DeviceMetric, TMetric, DeviceMetricGroup 
+from metric_ingestion_models.models import DeviceInformation, DeviceMetric, TMetric, DeviceMetricGroup, IngestionResponse
+from metric_ingestion_models.codec import CodecError, JSON_CONTENT_TYPE, NDJSON_CONTENT_TYPE, BINARY_CONTENT_TYPE
+from metric_ingestion_models.decoding import decode_group, decode_groups
 
 
-__all__ = ["DeviceInformation", "DeviceMetric", "TMetric", "DeviceMetricGroup"]
+__all__ = ["DeviceInformation", "DeviceMetric", "TMetric", "DeviceMetricGroup", "IngestionResponse",
+           "CodecError", "JSON_CONTENT_TYPE", "NDJSON_CONTENT_TYPE", "BINARY_CONTENT_TYPE",
+           "decode_group", "decode_groups"]
@@ -0,0 +1,137 @@
+import math
+import struct
+import sys
+from array import array
+from functools import lru_cache
+from typing import Iterable, List, Sequence, Tuple, Union
+
+JSON_CONTENT_TYPE = "application/json"
+NDJSON_CONTENT_TYPE = "application/x-ndjson"
+BINARY_CONTENT_TYPE = "application/vnd.device-metric-group"
+
+MAGIC = b"DMG"
+VERSION = 1
+
+# Layout, little endian:
+#   "DMG" | u8 version | u16 device id length | device id (utf-8)
+#   u16 name count | per name: u16 length + utf-8 bytes
+#   u32 sample count | u16[n] name index | f64[n] timestamp | f64[n] value
+# Metric names are interned, samples are stored column by column so they can
+# be copied in with array.tobytes and read back with one struct call.
+_HEADER = struct.Struct("<3sBH")
+_U16 = struct.Struct("<H")
+_U32 = struct.Struct("<I")
+_FRAME = struct.Struct("<I")
+_U16_MAX = 0xFFFF
+_U32_MAX = 0xFFFFFFFF
+
+_SWAP = sys.byteorder != "little"
+
+Buffer = Union[bytes, bytearray, memoryview]
+
+
+class CodecError(ValueError):
+    pass
+
+
+@lru_cache(maxsize=256)
+def _columns(count: int) -> struct.Struct:
+    # groups come in a handful of sizes, one cached struct unpacks all three columns at once
+    return struct.Struct(f"<{count}H{count}d{count}d")
+
+
+def encode_columns(device_id: str, names: List[str], timestamps: Iterable[float], values: Iterable[float]) -> bytes:
+    interned = {}
+    name_index = array("H")
+    for name in names:
+        index = interned.get(name)
+        if index is None:
+            if len(interned) == _U16_MAX:
+                raise CodecError(f"More than {_U16_MAX} distinct metric names")
+            index = interned[name] = len(interned)
+        name_index.append(index)
+    if len(name_index) > _U32_MAX:
+        raise CodecError(f"More than {_U32_MAX} samples")
+
+    # a missing timestamp travels as NaN
+    ts_column = array("d", (math.nan if ts is None else ts for ts in timestamps))
+    value_column = array("d", values)
+    if not len(name_index) == len(ts_column) == len(value_column):
+        raise CodecError("Columns must have the same length")
+
+    if _SWAP:
+        name_index.byteswap()
+        ts_column.byteswap()
+        value_column.byteswap()
+
+    device = device_id.encode()
+    if len(device) > _U16_MAX:
+        raise CodecError(f"Device id longer than {_U16_MAX} bytes")
+    parts = [_HEADER.pack(MAGIC, VERSION, len(device)), device, _U16.pack(len(interned))]
+    for name in interned:
+        raw = name.encode()
+        if len(raw) > _U16_MAX:
+            raise CodecError(f"Metric name longer than {_U16_MAX} bytes")
+        parts.append(_U16.pack(len(raw)))
+        parts.append(raw)
+    parts.append(_U32.pack(len(name_index)))
+    parts.append(name_index.tobytes())
+    parts.append(ts_column.tobytes())
+    parts.append(value_column.tobytes())
+    return b"".join(parts)
+
+
+def decode_columns(data: Buffer) -> Tuple[str, List[str], Sequence[int], Sequence[float], Sequence[float]]:
+    # frames are small, one copy makes every slice below a plain bytes slice
+    data = bytes(data)
+    try:
+        magic, version, device_len = _HEADER.unpack_from(data, 0)
+        if magic != MAGIC or version != VERSION:
+            raise CodecError(f"Unsupported frame {magic!r} v{version}")
+        offset = _HEADER.size
+        device_id = data[offset:offset + device_len].decode()
+        offset += device_len
+
+        (name_count,) = _U16.unpack_from(data, offset)
+        offset += _U16.size
+        names: List[str] = []
+        for _ in range(name_count):
+            (name_len,) = _U16.unpack_from(data, offset)
+            offset += _U16.size
+            names.append(data[offset:offset + name_len].decode())
+            offset += name_len
+
+        (count,) = _U32.unpack_from(data, offset)
+        offset += _U32.size
+    except struct.error as err:
+        raise CodecError(f"Truncated frame: {err}") from err
+
+    if len(data) != offset + count * (2 + 8 + 8):
+        raise CodecError("Frame length does not match its sample count")
+
+    columns = _columns(count).unpack_from(data, offset)
+    name_index = columns[:count]
+    if count and max(name_index) >= name_count:
+        raise CodecError("Sample refers to an unknown metric name")
+
+    return device_id, names, name_index, columns[count:2 * count], columns[2 * count:]
+
+
+def frame(payload: bytes) -> bytes:
+    return _FRAME.pack(len(payload)) + payload
+
+
+def split_frames(data: Buffer) -> List[memoryview]:
+    view = memoryview(data)
+    frames: List[memoryview] = []
+    offset = 0
+    while offset < len(view):
+        if offset + _FRAME.size > len(view):
+            raise CodecError("Truncated frame header")
+        (size,) = _FRAME.unpack_from(view, offset)
+        offset += _FRAME.size
+        if offset + size > len(view):
+            raise CodecError("Truncated frame")
+        frames.append(view[offset:offset + size])
+        offset += size
+    return frames
@@ -0,0 +1,36 @@
+from typing import List, Optional, Sequence
+
+from metric_ingestion_models.models import DeviceMetricGroup
+from metric_ingestion_models.codec import BINARY_CONTENT_TYPE
+
+# bound once, pydantic-core parses the raw bytes without an intermediate json.loads
+_validate_json = DeviceMetricGroup.__pydantic_validator__.validate_json
+
+
+def decode_group(body: bytes, content_type: Optional[str] = None) -> DeviceMetricGroup:
+    if content_type == BINARY_CONTENT_TYPE:
+        return DeviceMetricGroup.from_bytes(body)
+    return _validate_json(body)
+
+
+# Decodes a batch of message bodies, None marks a body that could not be decoded,
+# a bad body never costs the rest of the batch. One pydantic-core call over the
+# batch joined into a JSON array measured no faster than a call per body, and an
+# error in it would throw the whole batch back to this loop anyway.
+def decode_groups(bodies: Sequence[bytes],
+                  content_types: Optional[Sequence[Optional[str]]] = None) -> List[Optional[DeviceMetricGroup]]:
+    results: List[Optional[DeviceMetricGroup]] = []
+    append = results.append
+    from_bytes = DeviceMetricGroup.from_bytes
+    validate_json = _validate_json
+
+    for position, body in enumerate(bodies):
+        try:
+            if content_types is not None and content_types[position] == BINARY_CONTENT_TYPE:
+                append(from_bytes(body))
+            else:
+                append(validate_json(body))
+        except ValueError:
+            append(None)
+
+    return results
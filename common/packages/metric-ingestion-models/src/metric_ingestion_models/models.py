@@ -1,6 +1,6 @@
 from pydantic import BaseModel, Field 
 from typing import Optional, List, TypeVar, Literal, Union, Self
-import json
+from metric_ingestion_models.codec import encode_columns, decode_columns
 
 class DeviceInformation:
     os: Literal["linux", "macOS", "window", "other"] = Field(default="linux")
@@ -13,8 +13,9 @@ class DeviceMetric(BaseModel):
     timestamp: Optional[float] = Field(default=0.0)
     value: Union[float, int] = Field()
 
-    def from_json(cls, json_value: str) -> Self:
-        return cls.__init__(**json.loads(json_value))
+    @classmethod
+    def from_json(cls, json_value: Union[str, bytes]) -> Self:
+        return cls.model_validate_json(json_value)
 
 TMetric = TypeVar("TMetric", bound=DeviceMetric)
 
@@ -23,17 +24,38 @@ class DeviceMetricGroup(BaseModel):
     device_id: str = Field(default="000-010-0001")
 
     @classmethod
-    def from_json(cls, json_value: str):
-        json_object = json.loads(json_value)
+    def from_json(cls, json_value: Union[str, bytes]) -> Self:
+        return cls.model_validate_json(json_value)
+
+    def to_bytes(self) -> bytes:
+        return encode_columns(self.device_id,
+                              [metric.name for metric in self.metrics],
+                              [metric.timestamp for metric in self.metrics],
+                              [metric.value for metric in self.metrics])
 
-        return cls.__init__(device_id=json_object["device_id"],\
-                             metrics = [DeviceMetric.from_json(metric_raw) for metric_raw in json_object.get("metrics", [])])
+    @classmethod
+    def from_bytes(cls, data) -> Self:
+        device_id, names, name_index, timestamps, values = decode_columns(data)
+        # plain dicts go through pydantic-core in one call, about twice as fast as model_construct
+        # per metric; the columns are typed already, so strict mode has no coercion to try
+        return cls.__pydantic_validator__.validate_python(
+            {"device_id": device_id,
+             "metrics": [{"name": names[index], "timestamp": None if ts != ts else ts, "value": value}
+                         for index, ts, value in zip(name_index, timestamps, values)]},
+            strict=True)
 
     # TODO: write field validation using pydantic
 
 class IngestionResponse(BaseModel):
     counter: int = Field(default=0, gt=-1)
+    accepted: int = Field(default=0, gt=-1)
+    rejected: int = Field(default=0, gt=-1)
     status: Literal["success", "error"] = Field(default="success")
     msg: str = Field(default ="No msg")
+    # seconds the client should leave between uploads, grows with the load of the api; None when it is quiet
+    suggested_interval: Optional[float] = Field(default=None, ge=0)
+    # records at the head of the body that are settled, published or rejected; a client
+    # retrying a failed upload sends only the records after them
+    offset: int = Field(default=0, gt=-1)
 
     
\ No newline at end of file
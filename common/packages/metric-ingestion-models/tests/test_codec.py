@@ -0,0 +1,64 @@
+import math
+
+import pytest
+
+from metric_ingestion_models import CodecError, DeviceMetric, DeviceMetricGroup
+from metric_ingestion_models.codec import encode_columns, decode_columns, frame, split_frames
+
+
+def test_columns_round_trip():
+    names = ["cpu_usage", "ram_usage", "cpu_usage"]
+    data = encode_columns("dev-1", names, [1.5, None, 3.0], [10.0, 20.5, -1.0])
+    device_id, interned, name_index, timestamps, values = decode_columns(data)
+    assert device_id == "dev-1"
+    assert [interned[index] for index in name_index] == names
+    assert timestamps[0] == 1.5 and math.isnan(timestamps[1]) and timestamps[2] == 3.0
+    assert list(values) == [10.0, 20.5, -1.0]
+
+
+def test_group_round_trip():
+    group = DeviceMetricGroup(device_id="dev-ü",
+                              metrics=[DeviceMetric(name="cpu_usage", timestamp=100.0, value=12.5),
+                                       DeviceMetric(name="disk_usage", timestamp=None, value=3)])
+    decoded = DeviceMetricGroup.from_bytes(group.to_bytes())
+    assert decoded.device_id == "dev-ü"
+    assert [(metric.name, metric.timestamp, metric.value) for metric in decoded.metrics] == \
+        [("cpu_usage", 100.0, 12.5), ("disk_usage", None, 3.0)]
+
+
+def test_empty_group_round_trip():
+    decoded = DeviceMetricGroup.from_bytes(DeviceMetricGroup(device_id="dev", metrics=[]).to_bytes())
+    assert decoded.device_id == "dev" and decoded.metrics == []
+
+
+def test_decode_rejects_damaged_frames():
+    data = encode_columns("dev", ["cpu_usage"], [1.0], [2.0])
+    with pytest.raises(CodecError):
+        decode_columns(data[:-1])
+    with pytest.raises(CodecError):
+        decode_columns(b"XYZ" + data[3:])
+    with pytest.raises(CodecError):
+        decode_columns(data[:5])
+
+
+def test_encode_rejects_what_the_header_cannot_hold():
+    with pytest.raises(CodecError):
+        encode_columns("d" * 0x10000, [], [], [])
+    with pytest.raises(CodecError):
+        encode_columns("dev", ["m" * 0x10000], [1.0], [1.0])
+    with pytest.raises(CodecError):
+        encode_columns("dev", ["cpu_usage"], [1.0, 2.0], [1.0])
+
+
+def test_split_frames():
+    payloads = [b"", b"a", b"bc" * 100]
+    frames = split_frames(b"".join(frame(payload) for payload in payloads))
+    assert [bytes(part) for part in frames] == payloads
+
+
+def test_split_frames_truncated():
+    data = frame(b"abcdef")
+    with pytest.raises(CodecError):
+        split_frames(data[:-1])
+    with pytest.raises(CodecError):
+        split_frames(data + b"\x01\x00")
@@ -0,0 +1,28 @@
+from metric_ingestion_models import DeviceMetric, DeviceMetricGroup, BINARY_CONTENT_TYPE, JSON_CONTENT_TYPE, \
+    decode_group, decode_groups
+
+
+def make_group(device_id: str) -> DeviceMetricGroup:
+    return DeviceMetricGroup(device_id=device_id, metrics=[DeviceMetric(name="cpu_usage", timestamp=1.0, value=42.0)])
+
+
+def test_decode_groups_mixes_formats():
+    groups = [make_group("json"), make_group("binary")]
+    bodies = [groups[0].model_dump_json().encode(), groups[1].to_bytes()]
+    assert decode_groups(bodies, [JSON_CONTENT_TYPE, BINARY_CONTENT_TYPE]) == groups
+    # without content types every body is JSON
+    assert decode_groups(bodies[:1]) == groups[:1]
+
+
+def test_bad_bodies_do_not_abort_the_batch():
+    good = make_group("good")
+    bodies = [b"{not json", good.model_dump_json().encode(), b'{"metrics": [{"value": "high"}]}', b"DMG\x01",
+              good.to_bytes()]
+    types = [None, None, None, BINARY_CONTENT_TYPE, BINARY_CONTENT_TYPE]
+    assert decode_groups(bodies, types) == [None, good, None, None, good]
+
+
+def test_decode_groups_matches_decode_group():
+    body = make_group("dev").model_dump_json().encode()
+    assert decode_groups([body]) == [decode_group(body)]
+    assert decode_groups([]) == []
@@ -1,4 +1,8 @@
-from metric_ingestion import MetricIngestionClient, IngestionSettings
+from metric_ingestion.client import MetricIngestionClient, IngestionSettings
+from metric_ingestion.collectors import Collector, CollectorSet, register_collector
+from metric_ingestion.telemetry import RequestTelemetry, TelemetryMiddleware
+from metric_ingestion.cluster import MultiWorkerExporter
 
 
-__all__ = ["MetricIngestionClient", "IngestionSettings"]
+__all__ = ["MetricIngestionClient", "IngestionSettings", "Collector", "CollectorSet", "register_collector",
+           "RequestTelemetry", "TelemetryMiddleware", "MultiWorkerExporter"]
@@ -0,0 +1,152 @@
+import os
+import struct
+import time
+from collections import deque
+from typing import Deque, List, Tuple
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+_RECORD_HEADER = struct.Struct("<I")
+
+
+# Bounded in-memory buffer of encoded records, oldest first.
+# append hands back the records pushed out by an overflow so the caller can spill them.
+class RingBuffer(object):
+    def __init__(self, capacity: int = 10_000):
+        if capacity < 1:
+            raise ValueError("capacity must be positive")
+        self.capacity = capacity
+        self._records: Deque[Tuple[float, bytes]] = deque()
+        self._size: int = 0
+
+    def __len__(self) -> int:
+        return len(self._records)
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+    def oldest_age(self) -> float:
+        if not self._records:
+            return 0.0
+        return time.monotonic() - self._records[0][0]
+
+    def append(self, record: bytes) -> List[bytes]:
+        evicted: List[bytes] = []
+        while len(self._records) >= self.capacity:
+            evicted.append(self._pop())
+        self._records.append((time.monotonic(), record))
+        self._size += len(record)
+        return evicted
+
+    def take(self, max_records: int, max_bytes: int) -> List[bytes]:
+        # always hand out at least one record, even if it alone is over max_bytes
+        batch: List[bytes] = []
+        taken = 0
+        while self._records and len(batch) < max_records:
+            if batch and taken + len(self._records[0][1]) > max_bytes:
+                break
+            record = self._pop()
+            taken += len(record)
+            batch.append(record)
+        return batch
+
+    def _pop(self) -> bytes:
+        _, record = self._records.popleft()
+        self._size -= len(record)
+        return record
+
+
+# Append-only overflow file, records are stored with a u32 length prefix so
+# NDJSON lines and binary frames spill the same way. Replay reads from a
+# cursor, the file is removed only once everything up to its end was sent.
+# The methods block on file I/O, the client calls them from a worker thread.
+class SpillFile(object):
+    def __init__(self, path: str, max_bytes: int = 64 << 20):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.dropped: int = 0
+        self._cursor: int = 0
+
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def record_size(record: bytes) -> int:
+        return _RECORD_HEADER.size + len(record)
+
+    def pending_bytes(self) -> int:
+        try:
+            return max(os.path.getsize(self.path) - self._cursor, 0)
+        except FileNotFoundError:
+            return 0
+
+    def write(self, records: List[bytes]):
+        if not records:
+            return
+        try:
+            current = os.path.getsize(self.path)
+        except FileNotFoundError:
+            current = 0
+
+        parts: List[bytes] = []
+        dropped = 0
+        for record in records:
+            if current + _RECORD_HEADER.size + len(record) > self.max_bytes:
+                dropped += 1
+                continue
+            parts.append(_RECORD_HEADER.pack(len(record)))
+            parts.append(record)
+            current += _RECORD_HEADER.size + len(record)
+
+        if dropped:
+            self.dropped += dropped
+            logger.warning(f"Spill file {self.path} is full, dropped {dropped} records")
+        if parts:
+            with open(self.path, "ab") as file:
+                file.write(b"".join(parts))
+                file.flush()
+                os.fsync(file.fileno())
+
+    def read(self, max_records: int, max_bytes: int) -> Tuple[List[bytes], int]:
+        # returns a batch and the cursor to commit once that batch was delivered
+        records: List[bytes] = []
+        try:
+            file = open(self.path, "r+b")
+        except FileNotFoundError:
+            return records, self._cursor
+
+        with file:
+            file.seek(self._cursor)
+            offset = self._cursor
+            taken = 0
+            while len(records) < max_records:
+                header = file.read(_RECORD_HEADER.size)
+                if not header:
+                    break
+                length = _RECORD_HEADER.unpack(header)[0] if len(header) == _RECORD_HEADER.size else -1
+                if records and taken + length > max_bytes:
+                    break
+                record = file.read(length) if length >= 0 else b""
+                if length < 0 or len(record) < length:
+                    # torn write from a crash, nothing after it can be trusted
+                    logger.warning(f"Spill file {self.path} ends with a partial record, discarding it")
+                    file.truncate(offset)
+                    break
+                records.append(record)
+                taken += length
+                offset += _RECORD_HEADER.size + length
+        return records, offset
+
+    # the cursor lives in memory, after a restart the file is replayed from the
+    # start again, delivery is at least once
+    def commit(self, cursor: int):
+        self._cursor = cursor
+        try:
+            if self._cursor >= os.path.getsize(self.path):
+                os.remove(self.path)
+                self._cursor = 0
+        except FileNotFoundError:
+            self._cursor = 0
@@ -1,14 +1,23 @@
 import httpx 
 from pydantic import BaseModel, Field
 from datetime import timedelta, datetime, timezone
-import psutil
-from typing import Set, Optional
-from metric_ingestion_models import DeviceMetricGroup, DeviceMetric
+from typing import Any, Callable, Set, Optional, Literal, List
+from concurrent.futures import ThreadPoolExecutor
+from metric_ingestion_models import DeviceMetricGroup, NDJSON_CONTENT_TYPE, BINARY_CONTENT_TYPE
+from metric_ingestion_models.codec import frame
+from metric_ingestion.buffer import RingBuffer, SpillFile
+from metric_ingestion.collectors import Collector, CollectorSet, COLLECTORS, DEFAULT_METRICS
 import asyncio 
+import contextlib
+import gzip
+import random
+import time
 
 import logging
 
-METRICS: Set[str] = {"cpu_times", "cpu_percent", "cpu_time_percent"}
+logger = logging.getLogger(__name__)
+
+METRICS: Set[str] = set(COLLECTORS)
 
 
 class IngestionSettings(BaseModel):
@@ -17,19 +26,54 @@ class IngestionSettings(BaseModel):
     exporting_metrics: Optional[Set[str]] = Field(default=None)
     device_id: str = Field(...)
     sending_limit: Optional[int] = Field(default=None)
+    wire_format: Literal["json", "binary"] = Field(default="json")
+    buffer_capacity: int = Field(default=10_000, gt=0)
+    batch_max_records: int = Field(default=500, gt=0)
+    batch_max_bytes: int = Field(default=1 << 20, gt=0)
+    batch_max_delay: timedelta = Field(default_factory=lambda: timedelta(seconds=60))
+    compression: Optional[Literal["gzip"]] = Field(default="gzip")
+    request_timeout: float = Field(default=10.0, gt=0)
+    max_retries: int = Field(default=5, ge=0)
+    backoff_base: float = Field(default=0.5, gt=0)
+    backoff_max: float = Field(default=30.0, gt=0)
+    spill_path: Optional[str] = Field(default=None)
+    spill_max_bytes: int = Field(default=64 << 20, gt=0)
 
+# Samples go to a bounded ring buffer and leave it in batches, by size or age.
+# A batch that can't be delivered after the retries, and whatever the buffer
+# pushes out on overflow, is appended to the spill file and replayed once the
+# ingestion api answers again. The spill file's reads, writes and fsyncs run on
+# a worker thread of their own, off the host service's event loop, and one at a
+# time so a replay never removes a file a write is still appending to.
 class MetricIngestionClient(object):
-    def __init__(self, setting: IngestionSettings):
+    def __init__(self,
+                 setting: IngestionSettings,
+                 collectors: Optional[CollectorSet] = None,
+                 transport: Optional[httpx.AsyncBaseTransport] = None):
         self.setting: IngestionSettings = setting
         self.stop_event = asyncio.Event()
+        self.collectors = collectors or CollectorSet(setting.exporting_metrics or DEFAULT_METRICS)
+        # e.g. one ASGI transport shared by a simulated fleet, None opens a connection pool per client
+        self.transport = transport
+        self.buffer = RingBuffer(capacity=setting.buffer_capacity)
+        self.spill: Optional[SpillFile] = SpillFile(setting.spill_path, max_bytes=setting.spill_max_bytes) \
+            if setting.spill_path else None
+        self.sent: int = 0
+        self.dropped: int = 0
+        # the ingestion api's suggested interval, no upload leaves before _not_before
+        self.suggested_interval: Optional[float] = None
+        self._not_before: float = 0.0
+
+        self._wakeup = asyncio.Event()
+        self._client: Optional[httpx.AsyncClient] = None
+        self._spill_executor: Optional[ThreadPoolExecutor] = None
+
+    def add_collector(self, collector: Collector):
+        self.collectors.add(collector)
 
-    def _retrieve_metric(self) -> DeviceMetricGroup:
-        cpu_usage = psutil.cpu_percent(interval=1)
-        ram_usage = psutil.virtual_memory().percent
+    async def _retrieve_metric(self) -> DeviceMetricGroup:
         ts = datetime.now(timezone.utc).timestamp()
-        return DeviceMetricGroup(metrics = [DeviceMetric(name="cpu_usage", timestamp=ts, value = cpu_usage), \
-                                            DeviceMetric(name="ram_usage", timestamp=ts, value=ram_usage)], \
-                                 device_id=self.setting.device_id)
+        return DeviceMetricGroup(metrics=await self.collectors.collect(ts), device_id=self.setting.device_id)
     
     
     async def metric_streaming(self):
@@ -39,35 +83,203 @@ class MetricIngestionClient(object):
             nonlocal counter
             continued = True
             counter += 1 
-            if not self.setting.sending_limit :
+            if self.setting.sending_limit:
                 continued = counter <= self.setting.sending_limit
             return continued and not self.stop_event.is_set()
         
         while conditional_loop():
-            yield self._retrieve_metric()
-            #await asyncio.sleep()
-            await asyncio.wait_for(self.stop_event.wait(), timeout=float(self.setting.interval_time.microseconds))
+            yield self._encode(await self._retrieve_metric())
+            try:
+                await asyncio.wait_for(self.stop_event.wait(), timeout=self.setting.interval_time.total_seconds())
+            except asyncio.TimeoutError:
+                pass
 
 
+    def _encode(self, metric_group: DeviceMetricGroup) -> bytes:
+        if self.setting.wire_format == "binary":
+            return frame(metric_group.to_bytes())
+        # one record per line, the ingestion api frames the body on newlines
+        return metric_group.model_dump_json().encode() + b"\n"
+
+    def _content_type(self) -> str:
+        return BINARY_CONTENT_TYPE if self.setting.wire_format == "binary" else NDJSON_CONTENT_TYPE
+
     def export_device_information():
         pass
 
-    
-    async def start_expose(self):
-        logger = logging.getLogger(__name__)
+    async def _buffer_record(self, record: bytes):
+        evicted = self.buffer.append(record)
+        if evicted:
+            await self._spill(evicted)
+        if len(self.buffer) >= self.setting.batch_max_records or self.buffer.size >= self.setting.batch_max_bytes:
+            self._wakeup.set()
 
-        async with httpx.AsyncClient() as client:
-            response = await client.post(self.setting.ingestion_endpoint, content=self.metric_streaming())
-            logger.log(response.json())
-    
-    async def stop_expose(self, ):
-        self.stop_event.set()
+    async def _spill_io(self, method: Callable[..., Any], *args) -> Any:
+        if self._spill_executor is None:
+            self._spill_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="metric-spill")
+        return await asyncio.get_running_loop().run_in_executor(self._spill_executor, method, *args)
 
-                
+    async def _spill_pending(self) -> bool:
+        return self.spill is not None and await self._spill_io(self.spill.pending_bytes) > 0
 
-                
+    async def _spill(self, records: List[bytes]):
+        if not records:
+            return
+        if self.spill is None:
+            self.dropped += len(records)
+            logger.warning(f"Dropped {len(records)} records, no spill file configured")
+            return
+        await self._spill_io(self.spill.write, records)
 
+    def _batch_due(self) -> bool:
+        return len(self.buffer) >= self.setting.batch_max_records \
+            or self.buffer.size >= self.setting.batch_max_bytes \
+            or self.buffer.oldest_age() >= self.setting.batch_max_delay.total_seconds()
 
+    def _obey(self, response: httpx.Response):
+        try:
+            suggested = response.json().get("suggested_interval")
+        except (ValueError, AttributeError):
+            return
+        if suggested is None:
+            # no load on the api, the client's own batching decides again
+            self.suggested_interval = None
+            self._not_before = 0.0
+            return
+        self.suggested_interval = float(suggested)
+        self._not_before = time.monotonic() + self.suggested_interval
 
+    def _flush_wait(self) -> float:
+        timeout = self.setting.batch_max_delay.total_seconds() - self.buffer.oldest_age()
+        return max(timeout, self._not_before - time.monotonic(), 0)
 
-        
+    def _backoff(self, attempt: int) -> float:
+        # full jitter, so clients knocked off together don't come back together
+        return random.uniform(0, min(self.setting.backoff_max, self.setting.backoff_base * 2 ** attempt))
+
+    def _body(self, records: List[bytes]) -> bytes:
+        body = b"".join(records)
+        if self.setting.compression == "gzip":
+            body = gzip.compress(body, compresslevel=6)
+        return body
+
+    def _settled(self, response: httpx.Response, records: List[bytes]) -> int:
+        # a failed upload reports how many records at its head went through or were
+        # rejected, only the ones after them are sent again
+        try:
+            offset = int(response.json().get("offset") or 0)
+        except (ValueError, TypeError, AttributeError):
+            return 0
+        return min(max(offset, 0), len(records))
+
+    async def _send(self, records: List[bytes], retries: int) -> List[bytes]:
+        # returns the records still to deliver, none once the batch is settled:
+        # delivered, or refused for good by a 4xx
+        body = self._body(records)
+        headers = {"Content-Type": self._content_type(), "X-Device-Id": self.setting.device_id}
+        if self.setting.compression == "gzip":
+            headers["Content-Encoding"] = "gzip"
+
+        for attempt in range(retries + 1):
+            delay = None
+            try:
+                response = await self._client.post(self.setting.ingestion_endpoint, content=body, headers=headers)
+            except httpx.TransportError as err:
+                logger.warning(f"Failed to reach {self.setting.ingestion_endpoint}: {err!r}")
+            else:
+                self._obey(response)
+                if response.status_code < 300:
+                    self.sent += len(records)
+                    logger.debug(f"Delivered {len(records)} records: {response.text}")
+                    return []
+                if response.status_code != 429 and response.status_code < 500:
+                    logger.error(f"Ingestion refused {len(records)} records with {response.status_code}: {response.text}")
+                    return []
+                logger.warning(f"Ingestion answered {response.status_code}, attempt {attempt + 1}/{retries + 1}")
+                settled = self._settled(response, records)
+                if settled:
+                    self.sent += settled
+                    records = records[settled:]
+                    if not records:
+                        return []
+                    body = self._body(records)
+                try:
+                    delay = float(response.headers["Retry-After"])
+                except (KeyError, ValueError):
+                    pass
+
+            if attempt < retries:
+                await asyncio.sleep(delay if delay is not None else self._backoff(attempt))
+        return records
+
+    async def _replay_spill(self) -> bool:
+        while await self._spill_pending():
+            records, cursor = await self._spill_io(self.spill.read, self.setting.batch_max_records,
+                                                   self.setting.batch_max_bytes)
+            if not records:
+                await self._spill_io(self.spill.commit, cursor)
+                break
+            remaining = await self._send(records, retries=0)
+            if remaining:
+                # the delivered head of the batch is not replayed again
+                cursor -= sum(SpillFile.record_size(record) for record in remaining)
+                await self._spill_io(self.spill.commit, cursor)
+                return False
+            await self._spill_io(self.spill.commit, cursor)
+            logger.info(f"Replayed {len(records)} spilled records")
+        return True
+
+    async def flush(self, force: bool = False, retries: Optional[int] = None) -> bool:
+        retries = self.setting.max_retries if retries is None else retries
+        while self.buffer and (force or self._batch_due()):
+            records = self.buffer.take(self.setting.batch_max_records, self.setting.batch_max_bytes)
+            remaining = await self._send(records, retries)
+            if remaining:
+                await self._spill(remaining)
+                return False
+        # the endpoint answers again, catch up on what piled up while it was gone
+        return await self._replay_spill()
+
+    async def _sample(self):
+        try:
+            async for record in self.metric_streaming():
+                await self._buffer_record(record)
+        finally:
+            self._wakeup.set()
+
+    async def start_expose(self):
+        async with httpx.AsyncClient(timeout=self.setting.request_timeout, transport=self.transport) as client:
+            self._client = client
+            sampler = asyncio.create_task(self._sample())
+            try:
+                while not sampler.done():
+                    try:
+                        await asyncio.wait_for(self._wakeup.wait(), timeout=self._flush_wait())
+                    except asyncio.TimeoutError:
+                        pass
+                    self._wakeup.clear()
+                    # a loaded api asked for more room between uploads, the buffer holds on meanwhile
+                    if time.monotonic() < self._not_before:
+                        continue
+                    if self._batch_due() or await self._spill_pending():
+                        await self.flush()
+                await sampler
+            finally:
+                # cancelled from outside the sampler is still running, it must not keep
+                # collecting into a buffer nobody flushes anymore
+                if not sampler.done():
+                    sampler.cancel()
+                    with contextlib.suppress(asyncio.CancelledError):
+                        await sampler
+                # one last try on the way out, what doesn't make it waits in the spill file
+                if self.buffer and not await self.flush(force=True, retries=0):
+                    await self._spill(self.buffer.take(len(self.buffer), self.buffer.size))
+                self.collectors.close()
+                if self._spill_executor is not None:
+                    self._spill_executor.shutdown(wait=False)
+                    self._spill_executor = None
+                self._client = None
+
+    async def stop_expose(self, ):
+        self.stop_event.set()
+        self._wakeup.set()
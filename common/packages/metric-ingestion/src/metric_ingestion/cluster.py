@@ -0,0 +1,147 @@
+import asyncio
+import json
+import os
+import socket
+import time
+from typing import Optional
+
+import redis.asyncio as redis
+from redis.exceptions import LockError
+
+from metric_ingestion.client import MetricIngestionClient, IngestionSettings
+from metric_ingestion.telemetry import RequestTelemetry
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+# One exporter per host however many uvicorn workers run. Every worker runs a
+# MultiWorkerExporter; the one holding the redis lock is the leader, renews the
+# lock every heartbeat and runs the ingestion client. The others push their
+# request telemetry to a redis list the leader drains into its own telemetry,
+# so a single report per interval covers every worker. A list rather than a
+# hash: a worker that reports twice before the leader drains doesn't overwrite
+# itself. If the leader dies its lock runs out and the next worker to try
+# takes over.
+class MultiWorkerExporter(object):
+    def __init__(self,
+                 setting: IngestionSettings,
+                 client: redis.Redis,
+                 telemetry: Optional[RequestTelemetry] = None,
+                 lock_key: Optional[str] = None,
+                 lock_ttl: float = 30.0,
+                 max_pending: int = 10_000):
+        self.setting = setting
+        self.client = client
+        self.telemetry = telemetry
+        self.lock_ttl = lock_ttl
+        self.heartbeat = lock_ttl / 3
+        self.max_pending = max_pending
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}"
+        self.contributions_key = f"metric-exporter:{setting.device_id}:contributions"
+
+        self._lock = client.lock(lock_key or f"metric-exporter:{setting.device_id}:leader",
+                                 timeout=lock_ttl, blocking=False, thread_local=False)
+        self._leading = False
+        self._renewed_at = 0.0
+        self._exporter: Optional[MetricIngestionClient] = None
+        self._exporter_task: Optional[asyncio.Task] = None
+        self._stop_event = asyncio.Event()
+
+    @property
+    def is_leader(self) -> bool:
+        return self._leading
+
+    async def _lead(self):
+        self._leading = True
+        self._renewed_at = time.monotonic()
+        logger.info(f"Worker {self.worker_id} leads the metric export")
+        self._exporter = MetricIngestionClient(self.setting)
+        if self.telemetry is not None:
+            self._exporter.add_collector(self.telemetry)
+        self._exporter_task = asyncio.create_task(self._exporter.start_expose())
+
+    async def _step_down(self):
+        self._leading = False
+        if self._exporter is not None:
+            await self._exporter.stop_expose()
+            try:
+                await self._exporter_task
+            except Exception as err:
+                logger.error(f"Metric exporter of {self.worker_id} failed: {err!r}")
+        self._exporter = None
+        self._exporter_task = None
+
+    async def _contribute(self):
+        if self.telemetry is None:
+            return
+        state = self.telemetry.take_state()
+        if not state["routes"]:
+            return
+        async with self.client.pipeline(transaction=False) as pipe:
+            pipe.rpush(self.contributions_key, json.dumps(state, separators=(",", ":")))
+            # with no leader for a long while keep the newest, and let the key die eventually
+            pipe.ltrim(self.contributions_key, -self.max_pending, -1)
+            pipe.expire(self.contributions_key, int(self.setting.interval_time.total_seconds() * 10 + self.lock_ttl))
+            await pipe.execute()
+
+    async def _collect_contributions(self):
+        if self.telemetry is None:
+            return
+        async with self.client.pipeline(transaction=True) as pipe:
+            pipe.lrange(self.contributions_key, 0, -1)
+            pipe.delete(self.contributions_key)
+            entries, _ = await pipe.execute()
+        for entry in entries:
+            self.telemetry.merge_state(json.loads(entry))
+
+    async def _tick(self):
+        if self._leading:
+            try:
+                await self._lock.reacquire()
+            except LockError:
+                # the lock ran out under us (long pause, redis failover), someone else may lead now
+                logger.warning(f"Worker {self.worker_id} lost the exporter lock")
+                await self._step_down()
+                return
+            self._renewed_at = time.monotonic()
+            await self._collect_contributions()
+        elif await self._lock.acquire():
+            await self._lead()
+        else:
+            await self._contribute()
+
+    async def run(self):
+        tick = min(self.heartbeat, self.setting.interval_time.total_seconds())
+        try:
+            while not self._stop_event.is_set():
+                try:
+                    await self._tick()
+                except redis.RedisError as err:
+                    logger.warning(f"Exporter coordination failed on {self.worker_id}: {err!r}")
+                    # a blip is fine, but the lock runs out a ttl after the last renewal and the
+                    # next check is a tick away, so a leader gives up one heartbeat early; later
+                    # another worker could be exporting next to it
+                    if self._leading and time.monotonic() - self._renewed_at >= self.lock_ttl - self.heartbeat:
+                        logger.warning(f"Worker {self.worker_id} could not renew the exporter lock in time")
+                        await self._step_down()
+                try:
+                    await asyncio.wait_for(self._stop_event.wait(), timeout=tick)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            if self._leading:
+                await self._step_down()
+                try:
+                    await self._lock.release()
+                except (LockError, redis.RedisError):
+                    pass
+            # the last partial interval goes to whoever leads next
+            try:
+                await self._contribute()
+            except redis.RedisError:
+                pass
+
+    async def stop(self):
+        self._stop_event.set()
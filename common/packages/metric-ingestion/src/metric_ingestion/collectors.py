@@ -0,0 +1,200 @@
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, List, Optional, Type
+
+import psutil
+from metric_ingestion_models import DeviceMetric
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+# A collector turns one psutil probe into metrics. Counters are turned into
+# rates against the previous call, so nothing ever sleeps to take a delta.
+# blocking=True collectors touch the filesystem and run on the executor.
+class Collector(object):
+    name: str = ""
+    blocking: bool = False
+
+    def collect(self, ts: float) -> List[DeviceMetric]:
+        raise NotImplementedError
+
+
+class CpuCollector(Collector):
+    name = "cpu_usage"
+
+    def __init__(self):
+        # the first non-blocking call only sets the reference point
+        psutil.cpu_percent(interval=None)
+
+    def collect(self, ts: float) -> List[DeviceMetric]:
+        return [DeviceMetric(name="cpu_usage", timestamp=ts, value=psutil.cpu_percent(interval=None))]
+
+
+class PerCoreCpuCollector(Collector):
+    name = "cpu_per_core"
+
+    def __init__(self):
+        psutil.cpu_percent(interval=None, percpu=True)
+
+    def collect(self, ts: float) -> List[DeviceMetric]:
+        return [DeviceMetric(name=f"cpu_core_{core}_usage", timestamp=ts, value=value)
+                for core, value in enumerate(psutil.cpu_percent(interval=None, percpu=True))]
+
+
+class MemoryCollector(Collector):
+    name = "ram_usage"
+
+    def collect(self, ts: float) -> List[DeviceMetric]:
+        return [DeviceMetric(name="ram_usage", timestamp=ts, value=psutil.virtual_memory().percent),
+                DeviceMetric(name="swap_usage", timestamp=ts, value=psutil.swap_memory().percent)]
+
+
+class DiskUsageCollector(Collector):
+    name = "disk_usage"
+    blocking = True
+
+    def __init__(self, path: str = "/"):
+        self.path = path
+
+    def collect(self, ts: float) -> List[DeviceMetric]:
+        return [DeviceMetric(name="disk_usage", timestamp=ts, value=psutil.disk_usage(self.path).percent)]
+
+
+class _RateCollector(Collector):
+    fields: Dict[str, str] = {}
+
+    def __init__(self):
+        self._previous = self._read()
+        self._previous_at = time.monotonic()
+
+    def _read(self):
+        raise NotImplementedError
+
+    def collect(self, ts: float) -> List[DeviceMetric]:
+        current, now = self._read(), time.monotonic()
+        previous, elapsed = self._previous, now - self._previous_at
+        self._previous, self._previous_at = current, now
+        if current is None or previous is None or elapsed <= 0:
+            return []
+        # counters may reset (interface down, nic swap), never report a negative rate
+        return [DeviceMetric(name=metric, timestamp=ts, value=max(getattr(current, field) - getattr(previous, field), 0) / elapsed)
+                for field, metric in self.fields.items()]
+
+
+class DiskIOCollector(_RateCollector):
+    name = "disk_io"
+    blocking = True
+    fields = {"read_bytes": "disk_read_bytes_per_sec", "write_bytes": "disk_write_bytes_per_sec"}
+
+    def _read(self):
+        return psutil.disk_io_counters()
+
+
+class NetworkCollector(_RateCollector):
+    name = "network"
+    fields = {"bytes_sent": "net_sent_bytes_per_sec", "bytes_recv": "net_recv_bytes_per_sec"}
+
+    def _read(self):
+        return psutil.net_io_counters()
+
+
+COLLECTORS: Dict[str, Type[Collector]] = {}
+
+
+def register_collector(collector: Type[Collector]) -> Type[Collector]:
+    COLLECTORS[collector.name] = collector
+    return collector
+
+
+for _collector in (CpuCollector, PerCoreCpuCollector, MemoryCollector, DiskUsageCollector, DiskIOCollector, NetworkCollector):
+    register_collector(_collector)
+
+DEFAULT_METRICS = frozenset({"cpu_usage", "ram_usage"})
+
+
+class CollectorTiming(object):
+    def __init__(self):
+        self.count: int = 0
+        self.failures: int = 0
+        self.total: float = 0.0
+        self.last: float = 0.0
+        self.max: float = 0.0
+
+    def record(self, elapsed: float):
+        self.count += 1
+        self.total += elapsed
+        self.last = elapsed
+        self.max = max(self.max, elapsed)
+
+    @property
+    def mean(self) -> float:
+        return self.total / self.count if self.count else 0.0
+
+
+# Runs the selected collectors once per sample. Non-blocking ones run inline,
+# they are a few /proc reads; the rest share one worker thread so the host
+# service's default executor is never competed for.
+class CollectorSet(object):
+    def __init__(self, names: Optional[Iterable[str]] = None, collectors: Optional[Iterable[Collector]] = None):
+        # given instances replace the default probes, the names add to them
+        if collectors is None:
+            names = sorted(set(names) if names else DEFAULT_METRICS)
+        else:
+            names = sorted(set(names or ()))
+        unknown = [name for name in names if name not in COLLECTORS]
+        if unknown:
+            raise ValueError(f"Unknown metrics {unknown}, available: {sorted(COLLECTORS)}")
+
+        self.collectors: List[Collector] = [COLLECTORS[name]() for name in names]
+        self.timings: Dict[str, CollectorTiming] = {collector.name: CollectorTiming() for collector in self.collectors}
+        self._executor: Optional[ThreadPoolExecutor] = None
+        for collector in collectors or ():
+            self.add(collector)
+
+    def add(self, collector: Collector):
+        # an instance the host service owns and feeds, e.g. request telemetry
+        if collector.name in self.timings:
+            raise ValueError(f"Collector {collector.name} already added")
+        self.collectors.append(collector)
+        self.timings[collector.name] = CollectorTiming()
+
+    def _run(self, collector: Collector, ts: float) -> List[DeviceMetric]:
+        timing = self.timings[collector.name]
+        start = time.perf_counter()
+        try:
+            return collector.collect(ts)
+        except Exception as err:
+            timing.failures += 1
+            logger.warning(f"Collector {collector.name} failed: {err!r}")
+            return []
+        finally:
+            timing.record(time.perf_counter() - start)
+
+    def _run_blocking(self, collectors: List[Collector], ts: float) -> List[DeviceMetric]:
+        metrics: List[DeviceMetric] = []
+        for collector in collectors:
+            metrics.extend(self._run(collector, ts))
+        return metrics
+
+    async def collect(self, ts: float) -> List[DeviceMetric]:
+        metrics: List[DeviceMetric] = []
+        blocking: List[Collector] = []
+        for collector in self.collectors:
+            if collector.blocking:
+                blocking.append(collector)
+            else:
+                metrics.extend(self._run(collector, ts))
+
+        if blocking:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="metric-collector")
+            metrics.extend(await asyncio.get_running_loop().run_in_executor(self._executor, self._run_blocking, blocking, ts))
+        return metrics
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
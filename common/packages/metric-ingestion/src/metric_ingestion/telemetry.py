@@ -0,0 +1,165 @@
+import time
+from bisect import bisect_left
+from typing import Dict, List, Optional, Tuple
+
+from metric_ingestion_models import DeviceMetric
+from metric_ingestion.collectors import Collector
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+UNMATCHED_ROUTE = "<unmatched>"
+
+
+def _latency_bounds(lowest: float, highest: float, steps_per_doubling: int) -> List[float]:
+    # log-linear like an HDR histogram, every bucket is the same relative width
+    factor = 2 ** (1 / steps_per_doubling)
+    bounds = [lowest]
+    while bounds[-1] < highest:
+        bounds.append(bounds[-1] * factor)
+    return bounds
+
+
+# 50us to ~100s in 2^(1/4) steps, 19% wide buckets, 85 of them
+LATENCY_BOUNDS: List[float] = _latency_bounds(50e-6, 100.0, 4)
+
+
+# Fixed bucket latency histogram. Recording is a bisect and an increment; the
+# quantiles come back as bucket upper bounds, so within one bucket width.
+class LatencyHistogram(object):
+    __slots__ = ("counts", "count", "total", "max")
+
+    def __init__(self):
+        # the extra slot catches everything over the last bound
+        self.counts: List[int] = [0] * (len(LATENCY_BOUNDS) + 1)
+        self.count: int = 0
+        self.total: float = 0.0
+        self.max: float = 0.0
+
+    def record(self, seconds: float):
+        self.counts[bisect_left(LATENCY_BOUNDS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def merge(self, counts: Dict[int, int], total: float, max_seconds: float):
+        for index, bucket in counts.items():
+            self.counts[index] += bucket
+            self.count += bucket
+        self.total += total
+        self.max = max(self.max, max_seconds)
+
+    def quantile(self, q: float) -> float:
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for index, bucket in enumerate(self.counts):
+            seen += bucket
+            if seen >= rank:
+                return min(LATENCY_BOUNDS[index], self.max) if index < len(LATENCY_BOUNDS) else self.max
+        return self.max
+
+
+class RouteStats(object):
+    __slots__ = ("requests", "errors", "client_errors", "latency")
+
+    def __init__(self):
+        self.requests: int = 0
+        self.errors: int = 0
+        self.client_errors: int = 0
+        self.latency = LatencyHistogram()
+
+
+# Per route request counts, errors and latency of this worker process. Every
+# update happens on the event loop, so plain counters are enough, no locks.
+# collect() swaps the table for a fresh one and turns the old one into
+# metrics, so each sample covers exactly the requests since the previous one.
+class RequestTelemetry(Collector):
+    name = "http_requests"
+
+    def __init__(self, quantiles: Tuple[float, ...] = (0.5, 0.95, 0.99)):
+        self.quantiles = quantiles
+        self._routes: Dict[Tuple[str, str], RouteStats] = {}
+        self._since = time.monotonic()
+
+    def record(self, method: str, route: str, status: int, seconds: float):
+        stats = self._routes.get((method, route))
+        if stats is None:
+            stats = self._routes[(method, route)] = RouteStats()
+        stats.requests += 1
+        if status >= 500:
+            stats.errors += 1
+        elif status >= 400:
+            stats.client_errors += 1
+        stats.latency.record(seconds)
+
+    def take_state(self) -> Dict[str, list]:
+        # what this worker saw since the last call, in a form another process can merge
+        routes, self._routes = self._routes, {}
+        return {"routes": [[method, route, stats.requests, stats.errors, stats.client_errors,
+                            stats.latency.total, stats.latency.max,
+                            {index: bucket for index, bucket in enumerate(stats.latency.counts) if bucket}]
+                           for (method, route), stats in routes.items()]}
+
+    def merge_state(self, state: Dict[str, list]):
+        for method, route, requests, errors, client_errors, total, max_seconds, counts in state.get("routes", []):
+            stats = self._routes.get((method, route))
+            if stats is None:
+                stats = self._routes[(method, route)] = RouteStats()
+            stats.requests += requests
+            stats.errors += errors
+            stats.client_errors += client_errors
+            # json turned the bucket indexes into strings
+            stats.latency.merge({int(index): bucket for index, bucket in counts.items()}, total, max_seconds)
+
+    def collect(self, ts: float) -> List[DeviceMetric]:
+        routes, self._routes = self._routes, {}
+        now = time.monotonic()
+        elapsed, self._since = now - self._since, now
+
+        metrics: List[DeviceMetric] = []
+        for (method, route), stats in routes.items():
+            label = f"{method} {route}"
+            metrics.append(DeviceMetric(name=f"http_requests:{label}", timestamp=ts, value=stats.requests))
+            metrics.append(DeviceMetric(name=f"http_errors:{label}", timestamp=ts, value=stats.errors))
+            metrics.append(DeviceMetric(name=f"http_client_errors:{label}", timestamp=ts, value=stats.client_errors))
+            if elapsed > 0:
+                metrics.append(DeviceMetric(name=f"http_requests_per_sec:{label}", timestamp=ts, value=stats.requests / elapsed))
+            for q in self.quantiles:
+                metrics.append(DeviceMetric(name=f"http_latency_p{q * 100:g}_ms:{label}", timestamp=ts,
+                                            value=stats.latency.quantile(q) * 1000))
+            metrics.append(DeviceMetric(name=f"http_latency_max_ms:{label}", timestamp=ts, value=stats.latency.max * 1000))
+        return metrics
+
+
+# Plain ASGI middleware, app.add_middleware(TelemetryMiddleware, telemetry=...).
+# Requests are keyed by the route template ("/get/{package_id}"), not the raw
+# path, so ids in urls can't blow up the number of series.
+class TelemetryMiddleware(object):
+    def __init__(self, app, telemetry: RequestTelemetry):
+        self.app = app
+        self.telemetry = telemetry
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        status = 500
+        start = time.perf_counter()
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            # the router fills in scope["route"] on the way down
+            route: Optional[str] = getattr(scope.get("route"), "path", None)
+            self.telemetry.record(scope["method"], route or UNMATCHED_ROUTE, status, time.perf_counter() - start)
@@ -0,0 +1,70 @@
+import pytest
+
+from metric_ingestion.buffer import RingBuffer, SpillFile
+
+
+def test_ring_buffer_evicts_the_oldest():
+    buffer = RingBuffer(capacity=3)
+    evicted = []
+    for record in (b"a", b"bb", b"ccc", b"dddd", b"e"):
+        evicted.extend(buffer.append(record))
+    assert evicted == [b"a", b"bb"]
+    assert len(buffer) == 3 and buffer.size == 8
+
+
+def test_ring_buffer_take_respects_limits():
+    buffer = RingBuffer()
+    for record in (b"x" * 10, b"y" * 10, b"z" * 10, b"w"):
+        buffer.append(record)
+    assert buffer.take(max_records=10, max_bytes=25) == [b"x" * 10, b"y" * 10]
+    assert buffer.take(max_records=1, max_bytes=100) == [b"z" * 10]
+    assert buffer.take(max_records=10, max_bytes=100) == [b"w"]
+    assert len(buffer) == 0 and buffer.size == 0 and buffer.oldest_age() == 0.0
+
+
+def test_ring_buffer_hands_out_an_oversized_record():
+    buffer = RingBuffer()
+    buffer.append(b"x" * 100)
+    assert buffer.take(max_records=10, max_bytes=10) == [b"x" * 100]
+
+
+def test_ring_buffer_needs_a_capacity():
+    with pytest.raises(ValueError):
+        RingBuffer(capacity=0)
+
+
+def test_spill_file_replays_in_order(tmp_path):
+    spill = SpillFile(str(tmp_path / "spill" / "records.bin"))
+    spill.write([b"one", b"two\n", b"\x00three"])
+    spill.write([b"four"])
+
+    records, cursor = spill.read(max_records=2, max_bytes=1 << 20)
+    assert records == [b"one", b"two\n"]
+    # not committed, the next read starts over
+    assert spill.read(max_records=2, max_bytes=1 << 20)[0] == records
+    spill.commit(cursor)
+
+    records, cursor = spill.read(max_records=10, max_bytes=1 << 20)
+    assert records == [b"\x00three", b"four"]
+    spill.commit(cursor)
+    assert spill.pending_bytes() == 0
+    assert not (tmp_path / "spill" / "records.bin").exists()
+
+
+def test_spill_file_drops_past_its_limit(tmp_path):
+    spill = SpillFile(str(tmp_path / "records.bin"), max_bytes=20)
+    spill.write([b"x" * 8, b"y" * 8, b"z" * 4])
+    assert spill.dropped == 1
+    assert spill.read(max_records=10, max_bytes=1 << 20)[0] == [b"x" * 8, b"z" * 4]
+
+
+def test_spill_file_discards_a_torn_record(tmp_path):
+    path = tmp_path / "records.bin"
+    spill = SpillFile(str(path))
+    spill.write([b"whole", b"torn record"])
+    path.write_bytes(path.read_bytes()[:-3])
+
+    records, cursor = spill.read(max_records=10, max_bytes=1 << 20)
+    assert records == [b"whole"]
+    spill.commit(cursor)
+    assert spill.pending_bytes() == 0
@@ -0,0 +1,114 @@
+import asyncio
+from datetime import timedelta
+
+import httpx
+
+from metric_ingestion.client import MetricIngestionClient, IngestionSettings
+
+
+def settings(**overrides) -> IngestionSettings:
+    values = dict(device_id="dev", interval_time=timedelta(seconds=0.01), batch_max_delay=timedelta(seconds=0.02),
+                  max_retries=0, compression=None)
+    values.update(overrides)
+    return IngestionSettings(**values)
+
+
+def test_outage_spills_and_recovery_replays(tmp_path):
+    async def scenario():
+        path = str(tmp_path / "spill.bin")
+        up = False
+        delivered = []
+
+        def handler(request: httpx.Request) -> httpx.Response:
+            if not up:
+                return httpx.Response(503)
+            delivered.extend(request.content.splitlines())
+            return httpx.Response(200, json={"status": "success"})
+
+        down = MetricIngestionClient(settings(spill_path=path, buffer_capacity=3, sending_limit=10),
+                                     transport=httpx.MockTransport(handler))
+        await down.start_expose()
+        assert down.sent == 0 and down.spill.pending_bytes() > 0
+
+        up = True
+        back = MetricIngestionClient(settings(spill_path=path, sending_limit=1), transport=httpx.MockTransport(handler))
+        await back.start_expose()
+        # the ten records of the outage plus the new one, nothing lost and the file gone
+        assert len(delivered) == 11
+        assert back.spill.pending_bytes() == 0
+
+    asyncio.run(scenario())
+
+
+def test_without_a_spill_file_overflow_is_dropped():
+    async def scenario():
+        client = MetricIngestionClient(settings(buffer_capacity=2, sending_limit=5),
+                                       transport=httpx.MockTransport(lambda request: httpx.Response(503)))
+        await client.start_expose()
+        assert client.sent == 0 and client.dropped == 5
+
+    asyncio.run(scenario())
+
+
+def test_cancel_stops_the_sampler():
+    async def scenario():
+        client = MetricIngestionClient(settings(), transport=httpx.MockTransport(
+            lambda request: httpx.Response(200, json={"status": "success"})))
+        task = asyncio.create_task(client.start_expose())
+        await asyncio.sleep(0.1)
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+        assert asyncio.all_tasks() == {asyncio.current_task()}
+        assert len(client.buffer) == 0
+
+    asyncio.run(scenario())
+
+
+def test_a_partial_failure_resends_only_the_tail():
+    async def scenario():
+        bodies = []
+
+        def handler(request: httpx.Request) -> httpx.Response:
+            bodies.append(request.content.splitlines())
+            if len(bodies) == 1:
+                # the first two records went out before the broker failed
+                return httpx.Response(503, json={"status": "error", "offset": 2})
+            return httpx.Response(200, json={"status": "success"})
+
+        client = MetricIngestionClient(settings(max_retries=1, backoff_base=0.01),
+                                       transport=httpx.MockTransport(handler))
+        for value in range(5):
+            client.buffer.append(b"record-%d\n" % value)
+        async with httpx.AsyncClient(transport=client.transport) as http:
+            client._client = http
+            assert await client.flush(force=True)
+        assert bodies[1] == bodies[0][2:]
+        assert client.sent == 5
+
+    asyncio.run(scenario())
+
+
+def test_a_partial_replay_commits_the_delivered_head(tmp_path):
+    async def scenario():
+        path = str(tmp_path / "spill.bin")
+        bodies = []
+
+        def handler(request: httpx.Request) -> httpx.Response:
+            bodies.append(request.content.splitlines())
+            if len(bodies) == 1:
+                return httpx.Response(503, json={"status": "error", "offset": 3})
+            return httpx.Response(200, json={"status": "success"})
+
+        client = MetricIngestionClient(settings(spill_path=path), transport=httpx.MockTransport(handler))
+        client.spill.write([b"record-%d\n" % value for value in range(5)])
+        async with httpx.AsyncClient(transport=client.transport) as http:
+            client._client = http
+            assert not await client.flush()
+            assert await client.flush()
+        assert bodies[1] == bodies[0][3:]
+        assert client.sent == 5 and client.spill.pending_bytes() == 0
+
+    asyncio.run(scenario())
@@ -0,0 +1,96 @@
+import asyncio
+from datetime import timedelta
+
+import fakeredis
+
+from metric_ingestion import cluster
+from metric_ingestion.client import IngestionSettings
+from metric_ingestion.cluster import MultiWorkerExporter
+from metric_ingestion.telemetry import RequestTelemetry
+
+
+class FakeClient(object):
+    # stands in for the ingestion client the leader runs, nothing goes over the wire
+    def __init__(self, setting):
+        self.collectors = []
+        self.running = False
+        self._stop = asyncio.Event()
+
+    def add_collector(self, collector):
+        self.collectors.append(collector)
+
+    async def start_expose(self):
+        self.running = True
+        await self._stop.wait()
+        self.running = False
+
+    async def stop_expose(self):
+        self._stop.set()
+
+
+def workers(monkeypatch, count: int, lock_ttl: float = 30.0):
+    monkeypatch.setattr(cluster, "MetricIngestionClient", FakeClient)
+    server = fakeredis.FakeServer()
+    setting = IngestionSettings(device_id="host", interval_time=timedelta(seconds=0.05))
+    return [MultiWorkerExporter(setting, fakeredis.FakeAsyncRedis(server=server), telemetry=RequestTelemetry(),
+                                lock_ttl=lock_ttl)
+            for _ in range(count)]
+
+
+def test_one_worker_leads_and_the_others_contribute(monkeypatch):
+    async def scenario():
+        leader, follower = workers(monkeypatch, 2)
+        await leader._tick()
+        await follower._tick()
+        assert leader.is_leader and not follower.is_leader
+        assert leader._exporter.collectors == [leader.telemetry]
+
+        follower.telemetry.record("GET", "/get/{id}", 200, 0.01)
+        follower.telemetry.record("GET", "/get/{id}", 500, 0.02)
+        await follower._tick()
+        await leader._tick()
+        routes = leader.telemetry.take_state()["routes"]
+        assert [(method, route, requests, errors) for method, route, requests, errors, *_ in routes] == \
+            [("GET", "/get/{id}", 2, 1)]
+
+        await leader._step_down()
+
+    asyncio.run(scenario())
+
+
+def test_a_stopped_leader_hands_over_at_once(monkeypatch):
+    async def scenario():
+        leader, follower = workers(monkeypatch, 2)
+        running = asyncio.create_task(leader.run())
+        await asyncio.sleep(0.01)
+        assert leader.is_leader
+        exporter = leader._exporter
+
+        await leader.stop()
+        await running
+        assert not leader.is_leader and not exporter.running
+        # the lock was released on the way out, no ttl to wait for
+        await follower._tick()
+        assert follower.is_leader
+        await follower._step_down()
+
+    asyncio.run(scenario())
+
+
+def test_a_dead_leader_is_replaced_once_its_lock_runs_out(monkeypatch):
+    async def scenario():
+        leader, follower = workers(monkeypatch, 2, lock_ttl=0.2)
+        await leader._tick()
+        # the leader stops renewing, as if its process was killed
+        await follower._tick()
+        assert not follower.is_leader
+        await asyncio.sleep(0.25)
+        await follower._tick()
+        assert follower.is_leader
+
+        # the old leader finds out on its next renewal and steps down
+        await leader._tick()
+        assert not leader.is_leader and leader._exporter is None
+        await follower._step_down()
+
+    asyncio.run(scenario())
@@ -0,0 +1,59 @@
+import base64
+import json
+from typing import Any, Dict, List, Sequence, Type, TypeVar
+
+from fastapi import HTTPException, Request
+from pydantic import BaseModel, TypeAdapter, ValidationError
+from sqlalchemy import Table
+from sqlalchemy.dialects import postgresql, sqlite
+
+NDJSON_CONTENT_TYPE = "application/x-ndjson"
+
+TModel = TypeVar("TModel", bound=BaseModel)
+
+
+# Reads a bulk request body, either a JSON array or NDJSON (one object per line).
+# Errors are reported with the index of the offending item, nothing is half applied.
+async def read_items(request: Request, model: Type[TModel], max_items: int = 10_000) -> List[TModel]:
+    body = await request.body()
+    media_type = request.headers.get("content-type", "").split(";")[0].strip().lower()
+
+    try:
+        if media_type == NDJSON_CONTENT_TYPE:
+            validate = model.model_validate_json
+            items = [validate(line) for line in body.splitlines() if line.strip()]
+        else:
+            items = TypeAdapter(List[model]).validate_json(body)
+    except ValidationError as err:
+        raise HTTPException(status_code=422, detail=json.loads(err.json(include_url=False)))
+
+    if len(items) > max_items:
+        raise HTTPException(status_code=413, detail=f"At most {max_items} items per request")
+    return items
+
+
+# Opaque keyset cursor, the sort key values of the last row handed out.
+def encode_cursor(values: Sequence[Any]) -> str:
+    return base64.urlsafe_b64encode(json.dumps([str(value) for value in values]).encode()).decode()
+
+
+def decode_cursor(cursor: str) -> List[str]:
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Malformed cursor")
+    if not isinstance(values, list):
+        raise HTTPException(status_code=400, detail="Malformed cursor")
+    return values
+
+
+# INSERT ... ON CONFLICT (keys) DO UPDATE for the dialects we run on.
+def upsert_statement(table: Table, dialect: str, keys: Sequence[str], columns: Sequence[str]):
+    if dialect == "postgresql":
+        insert = postgresql.insert(table)
+    elif dialect == "sqlite":
+        insert = sqlite.insert(table)
+    else:
+        raise NotImplementedError(f"Upsert is not supported on {dialect}")
+    update: Dict[str, Any] = {column: insert.excluded[column] for column in columns if column not in keys}
+    return insert.on_conflict_do_update(index_elements=list(keys), set_=update)
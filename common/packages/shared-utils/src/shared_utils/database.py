@@ -0,0 +1,117 @@
+from typing import AsyncGenerator, Dict, Optional
+
+from pydantic import Field
+from pydantic_settings import BaseSettings
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, async_sessionmaker, create_async_engine
+from sqlalchemy.pool import QueuePool
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class DatabaseSettings(BaseSettings):
+    DATABASE_URL: str = Field(default="sqlite+aiosqlite:///database.db")
+    DB_ECHO: bool = Field(default=False)
+    DB_POOL_SIZE: int = Field(default=5, gt=0)
+    DB_MAX_OVERFLOW: int = Field(default=10, ge=0)
+    DB_POOL_TIMEOUT: float = Field(default=30, gt=0)
+    DB_POOL_RECYCLE: int = Field(default=1800, description="seconds, -1 never recycles")
+    DB_POOL_PRE_PING: bool = Field(default=True)
+    # compiled statements kept by sqlalchemy, per engine
+    DB_QUERY_CACHE_SIZE: int = Field(default=500, ge=0)
+    # prepared statements kept by asyncpg, per connection
+    DB_STATEMENT_CACHE_SIZE: int = Field(default=100, ge=0)
+    DB_SQLITE_WAL: bool = Field(default=True)
+    DB_SQLITE_BUSY_TIMEOUT_MS: int = Field(default=5000, ge=0)
+
+    class Config:
+        env_file = ".env"
+        env_file_encoding = "utf-8"
+        extra = "ignore"
+
+
+def _enable_sqlite_wal(engine: AsyncEngine, busy_timeout_ms: int):
+    # WAL lets readers run next to the single writer, every worker opens its own connections
+    @event.listens_for(engine.sync_engine, "connect")
+    def _on_connect(dbapi_connection, _):
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.execute(f"PRAGMA busy_timeout={busy_timeout_ms}")
+        cursor.close()
+
+
+def build_engine(settings: DatabaseSettings) -> AsyncEngine:
+    url = make_url(settings.DATABASE_URL)
+    options = {"echo": settings.DB_ECHO, "query_cache_size": settings.DB_QUERY_CACHE_SIZE}
+    connect_args = {}
+
+    if url.get_backend_name() == "sqlite":
+        connect_args["check_same_thread"] = False
+        in_memory = url.database in (None, "", ":memory:")
+    else:
+        in_memory = False
+        if url.get_driver_name() == "asyncpg":
+            connect_args["prepared_statement_cache_size"] = settings.DB_STATEMENT_CACHE_SIZE
+
+    # an in memory sqlite lives in one connection, sqlalchemy picks a static pool for it
+    if not in_memory:
+        options.update(pool_size=settings.DB_POOL_SIZE,
+                       max_overflow=settings.DB_MAX_OVERFLOW,
+                       pool_timeout=settings.DB_POOL_TIMEOUT,
+                       pool_recycle=settings.DB_POOL_RECYCLE,
+                       pool_pre_ping=settings.DB_POOL_PRE_PING)
+
+    engine = create_async_engine(url, connect_args=connect_args, **options)
+    if url.get_backend_name() == "sqlite" and settings.DB_SQLITE_WAL and not in_memory:
+        _enable_sqlite_wal(engine, settings.DB_SQLITE_BUSY_TIMEOUT_MS)
+    return engine
+
+
+# One engine and one session factory per process. Nothing connects until the
+# first query, so importing this before uvicorn forks its workers is safe.
+class Database(object):
+    def __init__(self, settings: Optional[DatabaseSettings] = None):
+        self.settings = settings or DatabaseSettings()
+        self.engine = build_engine(self.settings)
+        self.sessionmaker = async_sessionmaker(bind=self.engine, class_=AsyncSession, expire_on_commit=False)
+
+    @property
+    def dialect(self) -> str:
+        return self.engine.dialect.name
+
+    async def get_session(self) -> AsyncGenerator[AsyncSession, None]:
+        async with self.sessionmaker() as session:
+            yield session
+
+    def pool_stats(self) -> Dict[str, object]:
+        pool = self.engine.pool
+        if not isinstance(pool, QueuePool):
+            return {"pool": type(pool).__name__, "status": pool.status()}
+        capacity = pool.size() + self.settings.DB_MAX_OVERFLOW
+        return {
+            "pool": type(pool).__name__,
+            "size": pool.size(),
+            "max_overflow": self.settings.DB_MAX_OVERFLOW,
+            "checked_in": pool.checkedin(),
+            "checked_out": pool.checkedout(),
+            "overflow": max(pool.overflow(), 0),
+            "utilization": round(pool.checkedout() / capacity, 4) if capacity else 0.0,
+        }
+
+    async def dispose(self):
+        await self.engine.dispose()
+
+
+_database: Optional[Database] = None
+
+
+def get_database(settings: Optional[DatabaseSettings] = None) -> Database:
+    global _database
+    if _database is None:
+        _database = Database(settings)
+        logger.info(f"Database engine for {_database.engine.url!r} ({_database.dialect})")
+    return _database
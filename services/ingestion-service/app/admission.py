@@ -0,0 +1,90 @@
+import random
+from typing import Callable, Dict, Optional
+
+
+# Admission control for uploads, per worker process. An upload needs a slot
+# of the worker budget and one of its device's, and is turned away at once
+# with a Retry-After when either is gone or the broker blocked publishing,
+# before a byte of its body is read. One device can't take the whole budget,
+# so the devices that behave keep their latency while a storm is refused.
+#
+# Pressure is how full the worker is, the in-flight uploads against the
+# budget or the publish latency against its target, whichever is worse. Under
+# quiet_pressure no interval is suggested and clients keep their own cadence;
+# past it the suggested send interval stretches from base_interval up to
+# max_interval (saturated), so clients back off before they are refused.
+class AdmissionController(object):
+    def __init__(self,
+                 max_in_flight: int = 256,
+                 max_per_device: int = 2,
+                 base_interval: float = 30.0,
+                 max_interval: float = 300.0,
+                 target_publish_latency: float = 0.25,
+                 quiet_pressure: float = 0.25,
+                 is_blocked: Optional[Callable[[], bool]] = None):
+        self.max_in_flight = max_in_flight
+        self.max_per_device = max_per_device
+        self.base_interval = base_interval
+        self.max_interval = max_interval
+        self.target_publish_latency = target_publish_latency
+        self.quiet_pressure = quiet_pressure
+        self.is_blocked = is_blocked or (lambda: False)
+
+        self.in_flight: int = 0
+        self.admitted: int = 0
+        self.refused: int = 0
+        self.publish_latency: float = 0.0
+        self._devices: Dict[str, int] = {}
+
+    def pressure(self) -> float:
+        if self.is_blocked():
+            return 1.0
+        return min(max(self.in_flight / self.max_in_flight,
+                       self.publish_latency / self.target_publish_latency), 1.0)
+
+    def _stretched(self, pressure: float) -> float:
+        # quadratic past the quiet level, a half full worker barely moves clients, a nearly full one moves them a lot
+        load = max(pressure - self.quiet_pressure, 0.0) / max(1.0 - self.quiet_pressure, 1e-9)
+        return self.base_interval + (self.max_interval - self.base_interval) * min(load, 1.0) ** 2
+
+    def suggested_interval(self) -> Optional[float]:
+        pressure = self.pressure()
+        if pressure < self.quiet_pressure:
+            return None
+        return self._stretched(pressure)
+
+    def retry_after(self) -> int:
+        # jittered, refused clients shouldn't all come back in the same second
+        return max(1, round(self._stretched(self.pressure()) * random.uniform(0.5, 1.0)))
+
+    def try_admit(self, device_id: Optional[str]) -> bool:
+        if self.in_flight >= self.max_in_flight or self.is_blocked() \
+                or (device_id is not None and self._devices.get(device_id, 0) >= self.max_per_device):
+            self.refused += 1
+            return False
+        self.in_flight += 1
+        self.admitted += 1
+        if device_id is not None:
+            self._devices[device_id] = self._devices.get(device_id, 0) + 1
+        return True
+
+    def release(self, device_id: Optional[str]):
+        self.in_flight -= 1
+        if device_id is not None:
+            remaining = self._devices.get(device_id, 1) - 1
+            if remaining:
+                self._devices[device_id] = remaining
+            else:
+                self._devices.pop(device_id, None)
+
+    def record_publish(self, seconds: float, alpha: float = 0.2):
+        self.publish_latency += alpha * (seconds - self.publish_latency)
+
+    def stats(self) -> Dict[str, float]:
+        return {"in_flight": self.in_flight,
+                "admitted": self.admitted,
+                "refused": self.refused,
+                "devices_in_flight": len(self._devices),
+                "publish_latency": self.publish_latency,
+                "pressure": self.pressure(),
+                "suggested_interval": self.suggested_interval()}
@@ -0,0 +1,94 @@
+import asyncio
+import time
+from typing import Callable, List, Optional
+
+from app.publisher import MetricPublisher
+from app.metrics import PUBLISH_SECONDS, PUBLISH_BATCH_RECORDS
+
+
+# Collects validated records of one upload and hands them to the publisher
+# once the batch is big enough or its oldest record waited max_delay seconds.
+# Once a publish failed nothing more is published, so the published records
+# are always the first `published` ones added.
+class RecordBatcher(object):
+    def __init__(self,
+                 publisher: MetricPublisher,
+                 max_records: int = 500,
+                 max_bytes: int = 1 << 20,
+                 max_delay: float = 0.2,
+                 content_type: str = "application/json",
+                 on_publish: Optional[Callable[[float], None]] = None):
+        self.publisher = publisher
+        self.max_records = max_records
+        self.max_bytes = max_bytes
+        self.max_delay = max_delay
+        self.content_type = content_type
+        self.on_publish = on_publish
+        self.published: int = 0
+
+        self._records: List[bytes] = []
+        self._routing_keys: List[str] = []
+        self._size: int = 0
+        self._first_at: float = 0.0
+        self._lock = asyncio.Lock()
+        self._timer: Optional[asyncio.Task] = None
+        self._error: Optional[BaseException] = None
+
+    async def __aenter__(self):
+        self._timer = asyncio.create_task(self._flush_due())
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self._timer.cancel()
+        try:
+            await self._timer
+        except asyncio.CancelledError:
+            pass
+
+        if exc_type is None:
+            await self.flush()
+
+    async def add(self, record: bytes, routing_key: str):
+        if self._error is not None:
+            raise self._error
+        if not self._records:
+            self._first_at = time.monotonic()
+        self._records.append(record)
+        self._routing_keys.append(routing_key)
+        self._size += len(record)
+
+        if len(self._records) >= self.max_records or self._size >= self.max_bytes:
+            await self.flush()
+
+    async def flush(self):
+        async with self._lock:
+            if self._error is not None:
+                raise self._error
+            if not self._records:
+                return
+            records, self._records, self._size = self._records, [], 0
+            routing_keys, self._routing_keys = self._routing_keys, []
+            started = time.monotonic()
+            try:
+                await self.publisher.publish_batch(records, routing_keys, content_type=self.content_type)
+            except Exception as err:
+                # also when the timer flushed, the upload finds out on its next add or on exit
+                self._error = err
+                raise
+            elapsed = time.monotonic() - started
+            PUBLISH_SECONDS.observe(elapsed)
+            PUBLISH_BATCH_RECORDS.observe(len(records))
+            if self.on_publish is not None:
+                self.on_publish(elapsed)
+            self.published += len(records)
+
+    async def _flush_due(self):
+        # long lived uploads may trickle a record every few seconds,
+        # so the age bound needs its own timer
+        while True:
+            await asyncio.sleep(self.max_delay)
+            if self._records and time.monotonic() - self._first_at >= self.max_delay:
+                try:
+                    await self.flush()
+                except Exception:
+                    return
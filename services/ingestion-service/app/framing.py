@@ -0,0 +1,133 @@
+import zlib
+from typing import Iterator, List
+
+from metric_ingestion_models import CodecError
+
+
+# Splits a newline delimited byte stream into records as chunks arrive,
+# only the trailing partial record is ever kept in memory. positions holds,
+# per record handed out, its place in the body counting the skipped oversized
+# ones, blank lines aside.
+class NDJSONFramer(object):
+    def __init__(self, max_record_size: int = 1 << 20):
+        self.max_record_size = max_record_size
+        self.oversized: int = 0
+        self.framed: int = 0
+        self.positions: List[int] = []
+
+        self._buffer = bytearray()
+        self._scanned: int = 0
+        self._discarding: bool = False
+
+    def feed(self, chunk: bytes) -> List[bytes]:
+        records: List[bytes] = []
+        buffer = self._buffer
+        buffer += chunk
+
+        start = 0
+        end = buffer.find(b"\n", self._scanned)
+        while end != -1:
+            self._emit(buffer, start, end, records)
+            start = end + 1
+            end = buffer.find(b"\n", start)
+
+        del buffer[:start]
+        self._scanned = len(buffer)
+
+        if self._scanned > self.max_record_size:
+            # the record can't be accepted anyway, drop what we have and skip to its newline
+            if not self._discarding:
+                self.oversized += 1
+            self._discarding = True
+            buffer.clear()
+            self._scanned = 0
+
+        return records
+
+    def close(self) -> List[bytes]:
+        records: List[bytes] = []
+        if self._buffer:
+            self._emit(self._buffer, 0, len(self._buffer), records)
+            self._buffer.clear()
+            self._scanned = 0
+        return records
+
+    def _emit(self, buffer: bytearray, start: int, end: int, records: List[bytes]):
+        if self._discarding:
+            # the end of an oversized record, counted when it went over
+            self._discarding = False
+            self.framed += 1
+            return
+
+        record = bytes(buffer[start:end]).strip()
+        if not record:
+            return
+        self.framed += 1
+        if len(record) > self.max_record_size:
+            self.oversized += 1
+            return
+        self.positions.append(self.framed)
+        records.append(record)
+
+
+# Splits a stream of u32 length prefixed binary frames, see metric_ingestion_models.codec.
+class LengthPrefixedFramer(object):
+    HEADER_SIZE = 4
+
+    def __init__(self, max_record_size: int = 1 << 20):
+        self.max_record_size = max_record_size
+        self.oversized: int = 0
+        self.framed: int = 0
+        self.positions: List[int] = []
+
+        self._buffer = bytearray()
+
+    def feed(self, chunk: bytes) -> List[bytes]:
+        records: List[bytes] = []
+        buffer = self._buffer
+        buffer += chunk
+
+        start = 0
+        while len(buffer) - start >= self.HEADER_SIZE:
+            size = int.from_bytes(buffer[start:start + self.HEADER_SIZE], "little")
+            if size > self.max_record_size:
+                # without a delimiter there is no way to resync past a bad length
+                self.oversized += 1
+                raise CodecError(f"Frame of {size} bytes exceeds the {self.max_record_size} bytes limit")
+            end = start + self.HEADER_SIZE + size
+            if end > len(buffer):
+                break
+            records.append(bytes(buffer[start + self.HEADER_SIZE:end]))
+            self.framed += 1
+            self.positions.append(self.framed)
+            start = end
+
+        del buffer[:start]
+        return records
+
+    def close(self) -> List[bytes]:
+        if self._buffer:
+            self._buffer.clear()
+            raise CodecError("Stream ended inside a frame")
+        return []
+
+
+# Inflates a gzip request body as it arrives. Output comes out in pieces of at
+# most max_chunk bytes, so a small compressed body can't blow up in one call.
+class GzipDecoder(object):
+    def __init__(self, max_chunk: int = 1 << 16):
+        self.max_chunk = max_chunk
+        self._inflater = zlib.decompressobj(wbits=16 + zlib.MAX_WBITS)
+
+    def feed(self, chunk: bytes) -> Iterator[bytes]:
+        try:
+            data = self._inflater.decompress(chunk, self.max_chunk)
+            while data:
+                yield data
+                data = self._inflater.decompress(self._inflater.unconsumed_tail, self.max_chunk)
+        except zlib.error as err:
+            raise CodecError(f"Corrupt gzip body: {err}") from err
+
+    def close(self):
+        if not self._inflater.eof:
+            raise CodecError("Gzip body ended early")
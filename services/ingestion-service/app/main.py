@@ -1,26 +1,200 @@
-from fastapi import FastAPI, Request
-import pika
-import json
-from metric_ingestion_models import IngestionResponse
+from fastapi import FastAPI, Request, Response, Depends
+from fastapi.responses import JSONResponse
+from contextlib import asynccontextmanager
+from metric_ingestion_models import IngestionResponse, DeviceMetricGroup, CodecError, \
+    JSON_CONTENT_TYPE, NDJSON_CONTENT_TYPE, BINARY_CONTENT_TYPE
+from metric_ingestion_models.codec import decode_columns
+import logging
+import time
+from typing import List, Tuple
 
+from app.config import GlobalSetting
+from app.publisher import MetricPublisher
+from app.framing import NDJSONFramer, LengthPrefixedFramer, GzipDecoder
+from app.batching import RecordBatcher
+from app.admission import AdmissionController
+from app.metrics import UPLOADS, UPLOADS_REFUSED, UPLOADS_IN_FLIGHT, UPLOAD_SECONDS, CONTENT_TYPE_LATEST, \
+    count_records, exposition
+from event_exchange_rabbit_mq import ShardedTopology
 
+logger = logging.getLogger(__name__)
 
-app = FastAPI()
-def create_event_channel():
-    connection = pika.BlockingConnection(pika.ConnectionParameters(host="localhost"))
-    channel = connection.channel()
-    channel.exchange_declare(exchange="metrics", exchange_type="fanout")
+# set by MetricIngestionClient, lets the api hold a device to its share before reading the body
+DEVICE_ID_HEADER = "X-Device-Id"
 
-    return connection, channel 
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # on start up
+    topology = ShardedTopology(exchange_name=GlobalSetting.METRICS_EXCHANGE,
+                               queue_prefix=GlobalSetting.METRICS_QUEUE_PREFIX,
+                               shards=GlobalSetting.METRICS_SHARDS)
+    publisher = MetricPublisher(url=GlobalSetting.RABBITMQ_URL,
+                                topology=topology,
+                                pool_size=GlobalSetting.CHANNEL_POOL_SIZE,
+                                publish_timeout=GlobalSetting.PUBLISH_TIMEOUT,
+                                stall_after=GlobalSetting.PUBLISH_STALL_AFTER)
+    await publisher.start()
+    app.state.publisher = publisher
+    app.state.admission = AdmissionController(max_in_flight=GlobalSetting.ADMISSION_MAX_IN_FLIGHT,
+                                              max_per_device=GlobalSetting.ADMISSION_MAX_PER_DEVICE,
+                                              base_interval=GlobalSetting.SUGGESTED_INTERVAL_MIN,
+                                              max_interval=GlobalSetting.SUGGESTED_INTERVAL_MAX,
+                                              target_publish_latency=GlobalSetting.TARGET_PUBLISH_LATENCY,
+                                              quiet_pressure=GlobalSetting.SUGGESTED_INTERVAL_PRESSURE,
+                                              is_blocked=publisher.is_blocked)
+
+    yield
+    # on shutdown
+    await publisher.close()
+
+
+app = FastAPI(lifespan=lifespan, title="ingestion-api")
+
+
+def get_publisher(request: Request) -> MetricPublisher:
+    return request.app.state.publisher
+
+
+def get_admission(request: Request) -> AdmissionController:
+    return request.app.state.admission
+
+
+def prepare_json(record: bytes) -> Tuple[str, bytes]:
+    metric_group = DeviceMetricGroup.model_validate_json(record)
+    return metric_group.device_id, metric_group.model_dump_json().encode()
+
+
+def prepare_binary(record: bytes) -> Tuple[str, bytes]:
+    # a frame that decodes into its columns is valid, no models are built; it is
+    # forwarded untouched and the processor decodes it directly
+    return decode_columns(record)[0], record
+
+
+def negotiate_format(content_type: str):
+    media_type = content_type.split(";")[0].strip().lower()
+    if media_type == BINARY_CONTENT_TYPE:
+        return LengthPrefixedFramer(max_record_size=GlobalSetting.MAX_RECORD_SIZE), prepare_binary, BINARY_CONTENT_TYPE
+    if media_type in ("", NDJSON_CONTENT_TYPE, JSON_CONTENT_TYPE):
+        return NDJSONFramer(max_record_size=GlobalSetting.MAX_RECORD_SIZE), prepare_json, JSON_CONTENT_TYPE
+    return None
 
 
 @app.post("/ingest/metrics", response_model=IngestionResponse)
-async def ingest_data(request: Request):
-    connection, channel = create_event_channel()
-    counter = 0
-    async for chunk in request.stream():
-        channel.basic_publish(exchange='metrics', routing_key='metrics_queue', body=json.dumps(chunk))
-        counter += 1 
-        
-    connection.close()
-    return IngestionResponse(counter=counter)
\ No newline at end of file
+async def ingest_data(request: Request,
+                      publisher: MetricPublisher = Depends(get_publisher),
+                      admission: AdmissionController = Depends(get_admission)):
+    device_id = request.headers.get(DEVICE_ID_HEADER)
+    if not admission.try_admit(device_id):
+        UPLOADS_REFUSED.inc()
+        UPLOADS.labels("429").inc()
+        # refused before the body is read, a refusal costs next to nothing
+        response = IngestionResponse(status="error",
+                                     suggested_interval=admission.suggested_interval(),
+                                     msg="Ingestion is saturated, retry later")
+        return JSONResponse(status_code=429, content=response.model_dump(),
+                            headers={"Retry-After": str(admission.retry_after())})
+    started = time.perf_counter()
+    UPLOADS_IN_FLIGHT.inc()
+    try:
+        response = await receive_upload(request, publisher, admission)
+    finally:
+        UPLOADS_IN_FLIGHT.dec()
+        admission.release(device_id)
+    UPLOAD_SECONDS.observe(time.perf_counter() - started)
+    UPLOADS.labels(str(getattr(response, "status_code", 200))).inc()
+    return response
+
+
+@app.get("/metrics")
+async def metrics():
+    return Response(content=exposition(), media_type=CONTENT_TYPE_LATEST)
+
+
+@app.get("/admission/stats")
+async def admission_stats(admission: AdmissionController = Depends(get_admission)):
+    return admission.stats()
+
+
+async def receive_upload(request: Request, publisher: MetricPublisher, admission: AdmissionController):
+    negotiated = negotiate_format(request.headers.get("content-type", ""))
+    if negotiated is None:
+        response = IngestionResponse(status="error", msg=f"Unsupported content type, use {NDJSON_CONTENT_TYPE} or {BINARY_CONTENT_TYPE}")
+        return JSONResponse(status_code=415, content=response.model_dump())
+
+    content_encoding = request.headers.get("content-encoding", "identity").strip().lower()
+    if content_encoding not in ("identity", "gzip"):
+        response = IngestionResponse(status="error", msg=f"Unsupported content encoding {content_encoding}, use gzip or identity")
+        return JSONResponse(status_code=415, content=response.model_dump())
+
+    framer, prepare, content_type = negotiated
+    inflater = GzipDecoder() if content_encoding == "gzip" else None
+    accepted = 0
+    rejected = 0
+    handed_out = 0
+    # body position of every accepted record, in order
+    positions: List[int] = []
+
+    async def accept(records):
+        nonlocal accepted, rejected, handed_out
+        for record in records:
+            position = framer.positions[handed_out]
+            handed_out += 1
+            try:
+                device_id, body = prepare(record)
+            except ValueError:
+                rejected += 1
+                continue
+            positions.append(position)
+            # by device, so a device's records stay in order on one shard
+            await batcher.add(body, publisher.topology.routing_key_for(device_id))
+            accepted += 1
+
+    malformed = None
+    try:
+        async with RecordBatcher(publisher,
+                                 max_records=GlobalSetting.BATCH_MAX_RECORDS,
+                                 max_bytes=GlobalSetting.BATCH_MAX_BYTES,
+                                 max_delay=GlobalSetting.BATCH_MAX_DELAY,
+                                 content_type=content_type,
+                                 on_publish=admission.record_publish) as batcher:
+            try:
+                async for chunk in request.stream():
+                    if inflater is None:
+                        await accept(framer.feed(chunk))
+                        continue
+                    for piece in inflater.feed(chunk):
+                        await accept(framer.feed(piece))
+                if inflater is not None:
+                    inflater.close()
+                await accept(framer.close())
+            except CodecError as err:
+                # records framed before the damage are still published
+                malformed = str(err)
+    except Exception as err:
+        logger.exception("Failed to publish metrics")
+        count_records(batcher.published, accepted - batcher.published + rejected + framer.oversized)
+        # the batcher publishes in order and stops at the first failure, so the published
+        # records and the rejects between them are a head of the body the client can skip
+        response = IngestionResponse(counter=accepted + rejected + framer.oversized,
+                                     accepted=batcher.published,
+                                     rejected=rejected + framer.oversized,
+                                     status="error",
+                                     suggested_interval=admission.suggested_interval(),
+                                     offset=positions[batcher.published - 1] if batcher.published else 0,
+                                     msg=f"Failed to publish metrics: {err}")
+        return JSONResponse(status_code=503, content=response.model_dump())
+
+    rejected += framer.oversized
+    count_records(accepted, rejected)
+    if malformed is not None:
+        response = IngestionResponse(counter=accepted + rejected,
+                                     accepted=accepted,
+                                     rejected=rejected,
+                                     status="error",
+                                     suggested_interval=admission.suggested_interval(),
+                                     msg=f"Malformed body: {malformed}")
+        return JSONResponse(status_code=400, content=response.model_dump())
+
+    return IngestionResponse(counter=accepted + rejected, accepted=accepted, rejected=rejected,
+                             suggested_interval=admission.suggested_interval())
@@ -0,0 +1,43 @@
+import os
+
+from prometheus_client import CollectorRegistry, Counter, Gauge, Histogram, REGISTRY, CONTENT_TYPE_LATEST, \
+    generate_latest, multiprocess
+
+# uvicorn runs several workers; with PROMETHEUS_MULTIPROC_DIR set each of them writes its
+# samples to files there and a scrape answered by any worker adds them all up
+MULTIPROC_DIR = os.getenv("PROMETHEUS_MULTIPROC_DIR")
+if MULTIPROC_DIR:
+    os.makedirs(MULTIPROC_DIR, exist_ok=True)
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+UPLOADS = Counter("ingestion_uploads", "Uploads answered, by status code", ["code"])
+UPLOADS_REFUSED = Counter("ingestion_uploads_refused", "Uploads turned away by admission control")
+UPLOADS_IN_FLIGHT = Gauge("ingestion_uploads_in_flight", "Uploads being taken in", multiprocess_mode="livesum")
+UPLOAD_SECONDS = Histogram("ingestion_upload_seconds", "Time from admission to the answer of an upload",
+                           buckets=LATENCY_BUCKETS)
+RECORDS = Counter("ingestion_records", "Records of uploads, by outcome", ["outcome"])
+RECORDS_PER_UPLOAD = Histogram("ingestion_records_per_upload", "Records framed out of one upload", buckets=COUNT_BUCKETS)
+PUBLISH_SECONDS = Histogram("ingestion_publish_seconds", "One batch published, broker confirms included",
+                            buckets=LATENCY_BUCKETS)
+PUBLISH_BATCH_RECORDS = Histogram("ingestion_publish_batch_records", "Records per published batch", buckets=COUNT_BUCKETS)
+
+# children resolved once, labels() takes a lock and a dict lookup on every call
+RECORDS_ACCEPTED = RECORDS.labels("accepted")
+RECORDS_REJECTED = RECORDS.labels("rejected")
+
+
+def count_records(accepted: int, rejected: int):
+    RECORDS_ACCEPTED.inc(accepted)
+    RECORDS_REJECTED.inc(rejected)
+    RECORDS_PER_UPLOAD.observe(accepted + rejected)
+
+
+def exposition() -> bytes:
+    if MULTIPROC_DIR:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry)
+    return generate_latest(REGISTRY)
+
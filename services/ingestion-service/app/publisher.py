@@ -0,0 +1,105 @@
+import asyncio
+import itertools
+import logging
+import time
+from typing import Dict, Optional, Sequence
+
+import aio_pika
+from aio_pika.abc import AbstractChannel, AbstractRobustConnection
+from aio_pika.pool import Pool
+from event_exchange_rabbit_mq import ShardedTopology, DeliveryMode
+
+logger = logging.getLogger(__name__)
+
+
+# One robust connection per process with a pool of confirm-enabled channels on top.
+# The shard topology is declared once on start up, requests only borrow a channel.
+#
+# A broker on a memory or disk alarm blocks publishers: the client holds every
+# write back and no confirm comes in until it is unblocked. aio-pika has no
+# public hook for that state, so it is read off the publishes themselves, a
+# batch still unconfirmed after stall_after seconds means the broker is not
+# taking messages, blocked or too slow to be worth more load.
+class MetricPublisher(object):
+    def __init__(self,
+                 url: str,
+                 topology: ShardedTopology,
+                 pool_size: int = 8,
+                 publish_timeout: float = 5.0,
+                 stall_after: float = 1.0):
+        self.url = url
+        self.topology = topology
+        self.exchange_name = topology.exchange_name
+        self.pool_size = pool_size
+        self.publish_timeout = publish_timeout
+        self.stall_after = stall_after
+
+        self._connection: Optional[AbstractRobustConnection] = None
+        self._channel_pool: Optional[Pool[AbstractChannel]] = None
+        # start time of every batch awaiting its confirms, in start order
+        self._pending: Dict[int, float] = {}
+        self._batch_ids = itertools.count()
+
+    async def start(self):
+        # connect_robust reconnects on its own and restores every channel
+        # opened from it, including the pooled ones
+        self._connection = await aio_pika.connect_robust(self.url)
+
+        # the shard queues too, so nothing published before the first processor comes up is lost
+        channel = await self._connection.channel()
+        await self.topology.declare(channel)
+        await channel.close()
+
+        self._channel_pool = Pool(self._open_channel, max_size=self.pool_size)
+        logger.info(f"Publisher connected, exchange '{self.exchange_name}' with {self.topology.shards} shards declared")
+
+    def is_blocked(self) -> bool:
+        # dicts keep insertion order, the first pending batch is the oldest
+        for started in self._pending.values():
+            return time.monotonic() - started >= self.stall_after
+        return False
+
+    async def _open_channel(self) -> AbstractChannel:
+        return await self._connection.channel(publisher_confirms=True)
+
+    async def publish(self, body: bytes, device_id: str, content_type: str = "application/json"):
+        await self.publish_batch([body], [self.topology.routing_key_for(device_id)], content_type=content_type)
+
+    async def publish_batch(self,
+                            bodies: Sequence[bytes],
+                            routing_keys: Sequence[str],
+                            content_type: str = "application/json") -> int:
+        if self._channel_pool is None:
+            raise RuntimeError("Publisher is not started")
+
+        batch_id = next(self._batch_ids)
+        self._pending[batch_id] = time.monotonic()
+        try:
+            return await self._publish(bodies, routing_keys, content_type)
+        finally:
+            del self._pending[batch_id]
+
+    async def _publish(self, bodies: Sequence[bytes], routing_keys: Sequence[str], content_type: str) -> int:
+        async with self._channel_pool.acquire() as channel:
+            exchange = await channel.get_exchange(self.exchange_name, ensure=False)
+
+            # every message is written to the socket first and the confirms are
+            # awaited together, so a batch costs one round trip instead of one per message
+            confirmations = [exchange.publish(aio_pika.Message(body=body,
+                                                               content_type=content_type,
+                                                               delivery_mode=DeliveryMode.Persistent.value),
+                                              routing_key=routing_key,
+                                              timeout=self.publish_timeout)
+                             for body, routing_key in zip(bodies, routing_keys)]
+            await asyncio.gather(*confirmations)
+
+        return len(confirmations)
+
+    async def close(self):
+        if self._channel_pool is not None:
+            await self._channel_pool.close()
+            self._channel_pool = None
+
+        if self._connection is not None:
+            await self._connection.close()
+            self._connection = None
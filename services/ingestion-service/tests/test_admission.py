@@ -0,0 +1,80 @@
+import asyncio
+
+import httpx
+import pytest
+
+from app.admission import AdmissionController
+from app.main import app
+
+
+def test_the_worker_budget_and_the_device_share():
+    admission = AdmissionController(max_in_flight=3, max_per_device=2)
+    assert admission.try_admit("a") and admission.try_admit("a")
+    # a's share is used up, other devices still get in
+    assert not admission.try_admit("a")
+    assert admission.try_admit("b")
+    assert not admission.try_admit("c")
+    assert (admission.admitted, admission.refused) == (3, 2)
+
+    admission.release("a")
+    assert admission.try_admit("c")
+    for device_id in ("a", "b", "c"):
+        admission.release(device_id)
+    assert admission.stats()["in_flight"] == 0 and admission.stats()["devices_in_flight"] == 0
+
+
+def test_uploads_without_a_device_id_count_against_the_budget_only():
+    admission = AdmissionController(max_in_flight=2, max_per_device=1)
+    assert admission.try_admit(None) and admission.try_admit(None)
+    assert not admission.try_admit(None)
+
+
+def test_a_blocked_broker_refuses_everything():
+    blocked = False
+    admission = AdmissionController(is_blocked=lambda: blocked)
+    assert admission.try_admit("a")
+    blocked = True
+    assert not admission.try_admit("b")
+    assert admission.pressure() == 1.0
+
+
+def test_the_suggested_interval_follows_the_pressure():
+    admission = AdmissionController(max_in_flight=100, base_interval=30, max_interval=300, quiet_pressure=0.25)
+    # quiet, clients keep their own cadence
+    assert admission.suggested_interval() is None
+
+    for _ in range(50):
+        admission.try_admit(None)
+    half = admission.suggested_interval()
+    for _ in range(50):
+        admission.try_admit(None)
+    assert 30 <= half < admission.suggested_interval() == 300
+
+    slow = AdmissionController(target_publish_latency=0.25)
+    for _ in range(50):
+        slow.record_publish(0.5)
+    assert slow.suggested_interval() == pytest.approx(300, rel=0.01)
+
+
+def test_retry_after_is_jittered_within_the_interval():
+    admission = AdmissionController(max_in_flight=1, base_interval=30, max_interval=300)
+    admission.try_admit(None)
+    assert {150 <= admission.retry_after() <= 300 for _ in range(100)} == {True}
+
+
+def test_a_refused_upload_gets_a_429_before_its_body_is_read():
+    async def scenario():
+        app.state.admission = AdmissionController(max_in_flight=1, is_blocked=lambda: True)
+        app.state.publisher = None
+
+        async def body():
+            raise AssertionError("the body of a refused upload must not be read")
+            yield b""
+
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as client:
+            return await client.post("/ingest/metrics", content=body(), headers={"X-Device-Id": "dev"})
+
+    response = asyncio.run(scenario())
+    assert response.status_code == 429
+    assert int(response.headers["Retry-After"]) >= 1
+    assert response.json()["suggested_interval"] == 300
@@ -0,0 +1,92 @@
+import gzip
+
+import pytest
+
+from metric_ingestion_models import CodecError
+from metric_ingestion_models.codec import frame
+from app.framing import NDJSONFramer, LengthPrefixedFramer, GzipDecoder
+
+
+def feed_all(framer, chunks):
+    records = []
+    for chunk in chunks:
+        records.extend(framer.feed(chunk))
+    records.extend(framer.close())
+    return records
+
+
+def test_ndjson_records_across_chunks():
+    body = b'{"a": 1}\n\n  {"b": 2}  \r\n{"c": 3}'
+    for size in (1, 3, len(body)):
+        chunks = [body[start:start + size] for start in range(0, len(body), size)]
+        assert feed_all(NDJSONFramer(), chunks) == [b'{"a": 1}', b'{"b": 2}', b'{"c": 3}']
+
+
+def test_ndjson_skips_oversized_records():
+    framer = NDJSONFramer(max_record_size=8)
+    records = feed_all(framer, [b"short\n", b"x" * 5, b"x" * 10, b"x" * 10, b"\nafter\n"])
+    assert records == [b"short", b"after"]
+    assert framer.oversized == 1
+    # the places in the body, the skipped record in between still counts
+    assert framer.positions == [1, 3]
+
+
+def test_ndjson_positions_with_an_oversized_record_inside_a_chunk():
+    framer = NDJSONFramer(max_record_size=4)
+    assert framer.feed(b"a\n" + b"x" * 8 + b"\nb\n") == [b"a", b"b"]
+    assert framer.positions == [1, 3]
+
+
+def test_length_prefixed_records_across_chunks():
+    payloads = [b"one", b"", b"three" * 50]
+    body = b"".join(frame(payload) for payload in payloads)
+    for size in (1, 5, len(body)):
+        chunks = [body[start:start + size] for start in range(0, len(body), size)]
+        assert feed_all(LengthPrefixedFramer(), chunks) == payloads
+
+
+def test_length_prefixed_oversized_frame():
+    framer = LengthPrefixedFramer(max_record_size=4)
+    with pytest.raises(CodecError):
+        framer.feed(frame(b"too long"))
+    assert framer.oversized == 1
+
+
+def test_length_prefixed_truncated_stream():
+    framer = LengthPrefixedFramer()
+    assert framer.feed(frame(b"abc")[:-1]) == []
+    with pytest.raises(CodecError):
+        framer.close()
+
+
+def test_gzip_decoder_bounds_its_output():
+    raw = b"0123456789" * 10_000
+    compressed = gzip.compress(raw)
+    decoder = GzipDecoder(max_chunk=1024)
+    pieces = []
+    for start in range(0, len(compressed), 100):
+        pieces.extend(decoder.feed(compressed[start:start + 100]))
+    decoder.close()
+    assert b"".join(pieces) == raw
+    assert max(len(piece) for piece in pieces) <= 1024
+
+
+def test_gzip_decoder_feeds_framer():
+    body = b"".join(f'{{"n": {n}}}\n'.encode() for n in range(1000))
+    decoder, framer = GzipDecoder(max_chunk=512), NDJSONFramer()
+    records = []
+    for piece in decoder.feed(gzip.compress(body)):
+        records.extend(framer.feed(piece))
+    decoder.close()
+    records.extend(framer.close())
+    assert len(records) == 1000 and records[-1] == b'{"n": 999}'
+
+
+def test_gzip_decoder_truncated_and_corrupt():
+    compressed = gzip.compress(b"payload" * 100)
+    decoder = GzipDecoder()
+    list(decoder.feed(compressed[:-8]))
+    with pytest.raises(CodecError):
+        decoder.close()
+    with pytest.raises(CodecError):
+        list(GzipDecoder().feed(b"not gzip at all"))
@@ -0,0 +1,49 @@
+import asyncio
+
+from event_exchange_rabbit_mq import ShardedTopology
+
+from app.publisher import MetricPublisher
+
+
+def test_a_stalled_publish_reads_as_blocked():
+    async def scenario():
+        publisher = MetricPublisher(url="amqp://unused", topology=ShardedTopology(shards=2), stall_after=0.05)
+        # started, nothing on the wire: stand in for the channel pool and the broker
+        publisher._channel_pool = object()
+        confirmed = asyncio.Event()
+
+        async def publish(bodies, routing_keys, content_type):
+            await confirmed.wait()
+            return len(bodies)
+
+        publisher._publish = publish
+        assert not publisher.is_blocked()
+        pending = asyncio.create_task(publisher.publish_batch([b"a"], ["key"]))
+        await asyncio.sleep(0.01)
+        assert not publisher.is_blocked()
+        await asyncio.sleep(0.06)
+        assert publisher.is_blocked()
+
+        confirmed.set()
+        assert await pending == 1
+        assert not publisher.is_blocked()
+
+    asyncio.run(scenario())
+
+
+def test_a_failed_publish_does_not_stay_pending():
+    async def scenario():
+        publisher = MetricPublisher(url="amqp://unused", topology=ShardedTopology(shards=2), stall_after=0.0)
+        publisher._channel_pool = object()
+
+        async def publish(bodies, routing_keys, content_type):
+            raise ConnectionError("gone")
+
+        publisher._publish = publish
+        try:
+            await publisher.publish_batch([b"a"], ["key"])
+        except ConnectionError:
+            pass
+        assert not publisher.is_blocked()
+
+    asyncio.run(scenario())
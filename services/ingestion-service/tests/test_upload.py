@@ -0,0 +1,59 @@
+import asyncio
+
+import httpx
+from metric_ingestion_models import DeviceMetricGroup, DeviceMetric, NDJSON_CONTENT_TYPE
+from event_exchange_rabbit_mq import ShardedTopology
+
+from app.main import app, GlobalSetting
+from app.admission import AdmissionController
+
+
+class FailingPublisher(object):
+    # publishes the first `batches` batches and fails every one after
+    def __init__(self, batches: int):
+        self.topology = ShardedTopology(shards=2)
+        self.batches = batches
+        self.published = []
+
+    async def publish_batch(self, bodies, routing_keys, content_type="application/json"):
+        if self.batches == 0:
+            raise ConnectionError("broker gone")
+        self.batches -= 1
+        self.published.extend(bodies)
+        return len(bodies)
+
+
+def record(value: float) -> bytes:
+    group = DeviceMetricGroup(device_id="dev", metrics=[DeviceMetric(name="cpu", value=value, timestamp=1.0)])
+    return group.model_dump_json().encode() + b"\n"
+
+
+def upload(body: bytes, publisher: FailingPublisher) -> httpx.Response:
+    async def scenario():
+        # no lifespan over ASGITransport, the state it would set up is put in place here
+        app.state.publisher = publisher
+        app.state.admission = AdmissionController()
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as client:
+            return await client.post("/ingest/metrics", content=body,
+                                     headers={"Content-Type": NDJSON_CONTENT_TYPE, "X-Device-Id": "dev"})
+
+    return asyncio.run(scenario())
+
+
+def test_partial_publish_failure_reports_the_settled_head(monkeypatch):
+    monkeypatch.setattr(GlobalSetting, "BATCH_MAX_RECORDS", 2)
+    publisher = FailingPublisher(batches=1)
+    # a rejected record inside the published head counts as settled
+    body = record(1) + b"not json\n" + record(2) + record(3) + record(4)
+    response = upload(body, publisher)
+
+    assert response.status_code == 503
+    assert response.json()["accepted"] == 2
+    assert response.json()["offset"] == 3
+    assert len(publisher.published) == 2
+
+
+def test_publish_failure_before_anything_went_out():
+    response = upload(record(1) + record(2), FailingPublisher(batches=0))
+    assert response.status_code == 503
+    assert response.json()["offset"] == 0
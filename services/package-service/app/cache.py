@@ -0,0 +1,115 @@
+import asyncio
+from typing import Awaitable, Callable, Dict, Optional
+
+import redis.asyncio as redis
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+# SET only when the key's generation is still the one read before the load, an
+# invalidation from any worker in between means the loaded row may be stale;
+# KEYS[1] the cached key, KEYS[2] its generation, ARGV generation, value, ttl
+_SET_IF_CURRENT = """
+if (redis.call('GET', KEYS[2]) or '0') ~= ARGV[1] then
+    return 0
+end
+redis.call('SET', KEYS[1], ARGV[2], 'EX', ARGV[3])
+return 1
+"""
+
+
+# Read-through cache over redis. Concurrent misses on one key share a single
+# load, and a load that raced an invalidation is served but not cached, so a
+# stale row can't be written back right after an update dropped it. The
+# generation counters live in redis next to the keys, an update handled by
+# another worker counts as much as one handled here.
+class ReadThroughCache(object):
+    def __init__(self, client: redis.Redis, prefix: str = "package-cache", ttl: int = 300):
+        self.client = client
+        self.prefix = prefix
+        self.ttl = ttl
+        self.hits: int = 0
+        self.misses: int = 0
+        self.coalesced: int = 0
+        self.errors: int = 0
+
+        self._inflight: Dict[str, asyncio.Task] = {}
+        self._set_if_current = client.register_script(_SET_IF_CURRENT)
+
+    def key(self, name: str) -> str:
+        return f"{self.prefix}:{name}"
+
+    @staticmethod
+    def generation_key(key: str) -> str:
+        # no expiry: a counter that vanished and counted up again could repeat a generation
+        return f"{key}:generation"
+
+    def stats(self) -> Dict[str, int]:
+        return {"hits": self.hits, "misses": self.misses, "coalesced": self.coalesced, "errors": self.errors}
+
+    async def get_or_load(self,
+                          name: str,
+                          load: Callable[[], Awaitable[Optional[bytes]]],
+                          ttl: Optional[int] = None) -> Optional[bytes]:
+        key = self.key(name)
+        try:
+            cached = await self.client.get(key)
+        except redis.RedisError as err:
+            # redis down means slower, not broken
+            self.errors += 1
+            logger.warning(f"Cache read failed for {key}: {err!r}")
+            cached = None
+        if cached is not None:
+            self.hits += 1
+            return cached
+
+        # the load runs in its own task, a caller that goes away does not cancel it for the others
+        task = self._inflight.get(key)
+        if task is None:
+            self.misses += 1
+            task = asyncio.create_task(self._load(key, load, ttl))
+            self._inflight[key] = task
+            task.add_done_callback(lambda done: self._forget(key, done))
+        else:
+            self.coalesced += 1
+        return await asyncio.shield(task)
+
+    def _forget(self, key: str, task: asyncio.Task):
+        # an invalidation may already have replaced the entry with a newer load
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+
+    async def _load(self, key: str, load: Callable[[], Awaitable[Optional[bytes]]], ttl: Optional[int]) -> Optional[bytes]:
+        generation_key = self.generation_key(key)
+        try:
+            generation = await self.client.get(generation_key) or b"0"
+        except redis.RedisError as err:
+            # without a generation to check against the value is served, not cached
+            self.errors += 1
+            logger.warning(f"Cache generation read failed for {key}: {err!r}")
+            generation = None
+        value = await load()
+        if value is not None and generation is not None:
+            try:
+                await self._set_if_current(keys=[key, generation_key],
+                                           args=[generation, value, self.ttl if ttl is None else ttl])
+            except redis.RedisError as err:
+                self.errors += 1
+                logger.warning(f"Cache write failed for {key}: {err!r}")
+        return value
+
+    async def invalidate(self, *names: str):
+        keys = [self.key(name) for name in names]
+        for key in keys:
+            # callers after the update must not join a load that may have read the old row
+            self._inflight.pop(key, None)
+        try:
+            async with self.client.pipeline(transaction=True) as pipe:
+                for key in keys:
+                    pipe.incr(self.generation_key(key))
+                pipe.delete(*keys)
+                await pipe.execute()
+        except redis.RedisError as err:
+            self.errors += 1
+            logger.warning(f"Cache invalidation failed for {keys}: {err!r}")
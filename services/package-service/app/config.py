@@ -1,4 +1,6 @@
-from pydantic import BaseSettings, Field, SecretStr
+from typing import Optional
+from pydantic import Field, SecretStr
+from pydantic_settings import BaseSettings
 
 
 
@@ -6,15 +8,22 @@ class AppConfig(BaseSettings):
     INGESTION_ENDPOINT: str
     DEVICE_ID: str
     REDIS_URL: str
-    INGESTION_API_KEY: SecretStr = Field(default=None, env="INGESTION_API_KEY")
+    INGESTION_API_KEY: Optional[SecretStr] = Field(default=None)
     DEBUG_MODE: bool = False
     EXCLUSIVE_LOCK_KEY: str = Field(default="package-exclusive-key")
     ACQUIRE_LOCK_TIMEOUT: float = Field(default=60)
+    CACHE_PREFIX: str = Field(default="package-cache")
+    PACKAGE_CACHE_TTL: int = Field(default=300, gt=0)
+    ACTIVE_PACKAGES_CACHE_TTL: int = Field(default=60, gt=0)
+    BULK_MAX_ITEMS: int = Field(default=10_000, gt=0)
+    LIST_MAX_LIMIT: int = Field(default=1000, gt=0)
 
 
     class Config:
         env_file = ".env"
         env_file_encoding = "utf-8"
+        # the DB_* keys of the same .env belong to the shared DatabaseSettings
+        extra = "ignore"
 
 
 
@@ -1 +0,0 @@
-from sqlmodel import SqlModel, create_engine
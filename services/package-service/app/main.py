@@ -1,16 +1,21 @@
-from fastapi import FastAPI, Depends, HTTPException
+from fastapi import FastAPI, Depends, HTTPException, Query, Request
+from fastapi.responses import Response
 from sqlmodel import Field, SQLModel, select
-from typing import AsyncGenerator, Optional
+from sqlalchemy import Index, insert
+from typing import Optional, List
 from uuid import UUID, uuid4
 from contextlib import asynccontextmanager
-from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
+from sqlalchemy.ext.asyncio import AsyncSession
 import logging 
 import asyncio
-from config import GlobalSetting
+from app.config import GlobalSetting
+from app.cache import ReadThroughCache
+from shared_utils.bulk import read_items, encode_cursor, decode_cursor, upsert_statement
+from shared_utils.database import get_database
 
-from pydantic import BaseModel as DtoModel, Field as DtoField
+from pydantic import BaseModel as DtoModel, Field as DtoField, TypeAdapter
 
-from metric_ingestion import MetricIngestionClient as IngestionClient, IngestionSettings
+from metric_ingestion import IngestionSettings, MultiWorkerExporter, RequestTelemetry, TelemetryMiddleware
 
 import redis.asyncio as redis
 
@@ -20,6 +25,9 @@ logger = logging.getLogger(__name__)
 
 
 class Package(SQLModel, table=True):
+    # keyset listing filtered by active walks this index in id order
+    __table_args__ = (Index("ix_package_active_id", "active", "id"),)
+
     id: UUID = Field(default_factory=uuid4, primary_key=True)
     name: str = Field(default="Home Basic", max_length=1024)
     speed_mbps: int = Field(default=50, ge=30, le=200)
@@ -30,27 +38,22 @@ class Package(SQLModel, table=True):
     active: bool = Field(default=True)
 
 
-sqlite_file_name = "database.db"
-sqlite_url = f"sqlite+aiosqlite:///{sqlite_file_name}"
-
-
-async_engine = create_async_engine(
-    sqlite_url, echo=True, connect_args={"check_same_thread": False}
-)
+database = get_database()
+async_engine = database.engine
+async_session = database.sessionmaker
+get_session = database.get_session
 
 
 async def create_db_and_tables():
     async with async_engine.begin() as conn:
         await conn.run_sync(SQLModel.metadata.create_all)
+        # create_all skips indexes of tables that already exist
+        for index in Package.__table__.indexes:
+            await conn.run_sync(index.create, checkfirst=True)
 
 
-async def get_session() -> AsyncGenerator[AsyncSession, None]:
-    async_session = async_sessionmaker(
-        bind=async_engine, class_=AsyncSession, expire_on_commit=False
-    )
-
-    async with async_session() as session:
-        yield session
+# request telemetry of this worker, see MultiWorkerExporter
+request_telemetry = RequestTelemetry()
 
 
 @asynccontextmanager
@@ -58,27 +61,27 @@ async def lifespan(app: FastAPI):
     # on start up
 
     r = redis.from_url(GlobalSetting.REDIS_URL)
+    app.state.package_cache = ReadThroughCache(r, prefix=GlobalSetting.CACHE_PREFIX, ttl=GlobalSetting.PACKAGE_CACHE_TTL)
 
-    exclusive_lock = r.lock(name = GlobalSetting.EXCLUSIVE_LOCK_KEY, timeout=GlobalSetting.ACQUIRE_LOCK_TIMEOUT, blocking=False)
-
-    keep_lock = False
-    if await exclusive_lock.acquire():
-        import os 
-        pid = os.getpid()
-        logger.info(f"Begin start internal work. Worker with pid: {pid} undertake")
+    # every worker waits for the schema, one at a time, create_all is idempotent
+    async with r.lock(name = f"{GlobalSetting.EXCLUSIVE_LOCK_KEY}:schema", timeout=GlobalSetting.ACQUIRE_LOCK_TIMEOUT,
+                      blocking_timeout=GlobalSetting.ACQUIRE_LOCK_TIMEOUT):
         await create_db_and_tables()
-        ingestion_client = IngestionClient(setting = IngestionSettings(ingestion_endpoint = GlobalSetting.INGESTION_ENDPOINT, device_id = GlobalSetting.DEVICE_ID))
-        task = asyncio.create_task(ingestion_client.start_expose())
 
-        keep_lock = True
+    # one worker exports for the host, the others hand it their request telemetry
+    exporter = MultiWorkerExporter(setting = IngestionSettings(ingestion_endpoint = GlobalSetting.INGESTION_ENDPOINT, device_id = GlobalSetting.DEVICE_ID),
+                                   client = r,
+                                   telemetry = request_telemetry,
+                                   lock_key = GlobalSetting.EXCLUSIVE_LOCK_KEY,
+                                   lock_ttl = GlobalSetting.ACQUIRE_LOCK_TIMEOUT)
+    task = asyncio.create_task(exporter.run())
 
-    
     yield
     # on shutdown
-    if keep_lock:
-        ingestion_client.stop_expose()
-        await task
-        await exclusive_lock.release() 
+    await exporter.stop()
+    await task
+    await r.aclose()
+    await database.dispose()
 
 #####
 ## Request-Response models
@@ -106,7 +109,7 @@ class CreatePackageResponse(DtoModel):
     active: bool = DtoField(default=True)
 
 
-class UpdatePackageRequest(Package):
+class UpdatePackageRequest(CreatePackageRequest):
     pass
 
 
@@ -114,13 +117,44 @@ class PackageDto(Package):
     pass
 
 
+class UpsertPackageRequest(CreatePackageRequest):
+    id: UUID = DtoField(...)
+
+
+class BulkGetRequest(DtoModel):
+    ids: List[UUID] = DtoField(..., max_length=GlobalSetting.BULK_MAX_ITEMS)
+
+
+class BulkWriteResponse(DtoModel):
+    count: int = DtoField(default=0)
+    ids: List[UUID] = DtoField(default_factory=list)
+
+
+class PackagePage(DtoModel):
+    items: List[PackageDto] = DtoField(default_factory=list)
+    next_cursor: Optional[str] = DtoField(default=None)
+
+
+PACKAGE_LIST_ADAPTER = TypeAdapter(List[PackageDto])
+ACTIVE_PACKAGES_KEY = "active"
+# keeps IN (...) under the bound parameter limit of older sqlite builds
+IDS_CHUNK_SIZE = 500
+
+
 
 app = FastAPI(lifespan=lifespan, title="package-api")
+app.add_middleware(TelemetryMiddleware, telemetry=request_telemetry)
+
+
+def get_package_cache(request: Request) -> ReadThroughCache:
+    return request.app.state.package_cache
 
 
 @app.post("/create", response_model=CreatePackageResponse)
 async def create_package(
-    req: CreatePackageRequest, session: AsyncSession = Depends(get_session)
+    req: CreatePackageRequest,
+    session: AsyncSession = Depends(get_session),
+    cache: ReadThroughCache = Depends(get_package_cache),
 ):
     package = Package(**req.model_dump())
 
@@ -131,21 +165,47 @@ async def create_package(
     await session.commit()
 
     await session.refresh(package)
+
+    if package.active:
+        await cache.invalidate(ACTIVE_PACKAGES_KEY)
     return CreatePackageResponse(**package.model_dump())
 
 
 @app.get("/get/{package_id}", response_model=PackageDto)
-async def get_by_id(package_id: UUID, session: AsyncSession = Depends(get_session)):
-    query = select(Package).where(Package.id == package_id)
+async def get_by_id(package_id: UUID, cache: ReadThroughCache = Depends(get_package_cache)):
+    async def load() -> Optional[bytes]:
+        # own session, the load may outlive the request that started it
+        async with async_session() as session:
+            package = await session.get(Package, package_id)
+        return None if package is None else PackageDto(**package.model_dump()).model_dump_json().encode()
+
+    body = await cache.get_or_load(str(package_id), load)
+    if body is None:
+        raise HTTPException(status_code=404, detail="Package not found")
 
-    result = await session.execute(query)
+    # already serialized PackageDto, no need to validate it again
+    return Response(content=body, media_type="application/json")
 
-    row = result.one()
 
-    if not row:
-        raise HTTPException(status_code=404, detail="Package not found")
+@app.get("/active", response_model=List[PackageDto])
+async def active_packages(cache: ReadThroughCache = Depends(get_package_cache)):
+    async def load() -> bytes:
+        async with async_session() as session:
+            packages = (await session.execute(select(Package).where(Package.active == True))).scalars().all()
+        return PACKAGE_LIST_ADAPTER.dump_json([PackageDto(**package.model_dump()) for package in packages])
+
+    body = await cache.get_or_load(ACTIVE_PACKAGES_KEY, load, ttl=GlobalSetting.ACTIVE_PACKAGES_CACHE_TTL)
+    return Response(content=body, media_type="application/json")
+
 
-    return PackageDto(**Package(**row._mapping).model_dump())
+@app.get("/cache/stats")
+async def cache_stats(cache: ReadThroughCache = Depends(get_package_cache)):
+    return cache.stats()
+
+
+@app.get("/db/stats")
+async def db_stats():
+    return database.pool_stats()
 
 
 @app.put("/update/{package_id}", response_model=PackageDto)
@@ -153,22 +213,21 @@ async def update(
     package_id: UUID,
     update_req: UpdatePackageRequest,
     session: AsyncSession = Depends(get_session),
+    cache: ReadThroughCache = Depends(get_package_cache),
 ):
-    print("-------------***********&&&&&&&&&", package_id)
-    query = select(Package).where(Package.id == package_id)
-
-    row = (await session.execute(query)).one()
+    record = await session.get(Package, package_id)
 
-    if not row:
+    if record is None:
         raise HTTPException(status_code=404, detail="Package not found")
-    record = Package(**row._mapping)
     record.sqlmodel_update(update_req.model_dump())
 
     session.add(record)
 
     await session.commit()
 
-    await session.refresh()
+    await session.refresh(record)
+
+    await cache.invalidate(str(package_id), ACTIVE_PACKAGES_KEY)
 
     return PackageDto(**record.model_dump())
 
@@ -178,35 +237,116 @@ async def partial_update(
     package_id: UUID,
     update_req: UpdatePackageRequest,
     session: AsyncSession = Depends(get_session),
+    cache: ReadThroughCache = Depends(get_package_cache),
 ):
-    query = select(Package).where(Package.id == package_id)
-
-    row = (await session.execute(query)).one()
+    record = await session.get(Package, package_id)
 
-    if not row:
+    if record is None:
         raise HTTPException(status_code=404, detail="Package not found")
-    record = Package(**row._mapping)
     record.sqlmodel_update(update_req.model_dump(exclude_unset=True))
 
     session.add(record)
 
     await session.commit()
 
-    await session.refresh()
+    await session.refresh(record)
+
+    await cache.invalidate(str(package_id), ACTIVE_PACKAGES_KEY)
 
     return PackageDto(**record.model_dump())
 
 
 @app.delete("/delete/{package_id}")
-async def delete(package_id: UUID, session: AsyncSession = Depends(get_session)):
-    query = select(Package).where(Package.id == package_id)
-
-    row: Package = (await session.execute(query)).one()
+async def delete(
+    package_id: UUID,
+    session: AsyncSession = Depends(get_session),
+    cache: ReadThroughCache = Depends(get_package_cache),
+):
+    record = await session.get(Package, package_id)
 
-    if not row:
+    if record is None:
         raise HTTPException(status_code=404, detail="Package not found")
 
-    session.delete(row)
+    await session.delete(record)
     await session.commit()
 
+    await cache.invalidate(str(package_id), ACTIVE_PACKAGES_KEY)
+
     return {"ok": True}
+
+
+# Bulk endpoints take a JSON array or NDJSON (Content-Type: application/x-ndjson)
+# and write everything in one transaction, all rows or none.
+@app.post("/bulk/create", response_model=BulkWriteResponse)
+async def bulk_create(
+    request: Request,
+    session: AsyncSession = Depends(get_session),
+    cache: ReadThroughCache = Depends(get_package_cache),
+):
+    items = await read_items(request, CreatePackageRequest, max_items=GlobalSetting.BULK_MAX_ITEMS)
+    if not items:
+        return BulkWriteResponse()
+    rows = [{"id": uuid4(), **item.model_dump()} for item in items]
+
+    await session.execute(insert(Package), rows)
+    await session.commit()
+
+    if any(row["active"] for row in rows):
+        await cache.invalidate(ACTIVE_PACKAGES_KEY)
+    return BulkWriteResponse(count=len(rows), ids=[row["id"] for row in rows])
+
+
+@app.post("/bulk/upsert", response_model=BulkWriteResponse)
+async def bulk_upsert(
+    request: Request,
+    session: AsyncSession = Depends(get_session),
+    cache: ReadThroughCache = Depends(get_package_cache),
+):
+    items = await read_items(request, UpsertPackageRequest, max_items=GlobalSetting.BULK_MAX_ITEMS)
+    if not items:
+        return BulkWriteResponse()
+    # last one wins when an id shows up twice, a single statement can't touch a row twice
+    rows = list({item.id: item.model_dump() for item in items}.values())
+
+    statement = upsert_statement(Package.__table__, database.dialect, keys=["id"], columns=list(rows[0]))
+    await session.execute(statement, rows)
+    await session.commit()
+
+    ids = [row["id"] for row in rows]
+    await cache.invalidate(*(str(package_id) for package_id in ids), ACTIVE_PACKAGES_KEY)
+    return BulkWriteResponse(count=len(rows), ids=ids)
+
+
+@app.post("/bulk/get", response_model=List[PackageDto])
+async def bulk_get(req: BulkGetRequest, session: AsyncSession = Depends(get_session)):
+    # unknown ids are left out rather than failing the whole lookup
+    ids = list(dict.fromkeys(req.ids))
+    packages: List[Package] = []
+    for start in range(0, len(ids), IDS_CHUNK_SIZE):
+        query = select(Package).where(Package.id.in_(ids[start:start + IDS_CHUNK_SIZE]))
+        packages.extend((await session.execute(query)).scalars().all())
+    return [PackageDto(**package.model_dump()) for package in packages]
+
+
+@app.get("/list", response_model=PackagePage)
+async def list_packages(
+    active: Optional[bool] = None,
+    limit: int = Query(default=100, gt=0, le=GlobalSetting.LIST_MAX_LIMIT),
+    cursor: Optional[str] = Query(default=None, description="next_cursor of the previous page"),
+    session: AsyncSession = Depends(get_session),
+):
+    # keyset pagination on id, a page costs the same however deep it is
+    query = select(Package).order_by(Package.id).limit(limit + 1)
+    if active is not None:
+        query = query.where(Package.active == active)
+    if cursor is not None:
+        try:
+            after = UUID(decode_cursor(cursor)[0])
+        except (IndexError, ValueError):
+            raise HTTPException(status_code=400, detail="Malformed cursor")
+        query = query.where(Package.id > after)
+
+    packages = (await session.execute(query)).scalars().all()
+    next_cursor = encode_cursor([packages[limit - 1].id]) if len(packages) > limit else None
+    return PackagePage(items=[PackageDto(**package.model_dump()) for package in packages[:limit]],
+                       next_cursor=next_cursor)
@@ -0,0 +1,8 @@
+import os
+import tempfile
+
+# app.config and the shared database read these on import, the tests run on a throwaway sqlite file
+os.environ.setdefault("DEVICE_ID", "package-service-test")
+os.environ.setdefault("INGESTION_ENDPOINT", "http://localhost:8001/ingest/metrics")
+os.environ.setdefault("REDIS_URL", "redis://localhost:6379/0")
+os.environ.setdefault("DATABASE_URL", f"sqlite+aiosqlite:///{tempfile.mkdtemp()}/package.db")
@@ -0,0 +1,91 @@
+import asyncio
+import json
+
+import fakeredis
+import httpx
+
+from app.cache import ReadThroughCache
+from app.main import app, create_db_and_tables, database
+
+
+def run(scenario):
+    async def wrapped():
+        await create_db_and_tables()
+        # no lifespan over ASGITransport, the state it would set up is put in place here
+        app.state.package_cache = ReadThroughCache(fakeredis.FakeAsyncRedis())
+        try:
+            async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as client:
+                await scenario(client)
+        finally:
+            await database.dispose()
+
+    asyncio.run(wrapped())
+
+
+def package(name: str, **fields):
+    return {"name": name, "speed_mbps": 50, "price_per_month": 50_000, **fields}
+
+
+def test_bulk_create_takes_json_and_ndjson():
+    async def scenario(client):
+        created = await client.post("/bulk/create", json=[package("json-1"), package("json-2")])
+        assert created.json()["count"] == 2
+
+        body = "\n".join(json.dumps(package(f"ndjson-{index}")) for index in range(3)) + "\n"
+        created = await client.post("/bulk/create", content=body, headers={"Content-Type": "application/x-ndjson"})
+        ids = created.json()["ids"]
+        assert len(ids) == 3
+
+        found = await client.post("/bulk/get", json={"ids": ids + ["00000000-0000-0000-0000-000000000000"]})
+        assert sorted(item["name"] for item in found.json()) == ["ndjson-0", "ndjson-1", "ndjson-2"]
+
+    run(scenario)
+
+
+def test_a_bad_item_fails_the_whole_batch():
+    async def scenario(client):
+        before = len((await client.get("/list", params={"limit": 1000})).json()["items"])
+        response = await client.post("/bulk/create", json=[package("fine"), package("too slow", speed_mbps=1)])
+        assert response.status_code == 422
+        # the index of the offending item leads its error location
+        assert response.json()["detail"][0]["loc"][0] == 1
+        assert len((await client.get("/list", params={"limit": 1000})).json()["items"]) == before
+
+    run(scenario)
+
+
+def test_upsert_updates_inserts_and_keeps_the_last_duplicate():
+    async def scenario(client):
+        (existing,) = (await client.post("/bulk/create", json=[package("old")])).json()["ids"]
+        fresh = "11111111-1111-1111-1111-111111111111"
+        response = await client.post("/bulk/upsert", json=[package("renamed", id=existing),
+                                                            package("first", id=fresh),
+                                                            package("second", id=fresh)])
+        assert response.json()["count"] == 2
+
+        found = {item["id"]: item["name"] for item in (await client.post("/bulk/get", json={"ids": [existing, fresh]})).json()}
+        assert found == {existing: "renamed", fresh: "second"}
+
+    run(scenario)
+
+
+def test_list_pages_with_a_cursor():
+    async def scenario(client):
+        await client.post("/bulk/create", json=[package(f"inactive-{index}", active=False) for index in range(5)])
+        expected = sorted(item["id"] for item in (await client.get("/list", params={"active": False, "limit": 1000})).json()["items"])
+        assert len(expected) >= 5
+
+        seen, cursor = [], None
+        while True:
+            params = {"active": False, "limit": 2, **({"cursor": cursor} if cursor else {})}
+            page = (await client.get("/list", params=params)).json()
+            assert all(not item["active"] for item in page["items"])
+            seen.extend(item["id"] for item in page["items"])
+            cursor = page["next_cursor"]
+            if cursor is None:
+                break
+        assert seen == expected
+
+        assert (await client.get("/list", params={"cursor": "not-a-cursor"})).status_code == 400
+
+    run(scenario)
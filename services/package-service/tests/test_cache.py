@@ -0,0 +1,107 @@
+import asyncio
+
+import fakeredis
+
+from app.cache import ReadThroughCache
+
+
+def caches(count: int):
+    # one redis, one cache per simulated worker
+    server = fakeredis.FakeServer()
+    return [ReadThroughCache(fakeredis.FakeAsyncRedis(server=server)) for _ in range(count)]
+
+
+def test_concurrent_misses_share_one_load():
+    async def scenario():
+        (cache,) = caches(1)
+        calls = 0
+
+        async def load():
+            nonlocal calls
+            calls += 1
+            await asyncio.sleep(0.01)
+            return b"row"
+
+        results = await asyncio.gather(*(cache.get_or_load("k", load) for _ in range(10)))
+        assert results == [b"row"] * 10
+        assert calls == 1 and cache.misses == 1 and cache.coalesced == 9
+        assert await cache.get_or_load("k", load) == b"row"
+        assert calls == 1 and cache.hits == 1
+
+    asyncio.run(scenario())
+
+
+def test_missing_row_is_not_cached():
+    async def scenario():
+        (cache,) = caches(1)
+
+        async def load():
+            return None
+
+        assert await cache.get_or_load("k", load) is None
+        assert await cache.client.get(cache.key("k")) is None
+
+    asyncio.run(scenario())
+
+
+def test_invalidate_drops_the_key():
+    async def scenario():
+        first, second = caches(2)
+
+        async def load():
+            return b"old"
+
+        await first.get_or_load("k", load)
+        await second.invalidate("k")
+        assert await first.client.get(first.key("k")) is None
+
+    asyncio.run(scenario())
+
+
+def test_load_racing_another_workers_invalidation_is_not_cached():
+    async def scenario():
+        first, second = caches(2)
+        loading = asyncio.Event()
+
+        async def stale():
+            loading.set()
+            await asyncio.sleep(0.01)
+            return b"stale"
+
+        pending = asyncio.create_task(first.get_or_load("k", stale))
+        await loading.wait()
+        await second.invalidate("k")
+        # the caller still gets its row, the cache doesn't keep it
+        assert await pending == b"stale"
+        assert await first.client.get(first.key("k")) is None
+
+        async def fresh():
+            return b"fresh"
+
+        assert await second.get_or_load("k", fresh) == b"fresh"
+        assert await first.client.get(first.key("k")) == b"fresh"
+
+    asyncio.run(scenario())
+
+
+def test_callers_after_an_invalidation_do_not_join_the_old_load():
+    async def scenario():
+        (cache,) = caches(1)
+        loading = asyncio.Event()
+
+        async def stale():
+            loading.set()
+            await asyncio.sleep(0.01)
+            return b"stale"
+
+        async def fresh():
+            return b"fresh"
+
+        pending = asyncio.create_task(cache.get_or_load("k", stale))
+        await loading.wait()
+        await cache.invalidate("k")
+        assert await cache.get_or_load("k", fresh) == b"fresh"
+        assert await pending == b"stale"
+        assert await cache.client.get(cache.key("k")) == b"fresh"
+
+    asyncio.run(scenario())
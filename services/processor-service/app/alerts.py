@@ -0,0 +1,231 @@
+import asyncio
+import html
+import logging
+import math
+import random
+import time
+from typing import Dict, List, Optional, Tuple
+
+import httpx
+from pydantic import BaseModel, Field
+
+from utils import create_telegram_client, post_telegram_message
+from metrics import ALERTS_QUEUED, ALERTS_SUPPRESSED, ALERTS_DROPPED, ALERT_SEND_SECONDS, \
+    ALERT_MESSAGES_SENT, ALERT_MESSAGES_FAILED
+
+logger = logging.getLogger(__name__)
+
+TELEGRAM_MESSAGE_LIMIT = 4096
+_TRUNCATED = "…"
+
+
+class Alert(BaseModel):
+    device_id: str = Field(...)
+    metric_name: str = Field(...)
+    value: float = Field(...)
+    status: str = Field(default="critical")
+    timestamp: Optional[float] = Field(default=None)
+
+
+class TokenBucket(object):
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens: float = capacity
+        self._updated: float = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self):
+        self._refill()
+        while self._tokens < 1:
+            await asyncio.sleep((1 - self._tokens) / self.rate)
+            self._refill()
+        self._tokens -= 1
+
+
+def format_digest(alerts: List[Alert]) -> str:
+    by_device: Dict[str, List[Alert]] = {}
+    for alert in alerts:
+        by_device.setdefault(alert.device_id, []).append(alert)
+
+    # the message is sent in HTML mode: every field is escaped, and an overlong
+    # digest is cut between lines so no tag is left open
+    lines = ["🚨 <b>Alert System</b> 🚨\n"]
+    for device_id, device_alerts in by_device.items():
+        lines.append(f"Device: <code>{html.escape(device_id)}</code>\n")
+        for alert in device_alerts:
+            lines.append("".join([f"Metric: <b>{html.escape(alert.metric_name)}</b> ",
+                                  f"Value: <b>{html.escape(str(alert.value))}%</b> ",
+                                  f"Status: <b>{html.escape(alert.status)}</b>\n"]))
+
+    msg = "".join(lines)
+    if len(msg) <= TELEGRAM_MESSAGE_LIMIT:
+        return msg
+    msg = ""
+    for line in lines:
+        if len(msg) + len(line) > TELEGRAM_MESSAGE_LIMIT - len(_TRUNCATED):
+            break
+        msg += line
+    return msg + _TRUNCATED
+
+
+# Alerts are queued by the worker and sent from a single background task over
+# one persistent HTTP client. Repeats of the same device/metric inside the
+# dedup window are dropped, queued alerts are merged into digest messages and
+# sends are paced by a token bucket, so a flapping device or a slow Telegram
+# never stalls metric processing.
+class AlertDispatcher(object):
+    def __init__(self,
+                 client: Optional[httpx.AsyncClient] = None,
+                 dedup_window: float = 300.0,
+                 digest_max_alerts: int = 20,
+                 digest_max_delay: float = 5.0,
+                 rate_per_second: float = 0.3,
+                 burst: int = 3,
+                 max_retries: int = 5,
+                 backoff_base: float = 1.0,
+                 queue_size: int = 10_000):
+        self.dedup_window = dedup_window
+        self.digest_max_alerts = digest_max_alerts
+        self.digest_max_delay = digest_max_delay
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+
+        self.submitted: int = 0
+        self.suppressed: int = 0
+        self.dropped: int = 0
+        self.sent_messages: int = 0
+        self.failed_messages: int = 0
+
+        self._client = client
+        self._owns_client = client is None
+        self._queue: asyncio.Queue[Optional[Alert]] = asyncio.Queue(maxsize=queue_size)
+        self._bucket = TokenBucket(rate=rate_per_second, capacity=burst)
+        self._last_seen: Dict[Tuple[str, str], float] = {}
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        if self._client is None:
+            self._client = create_telegram_client()
+        self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        if self._task is not None:
+            # the sentinel lets the queued alerts go out before the task ends
+            await self._queue.put(None)
+            await self._task
+            self._task = None
+
+        if self._owns_client and self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    def submit(self, alert: Alert) -> bool:
+        now = time.monotonic()
+        key = (alert.device_id, alert.metric_name)
+        last = self._last_seen.get(key)
+        if last is not None and now - last < self.dedup_window:
+            self.suppressed += 1
+            ALERTS_SUPPRESSED.inc()
+            return False
+
+        try:
+            self._queue.put_nowait(alert)
+        except asyncio.QueueFull:
+            self.dropped += 1
+            ALERTS_DROPPED.inc()
+            return False
+
+        self._last_seen[key] = now
+        self.submitted += 1
+        ALERTS_QUEUED.inc()
+        if len(self._last_seen) > 100_000:
+            self._forget_expired(now)
+        return True
+
+    @property
+    def pending(self) -> int:
+        return self._queue.qsize()
+
+    def _forget_expired(self, now: float):
+        self._last_seen = {key: seen for key, seen in self._last_seen.items() if now - seen < self.dedup_window}
+
+    async def _run(self):
+        stopping = False
+        while not stopping:
+            alert = await self._queue.get()
+            if alert is None:
+                break
+
+            digest = [alert]
+            deadline = time.monotonic() + self.digest_max_delay
+            while len(digest) < self.digest_max_alerts:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    alert = await asyncio.wait_for(self._queue.get(), timeout=timeout)
+                except asyncio.TimeoutError:
+                    break
+                if alert is None:
+                    stopping = True
+                    break
+                digest.append(alert)
+
+            try:
+                await self._bucket.acquire()
+                await self._deliver(format_digest(digest))
+            except Exception:
+                # the dispatcher is the only way out for alerts, one bad digest must not end it
+                self.failed_messages += 1
+                ALERT_MESSAGES_FAILED.inc()
+                logger.exception(f"Failed to deliver a digest of {len(digest)} alerts")
+
+    async def _deliver(self, message: str):
+        with ALERT_SEND_SECONDS.time():
+            if await self._send(message):
+                self.sent_messages += 1
+                ALERT_MESSAGES_SENT.inc()
+            else:
+                self.failed_messages += 1
+                ALERT_MESSAGES_FAILED.inc()
+
+    async def _send(self, message: str) -> bool:
+        for attempt in range(self.max_retries + 1):
+            try:
+                await post_telegram_message(self._client, message)
+                return True
+            except httpx.HTTPStatusError as err:
+                status = err.response.status_code
+                if status == 429:
+                    delay = self._retry_after(err.response, attempt)
+                elif status >= 500:
+                    delay = self._backoff(attempt)
+                else:
+                    logger.error(f"Telegram rejected alert message: {status} {err.response.text}")
+                    break
+            except httpx.TransportError as err:
+                logger.warning(f"Telegram unreachable: {err}")
+                delay = self._backoff(attempt)
+
+            if attempt < self.max_retries:
+                await asyncio.sleep(delay)
+        return False
+
+    def _backoff(self, attempt: int) -> float:
+        return self.backoff_base * (2 ** attempt) * random.uniform(0.5, 1.5)
+
+    def _retry_after(self, response: httpx.Response, attempt: int) -> float:
+        # telegram puts it in the body; a Retry-After header may also be an HTTP date
+        try:
+            delay = float(response.json()["parameters"]["retry_after"])
+        except (ValueError, KeyError, TypeError):
+            try:
+                delay = float(response.headers["Retry-After"])
+            except (KeyError, ValueError):
+                return self._backoff(attempt)
+        return delay if 0 <= delay < math.inf else self._backoff(attempt)
@@ -0,0 +1,273 @@
+import asyncio
+import os
+import time
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from alerts import Alert
+from timeseries import Sample
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+ANOMALY_STATUS = "anomaly"
+# a series key is device index << METRIC_BITS | metric index, one int per series in the lookup table
+METRIC_BITS = 20
+STREAK_MAX = np.iinfo(np.uint16).max
+COUNT_MAX = np.iinfo(np.uint32).max
+
+# per series state, one array each: name, dtype, value of an unused row
+FIELDS: Tuple[Tuple[str, type, float], ...] = (
+    ("mean", np.float32, 0.0),
+    ("var", np.float32, 0.0),
+    ("last_ts", np.float64, -np.inf),
+    ("count", np.uint32, 0),
+    ("shift_streak", np.uint16, 0),
+    ("critical_streak", np.uint16, 0),
+    ("device", np.int32, 0),
+    ("metric", np.int32, 0),
+)
+
+
+def _pack(names: List[str]) -> Tuple[np.ndarray, np.ndarray]:
+    encoded = [name.encode() for name in names]
+    return (np.frombuffer(b"".join(encoded), dtype=np.uint8),
+            np.fromiter((len(name) for name in encoded), dtype=np.int64, count=len(encoded)))
+
+
+def _unpack(blob: np.ndarray, lengths: np.ndarray) -> List[str]:
+    data = blob.tobytes()
+    ends = np.cumsum(lengths).tolist()
+    return [data[end - length:end].decode() for end, length in zip(ends, lengths.tolist())]
+
+
+def write_snapshot(path: str, arrays: Dict[str, np.ndarray]):
+    # written aside and renamed, a crash mid-write leaves the previous snapshot whole
+    partial = f"{path}.partial"
+    with open(partial, "wb") as f:
+        np.savez(f, **arrays)
+    os.replace(partial, path)
+
+
+class Detection(object):
+    def __init__(self, alerts: List[Alert], sustained: np.ndarray):
+        self.alerts = alerts
+        # per sample, critical for at least critical_sustain samples in a row
+        self.sustained = sustained
+
+
+# Streaming detector over every device/metric series the worker sees. A
+# series is one row of flat numpy arrays: an EWMA mean and variance, the last
+# sample time and two run counters, ~40 bytes, so a worker holds hundreds of
+# thousands of them. A batch is scored in a handful of vectorized passes, one
+# per sample of the busiest series, so samples of one series still go through
+# in time order.
+#
+# A sample is shifted when it sits z_threshold deviations off its series'
+# baseline; `sustain` shifted samples in a row raise one anomaly, so a level
+# change alerts and a lone spike doesn't. The same run counting, fed the rule
+# engine's critical flags, tells which critical samples held for
+# critical_sustain samples. Samples not newer than the last one of their
+# series are skipped, a redelivered batch is never counted twice.
+class AnomalyDetector(object):
+    def __init__(self,
+                 alpha: float = 0.02,
+                 z_threshold: float = 4.0,
+                 sustain: int = 5,
+                 warmup: int = 30,
+                 min_std: float = 1.0,
+                 critical_sustain: int = 1,
+                 capacity: int = 1024):
+        self.alpha = alpha
+        self.z_threshold = z_threshold
+        self.sustain = sustain
+        self.warmup = warmup
+        # flat series would otherwise call any wiggle an anomaly
+        self.min_std = min_std
+        self.critical_sustain = critical_sustain
+
+        self.size: int = 0
+        self._devices: Dict[str, int] = {}
+        self._device_names: List[str] = []
+        self._metrics: Dict[str, int] = {}
+        self._metric_names: List[str] = []
+        self._rows: Dict[int, int] = {}
+        self._allocate(capacity)
+
+    def __len__(self) -> int:
+        return self.size
+
+    def _allocate(self, capacity: int):
+        for name, dtype, default in FIELDS:
+            setattr(self, name, np.full(capacity, default, dtype=dtype))
+
+    def _grow(self, needed: int):
+        capacity = len(self.mean)
+        if needed <= capacity:
+            return
+        capacity = max(needed, capacity * 2)
+        for name, dtype, default in FIELDS:
+            grown = np.full(capacity, default, dtype=dtype)
+            grown[:self.size] = getattr(self, name)[:self.size]
+            setattr(self, name, grown)
+
+    def _series(self, device_id: str, metric_name: str) -> int:
+        device = self._devices.get(device_id)
+        if device is None:
+            device = self._devices[device_id] = len(self._device_names)
+            self._device_names.append(device_id)
+        metric = self._metrics.get(metric_name)
+        if metric is None:
+            metric = self._metrics[metric_name] = len(self._metric_names)
+            self._metric_names.append(metric_name)
+
+        key = device << METRIC_BITS | metric
+        row = self._rows.get(key)
+        if row is None:
+            row = self._rows[key] = self.size
+            self._grow(row + 1)
+            self.device[row] = device
+            self.metric[row] = metric
+            self.size += 1
+        return row
+
+    def evaluate(self, samples: List[Sample], critical: Optional[np.ndarray] = None) -> Detection:
+        total = len(samples)
+        rows = np.fromiter((self._series(device_id, name) for device_id, name, _, _ in samples), dtype=np.intp, count=total)
+        ts = np.fromiter((sample[2] for sample in samples), dtype=np.float64, count=total)
+        values = np.fromiter((sample[3] for sample in samples), dtype=np.float64, count=total)
+        critical = np.zeros(total, dtype=bool) if critical is None else critical
+
+        fired = np.zeros(total, dtype=bool)
+        sustained = np.zeros(total, dtype=bool)
+        if total:
+            # samples grouped by series in time order; rank is a sample's place within its series
+            order = np.lexsort((ts, rows))
+            ordered = rows[order]
+            starts = np.concatenate(([True], ordered[1:] != ordered[:-1]))
+            rank = np.arange(total) - np.maximum.accumulate(np.where(starts, np.arange(total), 0))
+            for step in range(int(rank.max()) + 1):
+                # every series at most once per pass, so fancy indexed writes don't collide
+                self._step(order[rank == step], rows, ts, values, critical, fired, sustained)
+        if self.critical_sustain <= 1:
+            # no run to wait for, every critical sample stands, stale or not
+            sustained = critical
+
+        alerts = [Alert(device_id=samples[position][0],
+                        metric_name=samples[position][1],
+                        value=samples[position][3],
+                        status=ANOMALY_STATUS,
+                        timestamp=samples[position][2]) for position in np.flatnonzero(fired).tolist()]
+        return Detection(alerts, sustained)
+
+    def _step(self, positions: np.ndarray, rows: np.ndarray, ts: np.ndarray, values: np.ndarray,
+              critical: np.ndarray, fired: np.ndarray, sustained: np.ndarray):
+        rows = rows[positions]
+        sample_ts, sample = ts[positions], values[positions]
+        # a NaN or inf would poison the baseline for good, it is never scored
+        fresh = (sample_ts > self.last_ts[rows]) & np.isfinite(sample_ts) & np.isfinite(sample)
+        if not fresh.all():
+            # not counted again, still critical when its series' run already held
+            stale, stale_rows = positions[~fresh], rows[~fresh]
+            sustained[stale] = critical[stale] & (self.critical_streak[stale_rows] >= self.critical_sustain)
+            positions, rows = positions[fresh], rows[fresh]
+            sample_ts, sample = sample_ts[fresh], sample[fresh]
+
+        mean = self.mean[rows].astype(np.float64)
+        var = self.var[rows].astype(np.float64)
+        count = self.count[rows]
+
+        # scored against the baseline before the sample moves it
+        z = (sample - mean) / np.maximum(np.sqrt(var), self.min_std)
+        shifted = (np.abs(z) >= self.z_threshold) & (count >= self.warmup)
+        shift_streak = np.where(shifted, np.minimum(self.shift_streak[rows].astype(np.int64) + 1, STREAK_MAX), 0)
+        fired[positions] = shift_streak == self.sustain
+
+        is_critical = critical[positions]
+        critical_streak = np.where(is_critical, np.minimum(self.critical_streak[rows].astype(np.int64) + 1, STREAK_MAX), 0)
+        sustained[positions] = is_critical & (critical_streak >= self.critical_sustain)
+
+        # incremental EWMA mean and variance, the first sample of a series seeds its mean.
+        # A shifted sample moves the mean but not the spread: were the spread to take it
+        # in, a level change would widen its own band and never last `sustain` samples
+        diff = sample - mean
+        step = np.where(count == 0, diff, self.alpha * diff)
+        self.mean[rows] = mean + step
+        self.var[rows] = np.where(count == 0, 0.0, np.where(shifted, var, (1 - self.alpha) * (var + diff * step)))
+        self.count[rows] = np.minimum(count.astype(np.int64) + 1, COUNT_MAX)
+        self.shift_streak[rows] = shift_streak
+        self.critical_streak[rows] = critical_streak
+        self.last_ts[rows] = sample_ts
+
+    def evict(self, older_than: float) -> int:
+        # series silent since older_than are dropped, the survivors are packed to the front
+        keep = np.flatnonzero(self.last_ts[:self.size] >= older_than)
+        evicted = self.size - len(keep)
+        if not evicted:
+            return 0
+        for name, _, default in FIELDS:
+            array = getattr(self, name)
+            array[:len(keep)] = array[keep]
+            array[len(keep):self.size] = default
+        self.size = len(keep)
+
+        used, remapped = np.unique(self.device[:self.size], return_inverse=True)
+        self._device_names = [self._device_names[device] for device in used.tolist()]
+        self._devices = {name: device for device, name in enumerate(self._device_names)}
+        self.device[:self.size] = remapped
+        self._reindex()
+        return evicted
+
+    def _reindex(self):
+        self._rows = {device << METRIC_BITS | metric: row
+                      for row, (device, metric) in enumerate(zip(self.device[:self.size].tolist(),
+                                                                 self.metric[:self.size].tolist()))}
+
+    def snapshot(self) -> Dict[str, np.ndarray]:
+        # copies, the loop goes on updating the live arrays while this is written out
+        arrays = {name: getattr(self, name)[:self.size].copy() for name, _, _ in FIELDS}
+        arrays["device_names"], arrays["device_name_lengths"] = _pack(self._device_names)
+        arrays["metric_names"], arrays["metric_name_lengths"] = _pack(self._metric_names)
+        return arrays
+
+    def restore(self, arrays: Dict[str, np.ndarray]):
+        size = len(arrays["mean"])
+        self._allocate(max(size * 2, 1024))
+        for name, _, _ in FIELDS:
+            getattr(self, name)[:size] = arrays[name]
+        self.size = size
+        self._device_names = _unpack(arrays["device_names"], arrays["device_name_lengths"])
+        self._devices = {name: device for device, name in enumerate(self._device_names)}
+        self._metric_names = _unpack(arrays["metric_names"], arrays["metric_name_lengths"])
+        self._metrics = {name: metric for metric, name in enumerate(self._metric_names)}
+        self._reindex()
+
+    def save(self, path: str):
+        write_snapshot(path, self.snapshot())
+
+    def load(self, path: str) -> bool:
+        if not os.path.exists(path):
+            return False
+        try:
+            with np.load(path) as snapshot:
+                self.restore({name: snapshot[name] for name in snapshot.files})
+        except (OSError, ValueError, KeyError) as err:
+            logger.warning(f"Ignoring unreadable anomaly snapshot {path}: {err!r}")
+            return False
+        logger.info(f"Resumed {self.size} series from {path}")
+        return True
+
+    async def maintain(self, path: Optional[str], interval: float = 300, idle_ttl: float = 7 * 86400):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                evicted = self.evict(time.time() - idle_ttl)
+                if evicted:
+                    logger.info(f"Evicted {evicted} idle series")
+                if path:
+                    # the copy is taken on the loop, the disk write happens off it
+                    await asyncio.to_thread(write_snapshot, path, self.snapshot())
+            except Exception:
+                logger.exception("Anomaly state maintenance failed")
@@ -0,0 +1,153 @@
+import os
+import json
+import math
+import time
+from contextlib import asynccontextmanager
+from typing import List, Literal, Optional
+
+import redis.asyncio as redis
+from fastapi import FastAPI, Query, Request, HTTPException, Depends
+from fastapi.responses import Response, StreamingResponse
+
+from db import async_engine, DeviceStatus
+from cache import QueryCache
+from queries import SeriesQuery, choose_resolution, RAW
+from state_cache import DeviceStateCache, DeviceState
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+
+REDIS_URL = os.getenv("REDIS_URL")
+QUERY_MAX_POINTS = int(os.getenv("QUERY_MAX_POINTS", "1500"))
+QUERY_PAGE_LIMIT = int(os.getenv("QUERY_PAGE_LIMIT", "5000"))
+QUERY_CACHE_MAX_BYTES = int(os.getenv("QUERY_CACHE_MAX_BYTES", str(1 << 20)))
+QUERY_CACHE_TTL = {
+    RAW: int(os.getenv("QUERY_CACHE_TTL_RAW", "10")),
+    "1m": int(os.getenv("QUERY_CACHE_TTL_1M", "60")),
+    "5m": int(os.getenv("QUERY_CACHE_TTL_5M", "300")),
+    "1h": int(os.getenv("QUERY_CACHE_TTL_1H", "3600")),
+}
+# the worker's retention settings, a tier is only chosen while it still holds the start of a range
+RETENTION = {
+    RAW: float(os.getenv("METRICS_RETENTION_DAYS", "30")) * 86400,
+    "1m": float(os.getenv("ROLLUP_RETENTION_1M_DAYS", "7")) * 86400,
+    "5m": float(os.getenv("ROLLUP_RETENTION_5M_DAYS", "30")) * 86400,
+    "1h": float(os.getenv("ROLLUP_RETENTION_1H_DAYS", "365")) * 86400,
+}
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # on start up
+    client = redis.from_url(REDIS_URL) if REDIS_URL else None
+    app.state.series_query = SeriesQuery(async_engine)
+    app.state.query_cache = QueryCache(client, QUERY_CACHE_TTL, max_bytes=QUERY_CACHE_MAX_BYTES)
+    app.state.device_states = DeviceStateCache(client) if client is not None else None
+
+    yield
+    # on shutdown
+    if client is not None:
+        await client.aclose()
+
+
+app = FastAPI(lifespan=lifespan, title="metric-query-api")
+
+
+def get_device_states(request: Request) -> DeviceStateCache:
+    device_states = request.app.state.device_states
+    if device_states is None:
+        raise HTTPException(status_code=503, detail="Device states need REDIS_URL")
+    return device_states
+
+
+# fleet overview straight from the processor's redis state, postgres is not touched
+@app.get("/devices", response_model=List[DeviceState])
+async def fleet_overview(status: Optional[DeviceStatus] = None,
+                         device_states: DeviceStateCache = Depends(get_device_states)):
+    states = await device_states.fleet()
+    if status is not None:
+        states = [state for state in states if state.status == status]
+    return states
+
+
+@app.get("/devices/stale")
+async def stale_devices(older_than: float = Query(default=300, gt=0, description="seconds since last seen"),
+                        limit: Optional[int] = Query(default=None, gt=0),
+                        device_states: DeviceStateCache = Depends(get_device_states)):
+    return await device_states.stale(older_than, limit=limit)
+
+
+@app.get("/devices/{device_id}/state", response_model=DeviceState)
+async def device_state(device_id: str, device_states: DeviceStateCache = Depends(get_device_states)):
+    state = await device_states.get(device_id)
+    if state is None:
+        raise HTTPException(status_code=404, detail=f"No state for device {device_id}")
+    return state
+
+
+@app.get("/devices/{device_id}/metrics/{metric_name}")
+async def metric_series(request: Request,
+                        device_id: str,
+                        metric_name: str,
+                        start: float = Query(..., description="epoch seconds, inclusive"),
+                        end: Optional[float] = Query(default=None, description="epoch seconds, exclusive, defaults to now"),
+                        resolution: Literal["auto", "raw", "1m", "5m", "1h"] = Query(default="auto"),
+                        limit: int = Query(default=QUERY_PAGE_LIMIT, gt=0, le=QUERY_PAGE_LIMIT),
+                        after: Optional[float] = Query(default=None, description="next_after of the previous page"),
+                        skip: int = Query(default=0, ge=0, description="next_skip of the previous page")):
+    now = time.time()
+    open_ended = end is None
+    end = now if open_ended else end
+    if end <= start:
+        raise HTTPException(status_code=400, detail="end must be after start")
+    if resolution == "auto":
+        resolution = choose_resolution(start, end, max_points=QUERY_MAX_POINTS, now=now, retention=RETENTION)
+    if open_ended:
+        # "until now" rounded up to the cache TTL, so live dashboards share entries
+        ttl = QUERY_CACHE_TTL[resolution]
+        end = math.ceil(end / ttl) * ttl
+
+    series_query: SeriesQuery = request.app.state.series_query
+    query_cache: QueryCache = request.app.state.query_cache
+    headers = {"X-Resolution": resolution}
+
+    cache_key = query_cache.key(device_id, metric_name, start, end, resolution, limit, after, skip)
+    cached = await query_cache.get(cache_key)
+    if cached is not None:
+        headers["X-Cache"] = "hit"
+        return Response(content=cached, media_type=NDJSON_MEDIA_TYPE, headers=headers)
+
+    async def lines():
+        # one point per line, the last line carries the cursor of the next page
+        body = []
+        size = 0
+        count = 0
+        last_ts = None
+        # rows of the page at its last ts, the next page skips them; a run of equal
+        # timestamps can span pages, so the ones skipped to get here count too
+        ties = skip if after is not None else 0
+        async for point in series_query.stream(device_id, metric_name, start, end, resolution, limit, after, skip):
+            line = json.dumps(point, separators=(",", ":")).encode() + b"\n"
+            count += 1
+            ties = ties + 1 if point["ts"] == last_ts or (last_ts is None and point["ts"] == after) else 1
+            last_ts = point["ts"]
+            if size <= query_cache.max_bytes:
+                body.append(line)
+                size += len(line)
+            yield line
+
+        more = count == limit
+        trailer = json.dumps({"next_after": last_ts if more else None,
+                              "next_skip": ties if more and resolution == RAW else 0,
+                              "count": count,
+                              "resolution": resolution}, separators=(",", ":")).encode() + b"\n"
+        body.append(trailer)
+        yield trailer
+        if size <= query_cache.max_bytes:
+            await query_cache.set(cache_key, resolution, b"".join(body))
+
+    headers["X-Cache"] = "miss"
+    return StreamingResponse(lines(), media_type=NDJSON_MEDIA_TYPE, headers=headers)
@@ -0,0 +1,37 @@
+import time
+from typing import Any, Generic, List, Tuple, TypeVar
+
+T = TypeVar("T")
+
+
+# Accumulates consumed messages until the batch holds max_size items or its
+# first item waited max_delay seconds. Tags are whatever the transport needs
+# to acknowledge the message later on.
+class MessageBatch(Generic[T]):
+    def __init__(self, max_size: int = 200, max_delay: float = 1.0):
+        self.max_size = max_size
+        self.max_delay = max_delay
+
+        self.tags: List[Any] = []
+        self.items: List[T] = []
+        self._opened_at: float = 0.0
+
+    def __len__(self) -> int:
+        return len(self.items)
+
+    def add(self, tag: Any, item: T):
+        if not self.items:
+            self._opened_at = time.monotonic()
+        self.tags.append(tag)
+        self.items.append(item)
+
+    def is_full(self) -> bool:
+        return len(self.items) >= self.max_size
+
+    def is_due(self) -> bool:
+        return bool(self.items) and time.monotonic() - self._opened_at >= self.max_delay
+
+    def drain(self) -> Tuple[List[Any], List[T]]:
+        tags, items = self.tags, self.items
+        self.tags, self.items = [], []
+        return tags, items
@@ -0,0 +1,51 @@
+import hashlib
+from typing import Dict, Optional
+
+import redis.asyncio as redis
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+# Query results cached in redis as the exact response body. The TTL follows
+# the resolution: a raw page of the last minutes goes stale fast, an hourly
+# rollup barely moves. Redis being down only costs the cache, never the query.
+class QueryCache(object):
+    def __init__(self,
+                 client: Optional[redis.Redis],
+                 ttl_by_resolution: Dict[str, int],
+                 max_bytes: int = 1 << 20,
+                 prefix: str = "metric-query"):
+        self.client = client
+        self.ttl_by_resolution = ttl_by_resolution
+        self.max_bytes = max_bytes
+        self.prefix = prefix
+        self.hits: int = 0
+        self.misses: int = 0
+
+    def key(self, *parts) -> str:
+        digest = hashlib.blake2b(repr(parts).encode(), digest_size=16).hexdigest()
+        return f"{self.prefix}:{digest}"
+
+    async def get(self, key: str) -> Optional[bytes]:
+        if self.client is None:
+            return None
+        try:
+            body = await self.client.get(key)
+        except redis.RedisError as err:
+            logger.warning(f"Query cache read failed: {err!r}")
+            return None
+        if body is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return body
+
+    async def set(self, key: str, resolution: str, body: bytes):
+        if self.client is None or len(body) > self.max_bytes:
+            return
+        try:
+            await self.client.set(key, body, ex=self.ttl_by_resolution.get(resolution, 60))
+        except redis.RedisError as err:
+            logger.warning(f"Query cache write failed: {err!r}")
@@ -0,0 +1,167 @@
+import asyncio
+import logging
+from typing import Awaitable, Callable, Dict, Generic, List, Optional, Set, TypeVar
+
+import aio_pika
+from aio_pika.abc import AbstractIncomingMessage
+from aio_pika.exceptions import AMQPError
+from event_exchange_rabbit_mq import ShardedTopology, ShardClaimer
+
+from batching import MessageBatch
+from metrics import MESSAGES_COMMITTED, MESSAGES_UNDECODABLE, MESSAGES_REQUEUED
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+# Async AMQP consumer for the worker. Deliveries are taken by semaphore bounded
+# handlers and batched; each batch is decoded in one `decode` call, handed to
+# `commit`, and its messages are acked only once the commit went through.
+# The worker consumes the shard queues its ShardClaimer holds, replicas split
+# the shards between them.
+class MetricConsumer(Generic[T]):
+    def __init__(self,
+                 url: str,
+                 decode: Callable[[List[bytes], List[Optional[str]]], List[Optional[T]]],
+                 commit: Callable[[List[T]], Awaitable[None]],
+                 prefetch_count: int = 500,
+                 max_in_flight: int = 64,
+                 batch_max_size: int = 200,
+                 batch_max_delay: float = 1.0,
+                 topology: Optional[ShardedTopology] = None,
+                 claim_interval: float = 5.0,
+                 max_shards: Optional[int] = None,
+                 depth_interval: float = 15.0):
+        self.url = url
+        self.decode = decode
+        self.commit = commit
+        self.prefetch_count = prefetch_count
+        self.topology = topology or ShardedTopology()
+        self.claim_interval = claim_interval
+        self.max_shards = max_shards
+        self.depth_interval = depth_interval
+        # ready messages per held shard, as of the last refresh
+        self.shard_depths: Dict[int, int] = {}
+
+        self._semaphore = asyncio.Semaphore(max_in_flight)
+        self._in_flight: Set[asyncio.Task] = set()
+        self._batch: MessageBatch[AbstractIncomingMessage] = MessageBatch(max_size=batch_max_size, max_delay=batch_max_delay)
+        self._flush_lock = asyncio.Lock()
+        self._stopping = asyncio.Event()
+
+    def stop(self):
+        self._stopping.set()
+
+    @property
+    def pending(self) -> int:
+        return len(self._batch)
+
+    @property
+    def in_flight(self) -> int:
+        return len(self._in_flight)
+
+    async def run(self):
+        connection = await aio_pika.connect_robust(self.url)
+        async with connection:
+            claimer = ShardClaimer(connection,
+                                   self.topology,
+                                   on_message=self.on_message,
+                                   on_release=self._settle,
+                                   prefetch_count=self.prefetch_count,
+                                   claim_interval=self.claim_interval,
+                                   max_shards=self.max_shards)
+            await self.consume(claimer)
+
+    async def consume(self, claimer: ShardClaimer):
+        claiming = asyncio.create_task(claimer.run())
+        flusher = asyncio.create_task(self._flush_due())
+        watcher = asyncio.create_task(self._watch_depths(claimer))
+        logger.info("Worker is waiting for messages...")
+
+        await self._stopping.wait()
+
+        # graceful drain: the claimer cancels every shard consumer and settles
+        # what was delivered through it before closing its channel
+        logger.info("Stopping consumer, draining in-flight messages")
+        claimer.stop()
+        await claiming
+        flusher.cancel()
+        watcher.cancel()
+        await self.flush()
+
+    async def _settle(self, shard: int):
+        # a released shard's deliveries are committed and acked on its own channel,
+        # before the next owner sees anything after them
+        if self._in_flight:
+            await asyncio.gather(*self._in_flight, return_exceptions=True)
+        await self.flush()
+
+    async def on_message(self, message: AbstractIncomingMessage):
+        task = asyncio.current_task()
+        self._in_flight.add(task)
+        try:
+            async with self._semaphore:
+                await self.handle(message)
+        finally:
+            self._in_flight.discard(task)
+
+    async def handle(self, message: AbstractIncomingMessage):
+        self._batch.add(message.delivery_tag, message)
+        if self._batch.is_full():
+            await self.flush()
+
+    async def flush(self):
+        async with self._flush_lock:
+            _, messages = self._batch.drain()
+            if not messages:
+                return
+
+            decoded = self.decode([message.body for message in messages],
+                                  [message.content_type for message in messages])
+
+            accepted: List[AbstractIncomingMessage] = []
+            items: List[T] = []
+            for message, item in zip(messages, decoded):
+                if item is None:
+                    logger.warning(f"Dropping undecodable message {message.message_id or message.delivery_tag}")
+                    MESSAGES_UNDECODABLE.inc()
+                    await message.reject(requeue=False)
+                    continue
+                accepted.append(message)
+                items.append(item)
+
+            if not items:
+                return
+
+            try:
+                await self.commit(items)
+            except Exception:
+                logger.exception(f"Failed to commit a batch of {len(items)} messages, requeueing")
+                MESSAGES_REQUEUED.inc(len(accepted))
+                await asyncio.gather(*(message.nack(requeue=True) for message in accepted))
+                return
+
+            # handlers run concurrently so delivery tags in a batch aren't contiguous,
+            # a multiple-ack could settle a message that is still being processed
+            await asyncio.gather(*(message.ack() for message in accepted))
+            MESSAGES_COMMITTED.inc(len(accepted))
+
+    async def _flush_due(self):
+        interval = min(self._batch.max_delay, 1.0)
+        while True:
+            await asyncio.sleep(interval)
+            if self._batch.is_due():
+                try:
+                    await self.flush()
+                except Exception:
+                    logger.exception("Scheduled flush failed")
+
+    async def _watch_depths(self, claimer: ShardClaimer):
+        while True:
+            await asyncio.sleep(self.depth_interval)
+            try:
+                self.shard_depths = await claimer.depths()
+            except AMQPError as err:
+                # the control channel may be reopening, the next round tries again
+                logger.debug(f"Shard depths unavailable: {err!r}")
@@ -0,0 +1,74 @@
+import os
+from sqlmodel import Field, SQLModel
+from sqlalchemy import insert
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
+from sqlalchemy.dialects.postgresql import JSONB
+from uuid import UUID, uuid4
+from enum import Enum
+from typing import List, Optional, Tuple
+from metric_ingestion_models import DeviceMetric, DeviceMetricGroup as MetricGroupIncome
+from timeseries import TimeSeriesStore, samples_from_groups
+from rollups import RollupWriter
+
+
+DB_URL = os.getenv("DATABASE_URL")
+# statement logging, for debugging only, it costs more than the inserts it logs
+DB_ECHO = os.getenv("DB_ECHO", "false").lower() == "true"
+
+async_engine = create_async_engine(
+    url = DB_URL,
+    echo = DB_ECHO
+)
+
+# built once per process, sessions are cheap but the factory is not
+async_session = async_sessionmaker(
+    bind=async_engine, class_ = AsyncSession, expire_on_commit = False
+)
+
+class DeviceStatus(str, Enum):
+    Normal = "normal"
+    Warning = "warning"
+    Critical = "critical"
+
+class DeviceMetricGroup(SQLModel, table=True):
+    __tablename__ = "alerts"
+    id: UUID =  Field(default_factory=uuid4, primary_key=True)
+    device_id: str = Field(default="default")
+    status: DeviceStatus = Field(default=DeviceStatus.Normal)
+    metrics_raw: list = Field(default=[], sa_type=JSONB)
+
+    @property
+    def metrics(self) -> List[DeviceMetric]:
+        return [DeviceMetric(**metric) if isinstance(metric, dict) else metric for metric in self.metrics_raw]
+
+    @metrics.setter
+    def metrics(self, metrics: List[DeviceMetric]):
+        self.metrics_raw = metrics
+
+
+async def initdb():
+    async with async_engine.begin() as conn:
+        await conn.run_sync(SQLModel.metadata.create_all)
+
+async def save_batch(rows: List[Tuple[MetricGroupIncome, DeviceStatus]],
+                     store: Optional[TimeSeriesStore] = None,
+                     rollups: Optional[RollupWriter] = None):
+    values = [{"id": uuid4(),
+               "device_id": data.device_id,
+               "status": status,
+               "metrics_raw": [metric.model_dump() for metric in data.metrics]} for data, status in rows]
+
+    # one transaction and one multi-row INSERT for the whole batch
+    async with async_session() as session:
+        async with session.begin():
+            await session.execute(insert(DeviceMetricGroup), values)
+            if store is None and rollups is None:
+                return
+            # same transaction, a requeued batch never leaves half of itself behind
+            # nor gets counted twice in the rollups
+            conn = await session.connection()
+            samples = samples_from_groups(data for data, _ in rows)
+            if store is not None:
+                await store.write(conn, samples)
+            if rollups is not None:
+                await rollups.write(conn, samples)
@@ -1,123 +1,171 @@
-import pika
 import os
-from sqlmodel import Field, SQLModel
-from typing import AsyncGenerator
-from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
-import asyncio  
-from telebot import send_alert_message
-from uuid import UUID, uuid4
-from enum import Enum
-from sqlalchemy.dialects.postgresql import JSONB
-from metric_ingestion_models import DeviceMetric, DeviceMetricGroup as MetricGroupIncome 
-from typing import List, Set
-
-
-DB_URL = os.getenv("DATABASE_URL")
-
-async_engine = create_async_engine(
-    url = DB_URL,
-    echo = True
-)
-
-class DeviceStatus(str, Enum):
-    Normal = "normal"
-    Warning = "warning"
-    Critical = "critical"
-
-class DeviceMetricGroup(SQLModel, table=True):
-    __tablename__ = "alerts"
-    id: UUID =  Field(default_factory=uuid4, primary_key=True)
-    device_id: str = Field(default="default")
-    status: DeviceStatus = Field(default=DeviceStatus.Normal) 
-    metrics_raw: list = Field(default=[], sa_type=JSONB)
-    
-    @property
-    def metrics(self) -> List[DeviceMetric]:
-        return [DeviceMetric(**metric) if isinstance(metric, dict) else metric for metric in self.metrics_raw]
-    
-    @metrics.setter
-    def metrics(self, metrics: List[DeviceMetric]):
-        self.metrics_raw = metrics
-
-    
-
-
-async def initdb():
-    async with async_engine.begin() as conn:
-        await conn.run_sync(SQLModel.metadata.create_all)
-
-async def get_session() -> AsyncGenerator[AsyncSession, None]:
-    async_session = async_sessionmaker(
-        bind=async_engine, class_ = AsyncSession, expire_on_commit = False
-    )
-
-    async with async_session() as session:
-        yield session
-
-async def save_data(data: MetricGroupIncome, status: DeviceStatus):
-    record = DeviceMetricGroup(device_id = data.device_id, status = status)
-
-    record.metrics = data.metrics
-
-    session = await get_session()
-
-    session.add(record)
-
-    await session.commit()
-
-def process_message(payload):
-
-    def check_status(metric: float)-> DeviceStatus:
-        if metric >= 80:
-            return DeviceStatus.Critical
-        elif metric >= 61:
-            return DeviceStatus.Warning
-        else:
-            return DeviceStatus.Normal
-    def decide_overall_status(status_all: Set[DeviceStatus]) -> DeviceStatus:
-        if DeviceStatus.Critical in status_all:
-            return DeviceStatus.Critical
-        elif DeviceStatus.Warning in status_all:
-            return DeviceStatus.Warning
-        return DeviceStatus.Normal
-    metric_group: MetricGroupIncome = MetricGroupIncome.from_json(payload)
-
-    status_set: Set[DeviceStatus] = set()
-    msg = f"Device: <code>{metric_group.device_id}</code>\n"
-    for metric in metric_group.metrics:
-        st = check_status(metric.value)
-
-        status_set.add(st)
-
-        if st == DeviceStatus.Critical:
-            msg += "".join(["🚨 <b>Alert System</b> 🚨\n",\
-                            f"Metric: <b>{metric.name}</b>",\
-                            f"Value: <b>{metric.value}%</b>\n",\
-                            f"Status: <b>{st}</b>\n"])
-    overall_status = decide_overall_status(status_set)
-
-    if overall_status == DeviceStatus.Critical:
-        send_alert_message(msg)
-    
-    asyncio.run(save_data(metric_group, overall_status))
+import asyncio
+import logging
+import signal
+import time
+from alerts import AlertDispatcher
+from metric_ingestion_models import DeviceMetricGroup as MetricGroupIncome, decode_groups
+from typing import List, Optional
+
+from db import initdb, save_batch, async_engine
+from timeseries import TimeSeriesStore, samples_from_groups
+from rollups import RollupWriter
+from state_cache import DeviceStateCache
+import redis.asyncio as redis
+from rules import RuleEngine
+from anomaly import AnomalyDetector
+from consumer import MetricConsumer
+from event_exchange_rabbit_mq import ShardedTopology
+from prometheus_client import REGISTRY, start_http_server
+from metrics import BATCH_MESSAGES, COMMIT_SECONDS, PipelineCollector, observe_lag
+
+logger = logging.getLogger(__name__)
+
+PREFETCH_COUNT = int(os.getenv("PREFETCH_COUNT", "500"))
+BATCH_MAX_SIZE = int(os.getenv("BATCH_MAX_SIZE", "200"))
+BATCH_MAX_DELAY = float(os.getenv("BATCH_MAX_DELAY", "1.0"))
+MAX_IN_FLIGHT = int(os.getenv("MAX_IN_FLIGHT", "64"))
+ALERT_DEDUP_WINDOW = float(os.getenv("ALERT_DEDUP_WINDOW", "300"))
+ALERT_DIGEST_MAX = int(os.getenv("ALERT_DIGEST_MAX", "20"))
+ALERT_DIGEST_DELAY = float(os.getenv("ALERT_DIGEST_DELAY", "5"))
+ALERT_RATE_PER_SECOND = float(os.getenv("ALERT_RATE_PER_SECOND", "0.3"))
+ALERT_BURST = int(os.getenv("ALERT_BURST", "3"))
+ALERT_RULES_PATH = os.getenv("ALERT_RULES_PATH")
+METRICS_PARTITION_HOURS = int(os.getenv("METRICS_PARTITION_HOURS", "24"))
+METRICS_RETENTION_DAYS = float(os.getenv("METRICS_RETENTION_DAYS", "30"))
+METRICS_PREMAKE_PARTITIONS = int(os.getenv("METRICS_PREMAKE_PARTITIONS", "2"))
+PARTITION_MAINTENANCE_INTERVAL = float(os.getenv("PARTITION_MAINTENANCE_INTERVAL", "3600"))
+ROLLUP_RETENTION_1M_DAYS = float(os.getenv("ROLLUP_RETENTION_1M_DAYS", "7"))
+ROLLUP_RETENTION_5M_DAYS = float(os.getenv("ROLLUP_RETENTION_5M_DAYS", "30"))
+ROLLUP_RETENTION_1H_DAYS = float(os.getenv("ROLLUP_RETENTION_1H_DAYS", "365"))
+REDIS_URL = os.getenv("REDIS_URL")
+METRICS_EXCHANGE = os.getenv("METRICS_EXCHANGE", "metrics.sharded")
+METRICS_QUEUE_PREFIX = os.getenv("METRICS_QUEUE_PREFIX", "metrics.shard")
+# has to match the ingestion api, the shard of a device depends on it
+METRICS_SHARDS = int(os.getenv("METRICS_SHARDS", "16"))
+SHARD_CLAIM_INTERVAL = float(os.getenv("SHARD_CLAIM_INTERVAL", "5"))
+# prometheus scrape port of the worker, 0 turns it off
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9100"))
+SHARD_DEPTH_INTERVAL = float(os.getenv("SHARD_DEPTH_INTERVAL", "15"))
+ANOMALY_ALPHA = float(os.getenv("ANOMALY_ALPHA", "0.02"))
+ANOMALY_Z_THRESHOLD = float(os.getenv("ANOMALY_Z_THRESHOLD", "4"))
+ANOMALY_SUSTAIN = int(os.getenv("ANOMALY_SUSTAIN", "5"))
+ANOMALY_WARMUP = int(os.getenv("ANOMALY_WARMUP", "30"))
+ANOMALY_MIN_STD = float(os.getenv("ANOMALY_MIN_STD", "1"))
+# critical samples in a row before a threshold alert, 1 alerts on the first one
+CRITICAL_SUSTAIN = int(os.getenv("CRITICAL_SUSTAIN", "1"))
+ANOMALY_SNAPSHOT_PATH = os.getenv("ANOMALY_SNAPSHOT_PATH")
+ANOMALY_SNAPSHOT_INTERVAL = float(os.getenv("ANOMALY_SNAPSHOT_INTERVAL", "300"))
+ANOMALY_IDLE_DAYS = float(os.getenv("ANOMALY_IDLE_DAYS", "7"))
+
+
+def decode_messages(bodies: List[bytes], content_types: List[Optional[str]]) -> List[Optional[MetricGroupIncome]]:
+    # None marks a body that could not be decoded, the consumer drops it
+    return decode_groups(bodies, content_types)
+
+
+rule_engine = RuleEngine.from_path(ALERT_RULES_PATH)
+
+anomaly_detector = AnomalyDetector(alpha=ANOMALY_ALPHA,
+                                   z_threshold=ANOMALY_Z_THRESHOLD,
+                                   sustain=ANOMALY_SUSTAIN,
+                                   warmup=ANOMALY_WARMUP,
+                                   min_std=ANOMALY_MIN_STD,
+                                   critical_sustain=CRITICAL_SUSTAIN)
+
+metric_store = TimeSeriesStore(async_engine,
+                               partition_interval=METRICS_PARTITION_HOURS * 3600,
+                               retention=METRICS_RETENTION_DAYS * 86400,
+                               premake=METRICS_PREMAKE_PARTITIONS)
+
+rollup_writer = RollupWriter(async_engine,
+                             retention={"1m": ROLLUP_RETENTION_1M_DAYS * 86400,
+                                        "5m": ROLLUP_RETENTION_5M_DAYS * 86400,
+                                        "1h": ROLLUP_RETENTION_1H_DAYS * 86400})
+
+device_states = DeviceStateCache(redis.from_url(REDIS_URL)) if REDIS_URL else None
+
+alert_dispatcher = AlertDispatcher(dedup_window=ALERT_DEDUP_WINDOW,
+                                   digest_max_alerts=ALERT_DIGEST_MAX,
+                                   digest_max_delay=ALERT_DIGEST_DELAY,
+                                   rate_per_second=ALERT_RATE_PER_SECOND,
+                                   burst=ALERT_BURST)
+
+
+async def commit_batch(groups: List[MetricGroupIncome]):
+    evaluation = rule_engine.evaluate(groups)
+
+    statuses = evaluation.statuses()
+    started = time.perf_counter()
+    await save_batch(list(zip(groups, statuses)), store=metric_store, rollups=rollup_writer)
+    COMMIT_SECONDS.observe(time.perf_counter() - started)
+    BATCH_MESSAGES.observe(len(groups))
+    observe_lag(groups, time.time())
+
+    if device_states is not None:
+        # the batch is already committed, a redis hiccup must not get it requeued
+        try:
+            await device_states.write(groups, statuses)
+        except redis.RedisError as err:
+            logger.warning(f"Failed to update device states: {err!r}")
+
+    # after the commit, a batch that gets requeued must not have moved the baselines
+    detection = anomaly_detector.evaluate(samples_from_groups(groups), critical=evaluation.codes == 2)
+
+    # only queued here, the dispatcher sends them from its own task
+    for alert in evaluation.critical_alerts(detection.sustained) + detection.alerts:
+        alert_dispatcher.submit(alert)
+
+
+async def main():
+    await initdb()
+    await metric_store.setup()
+    await rollup_writer.setup()
+    if ANOMALY_SNAPSHOT_PATH:
+        anomaly_detector.load(ANOMALY_SNAPSHOT_PATH)
+
+    consumer = MetricConsumer(url=os.getenv("RABBITMQ_URL"),
+                              decode=decode_messages,
+                              commit=commit_batch,
+                              prefetch_count=PREFETCH_COUNT,
+                              max_in_flight=MAX_IN_FLIGHT,
+                              batch_max_size=BATCH_MAX_SIZE,
+                              batch_max_delay=BATCH_MAX_DELAY,
+                              topology=ShardedTopology(exchange_name=METRICS_EXCHANGE,
+                                                       queue_prefix=METRICS_QUEUE_PREFIX,
+                                                       shards=METRICS_SHARDS),
+                              claim_interval=SHARD_CLAIM_INTERVAL,
+                              depth_interval=SHARD_DEPTH_INTERVAL)
+
+    if METRICS_PORT:
+        REGISTRY.register(PipelineCollector(pending=lambda: consumer.pending,
+                                            in_flight=lambda: consumer.in_flight,
+                                            alert_queue=lambda: alert_dispatcher.pending,
+                                            shard_depths=lambda: consumer.shard_depths))
+        start_http_server(METRICS_PORT)
+        logger.info(f"Metrics exposed on :{METRICS_PORT}/metrics")
+
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, consumer.stop)
+
+    await alert_dispatcher.start()
+    maintenance = [asyncio.create_task(metric_store.maintain(PARTITION_MAINTENANCE_INTERVAL)),
+                   asyncio.create_task(rollup_writer.maintain(PARTITION_MAINTENANCE_INTERVAL)),
+                   asyncio.create_task(anomaly_detector.maintain(ANOMALY_SNAPSHOT_PATH,
+                                                                 interval=ANOMALY_SNAPSHOT_INTERVAL,
+                                                                 idle_ttl=ANOMALY_IDLE_DAYS * 86400))]
+    try:
+        await consumer.run()
+    finally:
+        for task in maintenance:
+            task.cancel()
+        if ANOMALY_SNAPSHOT_PATH:
+            # the consumer is drained, this snapshot covers every committed batch
+            anomaly_detector.save(ANOMALY_SNAPSHOT_PATH)
+        await alert_dispatcher.close()
 
 
 if __name__ == "__main__":
-    asyncio.run(initdb())
-
-    R_URL = os.getenv("RABBITMQ_URL")
-    params = pika.URLParameters(R_URL)
-    connection = pika.BlockingConnection(params)
-    channel = connection.channel()
-
-    channel.exchange_declare(exchange="metrics", exchange_type="fanout")
-
-    result = channel.queue_declare(queue='metrics_queue', durable=True, exclusive = True)
-
-    queue_name = result.method.queue
-
-    channel.queue_bind(exchange="metrics", queue=queue_name)
-    channel.basic_consume(queue=queue_name, on_message_callback=process_message, auto_ack=True)
-
-    print("Worker is waiting for messages...")
-    channel.start_consuming()
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(main())
@@ -0,0 +1,68 @@
+from typing import Callable, Dict, Iterator
+
+from prometheus_client import Counter, Histogram
+from prometheus_client.core import GaugeMetricFamily
+from prometheus_client.registry import Collector
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+LAG_BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 900.0, 3600.0)
+COUNT_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 200, 500, 1000)
+
+CONSUMER_LAG = Histogram("processor_consumer_lag_seconds",
+                         "Age of a metric group when its batch is committed, from its sample timestamp",
+                         buckets=LAG_BUCKETS)
+BATCH_MESSAGES = Histogram("processor_batch_messages", "Messages per committed batch", buckets=COUNT_BUCKETS)
+COMMIT_SECONDS = Histogram("processor_commit_seconds", "save_batch of one batch, a single transaction",
+                           buckets=LATENCY_BUCKETS)
+MESSAGES = Counter("processor_messages", "Deliveries settled, by outcome", ["outcome"])
+ALERTS = Counter("processor_alerts", "Critical alerts handed to the dispatcher, by outcome", ["outcome"])
+ALERT_SEND_SECONDS = Histogram("processor_alert_send_seconds", "One digest to Telegram, retries included",
+                               buckets=LATENCY_BUCKETS + (30.0, 60.0))
+ALERT_MESSAGES = Counter("processor_alert_messages", "Digest messages, by outcome", ["outcome"])
+
+# children resolved once, labels() takes a lock and a dict lookup on every call
+MESSAGES_COMMITTED = MESSAGES.labels("committed")
+MESSAGES_UNDECODABLE = MESSAGES.labels("undecodable")
+MESSAGES_REQUEUED = MESSAGES.labels("requeued")
+ALERTS_QUEUED = ALERTS.labels("queued")
+ALERTS_SUPPRESSED = ALERTS.labels("suppressed")
+ALERTS_DROPPED = ALERTS.labels("dropped")
+ALERT_MESSAGES_SENT = ALERT_MESSAGES.labels("sent")
+ALERT_MESSAGES_FAILED = ALERT_MESSAGES.labels("failed")
+
+
+def observe_lag(groups, now: float):
+    # one sample per group, its metrics are collected together
+    for group in groups:
+        if group.metrics:
+            ts = group.metrics[0].timestamp
+            if ts and ts == ts:
+                CONSUMER_LAG.observe(max(now - ts, 0.0))
+
+
+# Queue depths read at scrape time, from the prometheus server thread. Every
+# reading is a len() or a plain attribute, nothing the event loop could be
+# holding halfway through.
+class PipelineCollector(Collector):
+    def __init__(self,
+                 pending: Callable[[], int],
+                 in_flight: Callable[[], int],
+                 alert_queue: Callable[[], int],
+                 shard_depths: Callable[[], Dict[int, int]]):
+        self.pending = pending
+        self.in_flight = in_flight
+        self.alert_queue = alert_queue
+        self.shard_depths = shard_depths
+
+    def collect(self) -> Iterator[GaugeMetricFamily]:
+        yield GaugeMetricFamily("processor_batch_pending_messages", "Messages waiting in the open batch", value=self.pending())
+        yield GaugeMetricFamily("processor_in_flight_messages", "Deliveries being handled", value=self.in_flight())
+        yield GaugeMetricFamily("processor_alert_queue_depth", "Alerts waiting for the dispatcher", value=self.alert_queue())
+        depths = GaugeMetricFamily("processor_shard_queue_depth", "Ready messages of the held shard queues", labels=["shard"])
+        for shard, depth in sorted(self.shard_depths().items()):
+            depths.add_metric([str(shard)], depth)
+        yield depths
+
+    def describe(self):
+        # no describe-time collect, the callables may not be safe before start up
+        return []
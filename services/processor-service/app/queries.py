@@ -0,0 +1,105 @@
+import math
+import time
+from typing import AsyncIterator, Dict, Optional
+
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+from rollups import RESOLUTIONS
+
+RAW = "raw"
+
+# raw samples are only served for short ranges, past that the smallest
+# rollup that keeps the answer under max_points wins. A tier whose retention
+# doesn't reach back to start has dropped the head of the range already and
+# is passed over; retention is in seconds by resolution, RAW included, and
+# defaults to the rollup defaults with raw kept forever.
+RAW_MAX_RANGE = 6 * 3600
+
+
+def choose_resolution(start: float,
+                      end: float,
+                      max_points: int = 1500,
+                      raw_max_range: float = RAW_MAX_RANGE,
+                      now: Optional[float] = None,
+                      retention: Optional[Dict[str, float]] = None) -> str:
+    span = end - start
+    age = (time.time() if now is None else now) - start
+    if retention is None:
+        retention = {resolution: float(default) for resolution, (_, default) in RESOLUTIONS.items()}
+
+    def kept(resolution: str) -> bool:
+        return age <= retention.get(resolution, math.inf)
+
+    if span <= raw_max_range and kept(RAW):
+        return RAW
+    tiers = [resolution for resolution, _ in sorted(RESOLUTIONS.items(), key=lambda item: item[1][0])
+             if kept(resolution)]
+    for resolution in tiers:
+        if span / RESOLUTIONS[resolution][0] <= max_points:
+            return resolution
+    if tiers:
+        return tiers[-1]
+    # no tier reaches back that far, the one that keeps the most of the range
+    return max(RESOLUTIONS, key=lambda resolution: retention.get(resolution, math.inf))
+
+
+def resolution_width(resolution: str) -> float:
+    return 0.0 if resolution == RAW else float(RESOLUTIONS[resolution][0])
+
+
+# Streams one device metric series ordered by time. Pages are keyset based:
+# after is the last ts of the previous page, so page N costs the same as page 1.
+# Raw samples can share a timestamp and have no key of their own, so a raw
+# page resumes at ts >= after and skips the rows at `after` already returned,
+# in (ts, value) order; a rollup bucket is unique and resumes past `after`.
+class SeriesQuery(object):
+    def __init__(self, engine: AsyncEngine):
+        self.engine = engine
+        self.dialect = engine.dialect.name
+
+    def _raw_sql(self) -> str:
+        if self.dialect == "postgresql":
+            return ("SELECT EXTRACT(EPOCH FROM ts)::float8 AS ts, value FROM metrics "
+                    "WHERE device_id = :device_id AND metric_name = :metric_name "
+                    "AND ts >= to_timestamp(:start) AND ts < to_timestamp(:end) AND ts >= to_timestamp(:after) "
+                    "ORDER BY ts, value LIMIT :limit OFFSET :skip")
+        return ("SELECT ts, value FROM metrics "
+                "WHERE device_id = :device_id AND metric_name = :metric_name "
+                "AND ts >= :start AND ts < :end AND ts >= :after "
+                "ORDER BY ts, value LIMIT :limit OFFSET :skip")
+
+    @staticmethod
+    def _rollup_sql(resolution: str) -> str:
+        return (f"SELECT bucket AS ts, count, min, max, sum / count AS avg, p95 FROM metrics_rollup_{resolution} "
+                "WHERE device_id = :device_id AND metric_name = :metric_name "
+                "AND bucket >= :start AND bucket < :end AND bucket > :after "
+                "ORDER BY bucket LIMIT :limit")
+
+    async def stream(self,
+                     device_id: str,
+                     metric_name: str,
+                     start: float,
+                     end: float,
+                     resolution: str,
+                     limit: int,
+                     after: Optional[float] = None,
+                     skip: int = 0) -> AsyncIterator[Dict]:
+        params = {"device_id": device_id, "metric_name": metric_name, "limit": limit}
+        if resolution == RAW:
+            sql = self._raw_sql()
+            params.update(start=start, end=end,
+                          after=start if after is None else after,
+                          skip=0 if after is None else skip)
+        else:
+            # a bucket is returned when it starts inside the range; bucket is BIGINT and
+            # asyncpg takes no float for it
+            width = RESOLUTIONS[resolution][0]
+            sql = self._rollup_sql(resolution)
+            params.update(start=int(start // width * width), end=int(end),
+                          after=-1 if after is None else int(after))
+
+        async with self.engine.connect() as conn:
+            result = await conn.stream(text(sql), params)
+            async for row in result.mappings():
+                yield dict(row)
@@ -0,0 +1,290 @@
+import asyncio
+import math
+import struct
+import time
+from array import array
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from sqlalchemy import (MetaData, Table, Column, String, BigInteger, Integer, Float, LargeBinary, select, delete,
+                        tuple_)
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.ext.asyncio import AsyncConnection, AsyncEngine
+
+from timeseries import Sample
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+# resolution name -> (bucket width in seconds, default retention in seconds)
+RESOLUTIONS: Dict[str, Tuple[int, int]] = {
+    "1m": (60, 7 * 86400),
+    "5m": (300, 30 * 86400),
+    "1h": (3600, 365 * 86400),
+}
+
+_COUNT = struct.Struct("<I")
+# anything this close to zero, on either side, is counted in the zero bucket
+_MIN_VALUE = 1e-9
+
+
+# Log-bucketed histogram (DDSketch style). A quantile is off by at most
+# relative_accuracy of its true value, and two sketches merge by adding their
+# bucket counts, which is what lets late samples fold into an existing rollup.
+# Negative values get a store of their own, indexed by magnitude, so a gauge
+# that goes below zero keeps its quantiles instead of reading as 0.
+class QuantileSketch(object):
+    def __init__(self, relative_accuracy: float = 0.01, max_bins: int = 2048):
+        self.relative_accuracy = relative_accuracy
+        self.max_bins = max_bins
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._log_gamma = math.log(self.gamma)
+        self.bins: Dict[int, int] = {}
+        self.negative_bins: Dict[int, int] = {}
+        self.zero_count: int = 0
+
+    @property
+    def count(self) -> int:
+        return self.zero_count + sum(self.bins.values()) + sum(self.negative_bins.values())
+
+    def indexes(self, values: np.ndarray) -> np.ndarray:
+        # vectorized bucket index of the magnitude, add() routes the value by its sign
+        return np.ceil(np.log(np.maximum(np.abs(values), _MIN_VALUE)) / self._log_gamma).astype(np.int64)
+
+    def add(self, value: float, index: int):
+        if -_MIN_VALUE <= value <= _MIN_VALUE:
+            self.zero_count += 1
+            return
+        bins = self.bins if value > 0 else self.negative_bins
+        bins[index] = bins.get(index, 0) + 1
+
+    def merge(self, other: "QuantileSketch"):
+        for bins, others in ((self.bins, other.bins), (self.negative_bins, other.negative_bins)):
+            for index, count in others.items():
+                bins[index] = bins.get(index, 0) + count
+        self.zero_count += other.zero_count
+        self.collapse()
+
+    def collapse(self):
+        # keep the high end exact, that is where p95 lives: positive bins fold upwards
+        # from the smallest magnitude, negative ones from the largest
+        for bins, reverse in ((self.bins, False), (self.negative_bins, True)):
+            if len(bins) <= self.max_bins:
+                continue
+            ordered = sorted(bins, reverse=reverse)
+            overflow = len(ordered) - self.max_bins
+            target = ordered[overflow]
+            for index in ordered[:overflow]:
+                bins[target] += bins.pop(index)
+
+    def _value(self, index: int) -> float:
+        return 2 * self.gamma ** index / (self.gamma + 1)
+
+    def quantile(self, q: float) -> Optional[float]:
+        total = self.count
+        if not total:
+            return None
+        rank = q * (total - 1)
+        seen = 0
+        for index in sorted(self.negative_bins, reverse=True):
+            seen += self.negative_bins[index]
+            if rank < seen:
+                return -self._value(index)
+        seen += self.zero_count
+        if rank < seen:
+            return 0.0
+        for index in sorted(self.bins):
+            seen += self.bins[index]
+            if rank < seen:
+                return self._value(index)
+        if self.bins:
+            return self._value(max(self.bins))
+        return 0.0 if self.zero_count else -self._value(min(self.negative_bins))
+
+    def to_bytes(self) -> bytes:
+        # the negative store goes after the positive one, sketches written before it existed still load
+        return _COUNT.pack(self.zero_count) + _pack_bins(self.bins) + _pack_bins(self.negative_bins)
+
+    @classmethod
+    def from_bytes(cls, data: bytes, relative_accuracy: float = 0.01, max_bins: int = 2048) -> "QuantileSketch":
+        sketch = cls(relative_accuracy=relative_accuracy, max_bins=max_bins)
+        (sketch.zero_count,) = _COUNT.unpack_from(data, 0)
+        sketch.bins, offset = _unpack_bins(data, _COUNT.size)
+        if offset < len(data):
+            sketch.negative_bins, _ = _unpack_bins(data, offset)
+        return sketch
+
+
+def _pack_bins(bins: Dict[int, int]) -> bytes:
+    indexes = array("q", bins.keys())
+    counts = array("Q", bins.values())
+    return _COUNT.pack(len(indexes)) + indexes.tobytes() + counts.tobytes()
+
+
+def _unpack_bins(data: bytes, offset: int) -> Tuple[Dict[int, int], int]:
+    (size,) = _COUNT.unpack_from(data, offset)
+    offset += _COUNT.size
+    indexes = array("q")
+    indexes.frombytes(data[offset:offset + 8 * size])
+    counts = array("Q")
+    counts.frombytes(data[offset + 8 * size:offset + 16 * size])
+    return dict(zip(indexes, counts)), offset + 16 * size
+
+
+class RollupState(object):
+    __slots__ = ("count", "total", "minimum", "maximum", "sketch")
+
+    def __init__(self, sketch: QuantileSketch):
+        self.count: int = 0
+        self.total: float = 0.0
+        self.minimum: float = math.inf
+        self.maximum: float = -math.inf
+        self.sketch = sketch
+
+
+metadata = MetaData()
+
+
+def rollup_table(resolution: str) -> Table:
+    # bucket is the epoch second the bucket starts at, the same on every dialect
+    return Table(f"metrics_rollup_{resolution}", metadata,
+                 Column("device_id", String, primary_key=True),
+                 Column("metric_name", String, primary_key=True),
+                 Column("bucket", BigInteger, primary_key=True),
+                 Column("count", Integer, nullable=False),
+                 Column("sum", Float, nullable=False),
+                 Column("min", Float, nullable=False),
+                 Column("max", Float, nullable=False),
+                 Column("p95", Float, nullable=False),
+                 Column("sketch", LargeBinary, nullable=False))
+
+
+ROLLUP_TABLES: Dict[str, Table] = {resolution: rollup_table(resolution) for resolution in RESOLUTIONS}
+
+
+# Folds every persisted batch into per (device, metric, bucket) aggregates,
+# in the batch's own transaction. Only the buckets the batch touches are read
+# and rewritten, a late sample simply merges into its old bucket; anything
+# older than the resolution's retention is ignored.
+class RollupWriter(object):
+    def __init__(self,
+                 engine: AsyncEngine,
+                 retention: Optional[Dict[str, float]] = None,
+                 relative_accuracy: float = 0.01,
+                 chunk_size: int = 500):
+        self.engine = engine
+        self.dialect = engine.dialect.name
+        self.retention = {resolution: float(default) for resolution, (_, default) in RESOLUTIONS.items()}
+        self.retention.update(retention or {})
+        self.relative_accuracy = relative_accuracy
+        self.chunk_size = chunk_size
+        self._sketch = QuantileSketch(relative_accuracy)
+
+    async def setup(self):
+        async with self.engine.begin() as conn:
+            await conn.run_sync(metadata.create_all)
+
+    def _new_sketch(self) -> QuantileSketch:
+        return QuantileSketch(self.relative_accuracy)
+
+    def aggregate(self, samples: List[Sample], now: Optional[float] = None) -> Dict[str, Dict[Tuple[str, str, int], RollupState]]:
+        now = time.time() if now is None else now
+        if not samples:
+            return {resolution: {} for resolution in RESOLUTIONS}
+
+        timestamps = np.fromiter((sample[2] for sample in samples), dtype=np.float64, count=len(samples))
+        values = np.fromiter((sample[3] for sample in samples), dtype=np.float64, count=len(samples))
+        # a NaN or inf would land in a garbage sketch bucket and poison min, max and sum for good
+        finite = np.isfinite(timestamps) & np.isfinite(values)
+        if not finite.all():
+            logger.warning(f"Left {int(len(samples) - finite.sum())} non-finite samples out of the rollups")
+            samples = [samples[position] for position in np.flatnonzero(finite).tolist()]
+            timestamps, values = timestamps[finite], values[finite]
+        # sketch indexes do not depend on the resolution, compute them once
+        indexes = self._sketch.indexes(values).tolist()
+        value_list = values.tolist()
+
+        result: Dict[str, Dict[Tuple[str, str, int], RollupState]] = {}
+        for resolution, (width, _) in RESOLUTIONS.items():
+            states: Dict[Tuple[str, str, int], RollupState] = {}
+            buckets = (timestamps // width * width).astype(np.int64).tolist()
+            oldest = now - self.retention[resolution]
+            for position, sample in enumerate(samples):
+                bucket = buckets[position]
+                if bucket + width <= oldest:
+                    continue
+                key = (sample[0], sample[1], bucket)
+                state = states.get(key)
+                if state is None:
+                    state = states[key] = RollupState(self._new_sketch())
+                value = value_list[position]
+                state.count += 1
+                state.total += value
+                if value < state.minimum:
+                    state.minimum = value
+                if value > state.maximum:
+                    state.maximum = value
+                state.sketch.add(value, indexes[position])
+            result[resolution] = states
+        return result
+
+    async def _existing(self, conn: AsyncConnection, table: Table, keys: List[Tuple[str, str, int]]):
+        existing: Dict[Tuple[str, str, int], RollupState] = {}
+        key_columns = tuple_(table.c.device_id, table.c.metric_name, table.c.bucket)
+        for start in range(0, len(keys), self.chunk_size):
+            query = select(table).where(key_columns.in_(keys[start:start + self.chunk_size]))
+            if self.dialect == "postgresql":
+                query = query.with_for_update()
+            for row in (await conn.execute(query)).mappings():
+                state = RollupState(QuantileSketch.from_bytes(row["sketch"], self.relative_accuracy))
+                state.count, state.total, state.minimum, state.maximum = row["count"], row["sum"], row["min"], row["max"]
+                existing[(row["device_id"], row["metric_name"], row["bucket"])] = state
+        return existing
+
+    def _upsert(self, table: Table):
+        insert = postgresql.insert(table) if self.dialect == "postgresql" else sqlite.insert(table)
+        return insert.on_conflict_do_update(index_elements=[table.c.device_id, table.c.metric_name, table.c.bucket],
+                                            set_={name: insert.excluded[name]
+                                                  for name in ("count", "sum", "min", "max", "p95", "sketch")})
+
+    async def write(self, conn: AsyncConnection, samples: List[Sample], now: Optional[float] = None):
+        for resolution, states in self.aggregate(samples, now).items():
+            if not states:
+                continue
+            table = ROLLUP_TABLES[resolution]
+            keys = list(states)
+            existing = await self._existing(conn, table, keys)
+
+            rows = []
+            for key, state in states.items():
+                previous = existing.get(key)
+                if previous is not None:
+                    state.sketch.merge(previous.sketch)
+                    state.count += previous.count
+                    state.total += previous.total
+                    state.minimum = min(state.minimum, previous.minimum)
+                    state.maximum = max(state.maximum, previous.maximum)
+                else:
+                    state.sketch.collapse()
+                rows.append({"device_id": key[0], "metric_name": key[1], "bucket": key[2],
+                             "count": state.count, "sum": state.total, "min": state.minimum, "max": state.maximum,
+                             "p95": state.sketch.quantile(0.95), "sketch": state.sketch.to_bytes()})
+            await conn.execute(self._upsert(table), rows)
+
+    async def drop_expired(self, now: Optional[float] = None):
+        now = time.time() if now is None else now
+        async with self.engine.begin() as conn:
+            for resolution, table in ROLLUP_TABLES.items():
+                cutoff = int(now - self.retention[resolution])
+                result = await conn.execute(delete(table).where(table.c.bucket < cutoff))
+                if result.rowcount:
+                    logger.info(f"Dropped {result.rowcount} expired {resolution} rollups")
+
+    async def maintain(self, interval: float = 3600):
+        while True:
+            try:
+                await self.drop_expired()
+            except Exception:
+                logger.exception("Rollup retention failed")
+            await asyncio.sleep(interval)
@@ -0,0 +1,147 @@
+from typing import Dict, List, Optional
+
+import numpy as np
+from pydantic import BaseModel, Field
+from metric_ingestion_models import DeviceMetricGroup as MetricGroupIncome
+
+from db import DeviceStatus
+from alerts import Alert
+
+ANY = "*"
+STATUSES = [DeviceStatus.Normal, DeviceStatus.Warning, DeviceStatus.Critical]
+
+
+class ThresholdRule(BaseModel):
+    metric: str = Field(default=ANY)
+    device_group: str = Field(default=ANY)
+    warning: float = Field(...)
+    critical: float = Field(...)
+
+
+class RuleSet(BaseModel):
+    default_warning: float = Field(default=61)
+    default_critical: float = Field(default=80)
+    # group name -> device id prefixes belonging to it
+    device_groups: Dict[str, List[str]] = Field(default_factory=dict)
+    rules: List[ThresholdRule] = Field(default_factory=list)
+
+    @classmethod
+    def from_file(cls, path: str) -> "RuleSet":
+        with open(path, "rb") as f:
+            return cls.model_validate_json(f.read())
+
+
+class BatchEvaluation(object):
+    def __init__(self, groups: List[MetricGroupIncome], offsets: np.ndarray, codes: np.ndarray, overall: np.ndarray):
+        self.groups = groups
+        self.offsets = offsets
+        # 0 normal, 1 warning, 2 critical; per metric and per group
+        self.codes = codes
+        self.overall = overall
+
+    def statuses(self) -> List[DeviceStatus]:
+        return [STATUSES[code] for code in self.overall.tolist()]
+
+    def metric_statuses(self, index: int) -> List[DeviceStatus]:
+        start, end = self.offsets[index], self.offsets[index + 1]
+        return [STATUSES[code] for code in self.codes[start:end].tolist()]
+
+    def critical_alerts(self, sustained: Optional[np.ndarray] = None) -> List[Alert]:
+        # sustained, per metric: only the critical samples that held long enough
+        alerts: List[Alert] = []
+        critical = np.flatnonzero(self.codes == 2 if sustained is None else (self.codes == 2) & sustained)
+        if not critical.size:
+            return alerts
+
+        owners = np.searchsorted(self.offsets, critical, side="right") - 1
+        for position, owner in zip(critical.tolist(), owners.tolist()):
+            group = self.groups[owner]
+            metric = group.metrics[position - self.offsets[owner]]
+            alerts.append(Alert(device_id=group.device_id,
+                                metric_name=metric.name,
+                                value=metric.value,
+                                status=DeviceStatus.Critical.value,
+                                timestamp=metric.timestamp))
+        return alerts
+
+
+# Thresholds are compiled once into a (device group x metric name) table, a
+# batch is then flattened into value/index arrays and judged in a few numpy
+# operations instead of one python call per metric.
+class RuleEngine(object):
+    def __init__(self, rule_set: RuleSet):
+        self.rule_set = rule_set
+
+        self._metric_index: Dict[str, int] = {ANY: 0}
+        self._group_index: Dict[str, int] = {ANY: 0}
+        self._prefixes: List[tuple] = []
+        self._device_groups: Dict[str, int] = {}
+        self._thresholds: np.ndarray = np.empty((0, 0, 2))
+
+        self._compile()
+
+    @classmethod
+    def from_path(cls, path: Optional[str]) -> "RuleEngine":
+        return cls(RuleSet.from_file(path) if path else RuleSet())
+
+    def _compile(self):
+        rule_set = self.rule_set
+        for group in rule_set.device_groups:
+            self._group_index.setdefault(group, len(self._group_index))
+        for rule in rule_set.rules:
+            self._metric_index.setdefault(rule.metric, len(self._metric_index))
+            self._group_index.setdefault(rule.device_group, len(self._group_index))
+
+        # longest prefix first so the most specific group wins
+        self._prefixes = sorted(((prefix, self._group_index[group])
+                                 for group, prefixes in rule_set.device_groups.items()
+                                 for prefix in prefixes),
+                                key=lambda item: len(item[0]), reverse=True)
+
+        table = np.empty((len(self._group_index), len(self._metric_index), 2), dtype=np.float64)
+        table[...] = (rule_set.default_warning, rule_set.default_critical)
+
+        # precedence: defaults < any group/metric < group/any metric < group/metric
+        def specificity(rule: ThresholdRule):
+            return (rule.device_group != ANY, rule.metric != ANY)
+
+        for rule in sorted(rule_set.rules, key=specificity):
+            group = self._group_index[rule.device_group] if rule.device_group != ANY else slice(None)
+            metric = self._metric_index[rule.metric] if rule.metric != ANY else slice(None)
+            table[group, metric] = (rule.warning, rule.critical)
+
+        self._thresholds = table
+
+    def group_of(self, device_id: str) -> int:
+        index = self._device_groups.get(device_id)
+        if index is None:
+            # devices outside every declared group are judged by the "*" row
+            index = 0
+            for prefix, group in self._prefixes:
+                if device_id.startswith(prefix):
+                    index = group
+                    break
+            self._device_groups[device_id] = index
+        return index
+
+    def evaluate(self, groups: List[MetricGroupIncome]) -> BatchEvaluation:
+        counts = np.fromiter((len(group.metrics) for group in groups), dtype=np.intp, count=len(groups))
+        offsets = np.zeros(len(groups) + 1, dtype=np.intp)
+        np.cumsum(counts, out=offsets[1:])
+        total = int(offsets[-1])
+
+        metric_index = self._metric_index
+        values = np.fromiter((metric.value for group in groups for metric in group.metrics),
+                             dtype=np.float64, count=total)
+        columns = np.fromiter((metric_index.get(metric.name, 0) for group in groups for metric in group.metrics),
+                              dtype=np.intp, count=total)
+        rows = np.repeat(np.fromiter((self.group_of(group.device_id) for group in groups),
+                                     dtype=np.intp, count=len(groups)), counts)
+
+        thresholds = self._thresholds[rows, columns]
+        codes = (values >= thresholds[:, 0]).astype(np.int8) + (values >= thresholds[:, 1])
+
+        overall = np.zeros(len(groups), dtype=np.int8)
+        np.maximum.at(overall, np.repeat(np.arange(len(groups)), counts), codes)
+
+        return BatchEvaluation(groups, offsets, codes, overall)
@@ -0,0 +1,125 @@
+import time
+from typing import Dict, List, Optional, Sequence
+
+import redis.asyncio as redis
+from pydantic import BaseModel, Field
+from metric_ingestion_models import DeviceMetricGroup as MetricGroupIncome
+
+from db import DeviceStatus
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+_METRIC_FIELD = "m:"
+
+# HSET only when the hash isn't already newer, a requeued or late batch must not
+# rewind a device; KEYS[1] the device hash, ARGV last_seen then field/value pairs
+_WRITE_IF_NEWER = """
+local seen = redis.call('HGET', KEYS[1], 'last_seen')
+if seen and tonumber(seen) > tonumber(ARGV[1]) then
+    return 0
+end
+redis.call('HSET', KEYS[1], unpack(ARGV, 2))
+return 1
+"""
+
+
+class DeviceState(BaseModel):
+    device_id: str = Field(...)
+    status: DeviceStatus = Field(default=DeviceStatus.Normal)
+    last_seen: float = Field(default=0.0)
+    metrics: Dict[str, float] = Field(default_factory=dict)
+
+
+# Latest known state of every device, one redis hash per device
+# ("status", "last_seen" and one "m:<metric>" field per metric) plus a sorted
+# set of device ids scored by last seen. The sorted set is both the fleet
+# index and the stale device lookup, a silent device is a ZRANGEBYSCORE away.
+class DeviceStateCache(object):
+    def __init__(self, client: redis.Redis, prefix: str = "device-state", chunk_size: int = 500):
+        self.client = client
+        self.prefix = prefix
+        self.index_key = f"{prefix}:last-seen"
+        self.chunk_size = chunk_size
+        self._write_if_newer = client.register_script(_WRITE_IF_NEWER)
+
+    def _key(self, device_id: str) -> str:
+        return f"{self.prefix}:{device_id}"
+
+    async def write(self, groups: Sequence[MetricGroupIncome], statuses: Sequence[DeviceStatus], now: Optional[float] = None):
+        now = time.time() if now is None else now
+        # a batch often carries several groups of one device, applied oldest
+        # first so the newest value of every metric is the one that sticks
+        ordered = []
+        for group, status in zip(groups, statuses):
+            timestamps = [metric.timestamp for metric in group.metrics if metric.timestamp]
+            ordered.append((max(timestamps) if timestamps else now, group, status))
+        ordered.sort(key=lambda item: item[0])
+
+        latest: Dict[str, Dict[str, object]] = {}
+        seen_at: Dict[str, float] = {}
+        for seen, group, status in ordered:
+            fields = latest.setdefault(group.device_id, {})
+            fields["status"] = status.value
+            fields["last_seen"] = seen
+            seen_at[group.device_id] = seen
+            for metric in group.metrics:
+                fields[_METRIC_FIELD + metric.name] = metric.value
+
+        if not latest:
+            return
+        async with self.client.pipeline(transaction=False) as pipe:
+            for device_id, fields in latest.items():
+                args = [seen_at[device_id]]
+                for field, value in fields.items():
+                    args.extend((field, value))
+                await self._write_if_newer(keys=[self._key(device_id)], args=args, client=pipe)
+            # gt keeps a replayed older batch from moving a device back in time
+            pipe.zadd(self.index_key, seen_at, gt=True)
+            await pipe.execute()
+
+    def _parse(self, device_id: str, raw: Dict[bytes, bytes]) -> Optional[DeviceState]:
+        if not raw:
+            return None
+        state = DeviceState(device_id=device_id)
+        for field, value in raw.items():
+            field = field.decode()
+            if field.startswith(_METRIC_FIELD):
+                state.metrics[field[len(_METRIC_FIELD):]] = float(value)
+            elif field == "status":
+                state.status = DeviceStatus(value.decode())
+            elif field == "last_seen":
+                state.last_seen = float(value)
+        return state
+
+    async def get(self, device_id: str) -> Optional[DeviceState]:
+        return self._parse(device_id, await self.client.hgetall(self._key(device_id)))
+
+    async def _load(self, device_ids: List[str]) -> List[DeviceState]:
+        states: List[DeviceState] = []
+        for start in range(0, len(device_ids), self.chunk_size):
+            chunk = device_ids[start:start + self.chunk_size]
+            async with self.client.pipeline(transaction=False) as pipe:
+                for device_id in chunk:
+                    pipe.hgetall(self._key(device_id))
+                results = await pipe.execute()
+            states.extend(state for state in (self._parse(device_id, raw) for device_id, raw in zip(chunk, results))
+                          if state is not None)
+        return states
+
+    async def fleet(self) -> List[DeviceState]:
+        device_ids = [device_id.decode() for device_id in await self.client.zrange(self.index_key, 0, -1)]
+        return await self._load(device_ids)
+
+    async def stale(self, older_than: float, now: Optional[float] = None, limit: Optional[int] = None) -> List[Dict]:
+        now = time.time() if now is None else now
+        entries = await self.client.zrangebyscore(self.index_key, "-inf", now - older_than, withscores=True,
+                                                  start=0 if limit else None, num=limit)
+        return [{"device_id": device_id.decode(), "last_seen": last_seen} for device_id, last_seen in entries]
+
+    async def forget(self, device_id: str):
+        async with self.client.pipeline(transaction=True) as pipe:
+            pipe.delete(self._key(device_id))
+            pipe.zrem(self.index_key, device_id)
+            await pipe.execute()
@@ -0,0 +1,231 @@
+import asyncio
+import math
+import time
+from datetime import datetime, timezone
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy.ext.asyncio import AsyncConnection, AsyncEngine
+from metric_ingestion_models import DeviceMetricGroup as MetricGroupIncome
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+# (device_id, metric_name, ts as epoch seconds, value)
+Sample = Tuple[str, str, float, float]
+
+COLUMNS = ("device_id", "metric_name", "ts", "value")
+
+
+def samples_from_groups(groups: Iterable[MetricGroupIncome], received_at: Optional[float] = None) -> List[Sample]:
+    received_at = time.time() if received_at is None else received_at
+    samples: List[Sample] = []
+    append = samples.append
+    for group in groups:
+        device_id = group.device_id
+        for metric in group.metrics:
+            ts = metric.timestamp
+            # the model defaults a missing timestamp to 0.0, that is "unknown", not 1970
+            if not ts or math.isnan(ts):
+                ts = received_at
+            append((device_id, metric.name, ts, float(metric.value)))
+    return samples
+
+
+# Narrow (device_id, metric_name, ts, value) table split into time range
+# partitions, so retention is a DROP TABLE and a range scan only opens the
+# partitions it overlaps. Postgres uses declarative partitioning and COPY,
+# SQLite (local runs) gets one table per range behind a UNION ALL view.
+class TimeSeriesStore(object):
+    def __init__(self,
+                 engine: AsyncEngine,
+                 table: str = "metrics",
+                 partition_interval: float = 86400,
+                 retention: float = 30 * 86400,
+                 premake: int = 2):
+        if partition_interval < 3600 or partition_interval % 3600:
+            raise ValueError("partition_interval must be a whole number of hours")
+        self.engine = engine
+        self.table = table
+        self.partition_interval = partition_interval
+        self.retention = retention
+        self.premake = premake
+        self.dialect = engine.dialect.name
+
+        self._known: Dict[int, str] = {}
+
+    def partition_start(self, ts: float) -> int:
+        return int(ts // self.partition_interval * self.partition_interval)
+
+    def partition_name(self, start: int) -> str:
+        return f"{self.table}_p{datetime.fromtimestamp(start, timezone.utc):%Y%m%d%H}"
+
+    async def setup(self):
+        async with self.engine.begin() as conn:
+            if self.dialect == "postgresql":
+                await conn.exec_driver_sql(f"CREATE TABLE IF NOT EXISTS {self.table} ("
+                                           "device_id text NOT NULL, metric_name text NOT NULL, "
+                                           "ts timestamptz NOT NULL, value double precision NOT NULL"
+                                           ") PARTITION BY RANGE (ts)")
+                # created on the parent, postgres adds it to every partition
+                await conn.exec_driver_sql(f"CREATE INDEX IF NOT EXISTS {self.table}_device_metric_ts_idx "
+                                           f"ON {self.table} (device_id, metric_name, ts)")
+                # late or far-future samples land here instead of failing the whole COPY
+                await conn.exec_driver_sql(f"CREATE TABLE IF NOT EXISTS {self.table}_default PARTITION OF {self.table} DEFAULT")
+            else:
+                await self._create_table(conn, f"{self.table}_default")
+            await self._load_partitions(conn)
+        await self.ensure_partitions()
+
+    async def _load_partitions(self, conn: AsyncConnection):
+        if self.dialect == "postgresql":
+            result = await conn.exec_driver_sql(
+                "SELECT child.relname FROM pg_inherits "
+                "JOIN pg_class parent ON parent.oid = pg_inherits.inhparent "
+                "JOIN pg_class child ON child.oid = pg_inherits.inhrelid "
+                f"WHERE parent.relname = '{self.table}'")
+        else:
+            result = await conn.exec_driver_sql(
+                f"SELECT name FROM sqlite_master WHERE type = 'table' AND name LIKE '{self.table}_p%'")
+
+        self._known.clear()
+        prefix = f"{self.table}_p"
+        for (name,) in result.fetchall():
+            if not name.startswith(prefix):
+                continue
+            try:
+                start = datetime.strptime(name[len(prefix):], "%Y%m%d%H").replace(tzinfo=timezone.utc)
+            except ValueError:
+                continue
+            self._known[int(start.timestamp())] = name
+
+    async def _create_partition(self, conn: AsyncConnection, start: int):
+        name = self.partition_name(start)
+        default = f"{self.table}_default"
+        end = start + int(self.partition_interval)
+        if self.dialect == "postgresql":
+            lower = datetime.fromtimestamp(start, timezone.utc).isoformat()
+            upper = datetime.fromtimestamp(end, timezone.utc).isoformat()
+            in_range = f"ts >= '{lower}' AND ts < '{upper}'"
+            # postgres refuses a new range the default partition already holds rows of (clock
+            # skewed devices run ahead of premake), so those rows are moved over with it detached
+            result = await conn.exec_driver_sql(f"SELECT EXISTS (SELECT 1 FROM {default} WHERE {in_range})")
+            stranded = result.scalar()
+            if stranded:
+                await conn.exec_driver_sql(f"ALTER TABLE {self.table} DETACH PARTITION {default}")
+            await conn.exec_driver_sql(f"CREATE TABLE IF NOT EXISTS {name} PARTITION OF {self.table} "
+                                       f"FOR VALUES FROM ('{lower}') TO ('{upper}')")
+            if stranded:
+                await self._move_rows(conn, default, name, in_range)
+                await conn.exec_driver_sql(f"ALTER TABLE {self.table} ATTACH PARTITION {default} DEFAULT")
+        else:
+            await self._create_table(conn, name)
+            await self._move_rows(conn, default, name, f"ts >= {start} AND ts < {end}")
+        self._known[start] = name
+        logger.info(f"Created partition {name}")
+
+    async def _move_rows(self, conn: AsyncConnection, source: str, target: str, where: str):
+        moved = await conn.exec_driver_sql(f"INSERT INTO {target} (device_id, metric_name, ts, value) "
+                                           f"SELECT device_id, metric_name, ts, value FROM {source} WHERE {where}")
+        await conn.exec_driver_sql(f"DELETE FROM {source} WHERE {where}")
+        if moved.rowcount:
+            logger.info(f"Moved {moved.rowcount} rows from {source} into {target}")
+
+    async def _create_table(self, conn: AsyncConnection, name: str):
+        # sqlite only, stands in for a postgres partition
+        await conn.exec_driver_sql(f"CREATE TABLE IF NOT EXISTS {name} ("
+                                   "device_id TEXT NOT NULL, metric_name TEXT NOT NULL, "
+                                   "ts REAL NOT NULL, value REAL NOT NULL)")
+        await conn.exec_driver_sql(f"CREATE INDEX IF NOT EXISTS {name}_device_metric_ts_idx "
+                                   f"ON {name} (device_id, metric_name, ts)")
+
+    async def _refresh_view(self, conn: AsyncConnection):
+        # sqlite only, the planner pushes WHERE clauses into each UNION ALL arm
+        await conn.exec_driver_sql(f"DROP VIEW IF EXISTS {self.table}")
+        names = [name for _, name in sorted(self._known.items())] + [f"{self.table}_default"]
+        selects = [f"SELECT device_id, metric_name, ts, value FROM {name}" for name in names]
+        await conn.exec_driver_sql(f"CREATE VIEW {self.table} AS " + " UNION ALL ".join(selects))
+
+    async def ensure_partitions(self, now: Optional[float] = None):
+        now = time.time() if now is None else now
+        current = self.partition_start(now)
+        wanted = [current + step * int(self.partition_interval) for step in range(self.premake + 1)]
+        missing = [start for start in wanted if start not in self._known]
+        if not missing:
+            return
+        async with self.engine.begin() as conn:
+            for start in missing:
+                await self._create_partition(conn, start)
+            if self.dialect != "postgresql":
+                await self._refresh_view(conn)
+
+    async def drop_expired(self, now: Optional[float] = None) -> List[str]:
+        now = time.time() if now is None else now
+        # a partition goes once its newest possible sample is past retention
+        cutoff = now - self.retention
+        await self._prune_default(cutoff)
+
+        expired = {start: name for start, name in sorted(self._known.items())
+                   if start + self.partition_interval <= cutoff}
+        if not expired:
+            return []
+        for start in expired:
+            self._known.pop(start)
+        try:
+            async with self.engine.begin() as conn:
+                if self.dialect != "postgresql":
+                    await self._refresh_view(conn)
+                for name in expired.values():
+                    await conn.exec_driver_sql(f"DROP TABLE IF EXISTS {name}")
+        except Exception:
+            self._known.update(expired)
+            raise
+        dropped = list(expired.values())
+        logger.info(f"Dropped expired partitions {dropped}")
+        return dropped
+
+    async def _prune_default(self, cutoff: float):
+        # the catch-all partition has no range to drop, old rows are deleted instead
+        cutoff_sql = "to_timestamp(%s)" % cutoff if self.dialect == "postgresql" else repr(cutoff)
+        async with self.engine.begin() as conn:
+            await conn.exec_driver_sql(f"DELETE FROM {self.table}_default WHERE ts < {cutoff_sql}")
+
+    async def maintain(self, interval: float = 3600):
+        while True:
+            try:
+                await self.ensure_partitions()
+                await self.drop_expired()
+            except Exception:
+                logger.exception("Partition maintenance failed")
+            await asyncio.sleep(interval)
+
+    # Runs inside the caller's transaction, so the samples commit or roll back
+    # together with whatever else the batch wrote. On postgres the transaction
+    # must already be started (asyncpg begins it lazily on the first statement).
+    async def write(self, conn: AsyncConnection, samples: List[Sample]):
+        if not samples:
+            return
+        if self.dialect == "postgresql":
+            await self._copy(conn, samples)
+            return
+
+        by_partition: Dict[str, List[Sample]] = {}
+        default = f"{self.table}_default"
+        for sample in samples:
+            name = self._known.get(self.partition_start(sample[2]), default)
+            by_partition.setdefault(name, []).append(sample)
+
+        for name, rows in by_partition.items():
+            await conn.exec_driver_sql(f"INSERT INTO {name} (device_id, metric_name, ts, value) VALUES (?, ?, ?, ?)", rows)
+
+    async def _copy(self, conn: AsyncConnection, samples: List[Sample]):
+        raw = await conn.get_raw_connection()
+        driver = raw.driver_connection
+        if not hasattr(driver, "copy_records_to_table"):
+            # not asyncpg, fall back to a multi-row insert
+            await conn.exec_driver_sql(f"INSERT INTO {self.table} (device_id, metric_name, ts, value) "
+                                       "VALUES (%s, %s, to_timestamp(%s), %s)", samples)
+            return
+        records = [(device_id, name, datetime.fromtimestamp(ts, timezone.utc), value)
+                   for device_id, name, ts, value in samples]
+        await driver.copy_records_to_table(self.table, records=records, columns=COLUMNS)
@@ -1,20 +1,32 @@
 import os
 import httpx
+from typing import Optional
 
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
-CHAT_ID = os.getenv("TELEGRAM_CHAT_ID")
+CHAT_ID = os.getenv("TELEGRAM_CHAT_ID", os.getenv("CHAT_ID"))
+# point this at a local stand-in to exercise alerting without Telegram
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "https://api.telegram.org")
 
-async def send_telegram_alert(message: str):
-    
-    url = f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/sendMessage"
+
+def create_telegram_client(timeout: float = 10.0) -> httpx.AsyncClient:
+    return httpx.AsyncClient(base_url=TELEGRAM_API_URL, timeout=timeout)
+
+async def post_telegram_message(client: httpx.AsyncClient, message: str) -> httpx.Response:
     payload = {
         "chat_id": CHAT_ID,
         "text": message,
         "parse_mode": "HTML"
     }
-    async with httpx.AsyncClient() as client:
-        try:
-            response = await client.post(url, json=payload)
-            response.raise_for_status()
-        except Exception as e:
-            print(f"Failed to send Telegram alert: {e}")
+    response = await client.post(f"/bot{TELEGRAM_TOKEN}/sendMessage", json=payload)
+    response.raise_for_status()
+    return response
+
+async def send_telegram_alert(message: str, client: Optional[httpx.AsyncClient] = None):
+    try:
+        if client is not None:
+            await post_telegram_message(client, message)
+            return
+        async with create_telegram_client() as client:
+            await post_telegram_message(client, message)
+    except Exception as e:
+        print(f"Failed to send Telegram alert: {e}")
@@ -0,0 +1,4 @@
+import os
+
+# db.py builds its engine on import; modules that only need its models get an in-memory one
+os.environ.setdefault("DATABASE_URL", "sqlite+aiosqlite://")
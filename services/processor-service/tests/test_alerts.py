@@ -0,0 +1,119 @@
+import asyncio
+import json
+import time
+from typing import List
+
+import httpx
+
+from alerts import Alert, AlertDispatcher, TokenBucket, format_digest, TELEGRAM_MESSAGE_LIMIT
+
+
+def dispatcher_for(handler, **kwargs) -> AlertDispatcher:
+    client = httpx.AsyncClient(base_url="https://telegram.test", transport=httpx.MockTransport(handler))
+    options = dict(digest_max_delay=0.05, rate_per_second=1000, burst=1000, backoff_base=0.001)
+    options.update(kwargs)
+    return AlertDispatcher(client=client, **options)
+
+
+def alert(device_id: str = "dev", metric_name: str = "cpu_usage") -> Alert:
+    return Alert(device_id=device_id, metric_name=metric_name, value=99.0)
+
+
+def test_unparsable_retry_after_falls_back_to_backoff():
+    async def scenario():
+        answers: List[httpx.Response] = [
+            httpx.Response(429, headers={"Retry-After": "Wed, 21 Oct 2026 07:28:00 GMT"}),
+            httpx.Response(429, json={"parameters": {"retry_after": None}}),
+            httpx.Response(429, headers={"Retry-After": "inf"}),
+            httpx.Response(200, json={"ok": True}),
+        ]
+        dispatcher = dispatcher_for(lambda request: answers.pop(0))
+        await dispatcher.start()
+        dispatcher.submit(alert())
+        await asyncio.wait_for(dispatcher.close(), timeout=5)
+        assert dispatcher.sent_messages == 1 and not answers
+
+    asyncio.run(scenario())
+
+
+def test_a_failing_digest_does_not_stop_the_dispatcher():
+    async def scenario():
+        calls = 0
+
+        def handler(request: httpx.Request) -> httpx.Response:
+            nonlocal calls
+            calls += 1
+            if calls == 1:
+                raise RuntimeError("boom")
+            return httpx.Response(200, json={"ok": True})
+
+        dispatcher = dispatcher_for(handler, digest_max_alerts=1)
+        await dispatcher.start()
+        dispatcher.submit(alert("first"))
+        dispatcher.submit(alert("second"))
+        await asyncio.wait_for(dispatcher.close(), timeout=5)
+        assert dispatcher.failed_messages == 1 and dispatcher.sent_messages == 1
+
+    asyncio.run(scenario())
+
+
+def test_queued_alerts_go_out_as_digests():
+    async def scenario():
+        texts: List[str] = []
+
+        def handler(request: httpx.Request) -> httpx.Response:
+            texts.append(json.loads(request.content)["text"])
+            return httpx.Response(200, json={"ok": True})
+
+        dispatcher = dispatcher_for(handler, digest_max_alerts=3)
+        await dispatcher.start()
+        for number in range(7):
+            dispatcher.submit(alert(f"dev-{number}"))
+        await asyncio.wait_for(dispatcher.close(), timeout=5)
+        assert dispatcher.sent_messages == 3
+        assert [text.count("Device:") for text in texts] == [3, 3, 1]
+
+    asyncio.run(scenario())
+
+
+def test_repeats_inside_the_dedup_window_are_suppressed():
+    dispatcher = AlertDispatcher(client=httpx.AsyncClient(), dedup_window=60)
+    assert dispatcher.submit(alert("dev", "cpu_usage"))
+    assert not dispatcher.submit(alert("dev", "cpu_usage"))
+    assert dispatcher.submit(alert("dev", "ram_usage"))
+    assert dispatcher.submit(alert("other", "cpu_usage"))
+    assert (dispatcher.submitted, dispatcher.suppressed, dispatcher.pending) == (3, 1, 3)
+
+
+def test_full_queue_drops_without_marking_the_alert_seen():
+    dispatcher = AlertDispatcher(client=httpx.AsyncClient(), queue_size=1)
+    assert dispatcher.submit(alert("first"))
+    assert not dispatcher.submit(alert("second"))
+    assert dispatcher.dropped == 1
+    # dropped, not sent: a retry is not a repeat
+    dispatcher._queue.get_nowait()
+    assert dispatcher.submit(alert("second"))
+
+
+def test_token_bucket_paces_past_its_burst():
+    async def scenario():
+        bucket = TokenBucket(rate=50, capacity=2)
+        started = time.monotonic()
+        for _ in range(2):
+            await bucket.acquire()
+        assert time.monotonic() - started < 0.01
+        for _ in range(5):
+            await bucket.acquire()
+        # five more tokens at 50 per second
+        assert time.monotonic() - started >= 0.09
+
+    asyncio.run(scenario())
+
+
+def test_digest_is_escaped_and_cut_between_lines():
+    text = format_digest([Alert(device_id="<dev&1>", metric_name="cpu<b>", value=1.0)])
+    assert "&lt;dev&amp;1&gt;" in text and "cpu&lt;b&gt;" in text
+
+    long = format_digest([alert(f"dev-{number}", "m" * 100) for number in range(100)])
+    assert len(long) <= TELEGRAM_MESSAGE_LIMIT
+    assert long.endswith("\n…")
@@ -0,0 +1,87 @@
+import math
+
+import numpy as np
+
+from anomaly import AnomalyDetector, ANOMALY_STATUS
+
+
+def series(device_id, metric_name, values, start=0.0):
+    return [(device_id, metric_name, start + step, float(value)) for step, value in enumerate(values)]
+
+
+def test_level_shift_raises_one_anomaly():
+    detector = AnomalyDetector(sustain=3, warmup=10)
+    assert detector.evaluate(series("dev", "cpu", [10.0] * 50)).alerts == []
+    detection = detector.evaluate(series("dev", "cpu", [90.0] * 5, start=50))
+    assert len(detection.alerts) == 1
+    alert = detection.alerts[0]
+    assert (alert.device_id, alert.metric_name, alert.status, alert.timestamp) == ("dev", "cpu", ANOMALY_STATUS, 52.0)
+
+
+def test_lone_spike_is_not_an_anomaly():
+    detector = AnomalyDetector(sustain=3, warmup=10)
+    detector.evaluate(series("dev", "cpu", [10.0] * 50))
+    assert detector.evaluate(series("dev", "cpu", [10.0, 90.0, 10.0, 10.0], start=50)).alerts == []
+
+
+def test_batch_matches_sample_by_sample():
+    values = [10.0] * 40 + [80.0] * 10
+    samples = series("a", "cpu", values) + series("b", "cpu", values[::-1])
+    batched, single = AnomalyDetector(sustain=3, warmup=10), AnomalyDetector(sustain=3, warmup=10)
+    fired = [(alert.device_id, alert.timestamp) for alert in batched.evaluate(samples).alerts]
+    one_by_one = [(alert.device_id, alert.timestamp) for sample in samples for alert in single.evaluate([sample]).alerts]
+    assert sorted(fired) == sorted(one_by_one)
+    assert np.array_equal(batched.mean[:batched.size], single.mean[:single.size])
+
+
+def test_redelivered_and_non_finite_samples_are_skipped():
+    detector = AnomalyDetector()
+    detector.evaluate(series("dev", "cpu", [10.0, 12.0]))
+    mean, count = float(detector.mean[0]), int(detector.count[0])
+    detector.evaluate(series("dev", "cpu", [10.0, 12.0]) + [("dev", "cpu", 5.0, math.nan), ("dev", "cpu", math.inf, 1.0)])
+    assert (float(detector.mean[0]), int(detector.count[0])) == (mean, count)
+
+
+def test_critical_sustain():
+    detector = AnomalyDetector(critical_sustain=3)
+    samples = series("dev", "cpu", [95.0] * 4)
+    sustained = detector.evaluate(samples, critical=np.ones(4, dtype=bool)).sustained
+    assert sustained.tolist() == [False, False, True, True]
+    # a redelivered sample keeps the verdict of the run it belongs to
+    again = detector.evaluate(samples[-1:], critical=np.ones(1, dtype=bool)).sustained
+    assert again.tolist() == [True]
+
+
+def test_evict_keeps_recent_series():
+    detector = AnomalyDetector()
+    detector.evaluate(series("old", "cpu", [1.0], start=0) + series("new", "cpu", [2.0], start=100)
+                      + series("new", "ram", [3.0], start=100))
+    assert detector.evict(older_than=50) == 1
+    assert len(detector) == 2
+    # the survivors are still found under their names
+    detector.evaluate(series("new", "cpu", [4.0], start=101))
+    assert len(detector) == 2 and int(detector.count[detector._rows[0]]) == 2
+
+
+def test_snapshot_restore(tmp_path):
+    detector = AnomalyDetector()
+    detector.evaluate(series("dev-ü", "cpu", [10.0, 11.0, 12.0]) + series("dev-2", "ram", [50.0]))
+    path = str(tmp_path / "anomaly.npz")
+    detector.save(path)
+
+    restored = AnomalyDetector()
+    assert restored.load(path)
+    assert len(restored) == 2
+    for name in ("mean", "var", "last_ts", "count"):
+        assert np.array_equal(getattr(restored, name)[:2], getattr(detector, name)[:2])
+    # continues the same series rather than opening new ones
+    restored.evaluate(series("dev-ü", "cpu", [13.0], start=3))
+    assert len(restored) == 2 and int(restored.count[0]) == 4
+
+
+def test_load_ignores_missing_or_broken_snapshot(tmp_path):
+    detector = AnomalyDetector()
+    assert not detector.load(str(tmp_path / "missing.npz"))
+    broken = tmp_path / "broken.npz"
+    broken.write_bytes(b"not a snapshot")
+    assert not detector.load(str(broken))
@@ -0,0 +1,93 @@
+import asyncio
+import json
+
+import httpx
+
+from queries import choose_resolution, RAW
+
+NOW = 1_700_000_000.0
+HOUR = 3600
+DAY = 86400
+
+
+def test_short_recent_ranges_are_served_raw():
+    assert choose_resolution(NOW - HOUR, NOW, now=NOW) == RAW
+
+
+def test_the_smallest_rollup_under_max_points_wins():
+    assert choose_resolution(NOW - DAY, NOW, max_points=1500, now=NOW) == "1m"
+    assert choose_resolution(NOW - 5 * DAY, NOW, max_points=1500, now=NOW) == "5m"
+    assert choose_resolution(NOW - 6 * 30 * DAY, NOW, max_points=1500, now=NOW) == "1h"
+
+
+def test_tiers_that_no_longer_hold_the_start_are_skipped():
+    # one day eight days back: 1m fits the points but is kept seven days only
+    assert choose_resolution(NOW - 8 * DAY, NOW - 7 * DAY, now=NOW) == "5m"
+    # a short range past the raw retention comes from the rollups
+    retention = {RAW: 30 * DAY, "1m": 7 * DAY, "5m": 30 * DAY, "1h": 365 * DAY}
+    assert choose_resolution(NOW - 40 * DAY, NOW - 40 * DAY + HOUR, now=NOW, retention=retention) == "1h"
+    assert choose_resolution(NOW - 2 * DAY, NOW - 2 * DAY + HOUR, now=NOW, retention=retention) == RAW
+
+
+def test_past_every_retention_the_longest_kept_tier_is_used():
+    assert choose_resolution(NOW - 2 * 365 * DAY, NOW - 365 * DAY - DAY, now=NOW) == "1h"
+
+
+def series_app(tmp_path, rows, rollups=()):
+    from sqlalchemy.ext.asyncio import create_async_engine
+    from api import app, QUERY_CACHE_TTL
+    from cache import QueryCache
+    from queries import SeriesQuery
+    from rollups import metadata
+
+    async def prepare():
+        engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path / 'series.db'}")
+        async with engine.begin() as conn:
+            await conn.exec_driver_sql("CREATE TABLE metrics (device_id TEXT, metric_name TEXT, ts REAL, value REAL)")
+            if rows:
+                await conn.exec_driver_sql("INSERT INTO metrics VALUES ('dev', 'cpu', ?, ?)", rows)
+            await conn.run_sync(metadata.create_all)
+            for bucket, value in rollups:
+                await conn.exec_driver_sql("INSERT INTO metrics_rollup_1m VALUES ('dev', 'cpu', ?, 1, ?, ?, ?, ?, x'')",
+                                           (bucket, value, value, value, value))
+        return engine
+
+    engine = asyncio.run(prepare())
+    # no lifespan over ASGITransport, the state it would set up is put in place here
+    app.state.series_query = SeriesQuery(engine)
+    app.state.query_cache = QueryCache(None, QUERY_CACHE_TTL)
+    return app
+
+
+def read_all(app, params, limit):
+    async def pages():
+        points, cursor, requests = [], {}, 0
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as client:
+            while True:
+                response = await client.get("/devices/dev/metrics/cpu", params={**params, "limit": limit, **cursor})
+                lines = [json.loads(line) for line in response.text.splitlines()]
+                *page, trailer = lines
+                points.extend(page)
+                requests += 1
+                if trailer["next_after"] is None:
+                    return points, requests
+                cursor = {"after": trailer["next_after"], "skip": trailer["next_skip"]}
+
+    return asyncio.run(pages())
+
+
+def test_raw_pages_keep_every_row_of_a_tie(tmp_path):
+    # a run of five equal timestamps spans three pages of two
+    rows = [(100.0, 1.0), (101.0, 5.0), (101.0, 2.0), (101.0, 4.0), (101.0, 3.0), (101.0, 6.0), (102.0, 7.0)]
+    app = series_app(tmp_path, rows)
+    points, requests = read_all(app, {"start": 0, "end": 200, "resolution": "raw"}, limit=2)
+
+    assert [(point["ts"], point["value"]) for point in points] == sorted(rows)
+    assert requests == 4
+
+
+def test_rollup_pages_resume_past_the_last_bucket(tmp_path):
+    app = series_app(tmp_path, [], rollups=[(60 * minute, float(minute)) for minute in range(5)])
+    points, _ = read_all(app, {"start": 0, "end": 600, "resolution": "1m"}, limit=2)
+    assert [point["ts"] for point in points] == [0, 60, 120, 180, 240]
+    assert [point["avg"] for point in points] == [0.0, 1.0, 2.0, 3.0, 4.0]
@@ -0,0 +1,75 @@
+import numpy as np
+import pytest
+
+from rollups import QuantileSketch
+
+
+def sketch_of(values, **kwargs) -> QuantileSketch:
+    sketch = QuantileSketch(**kwargs)
+    values = np.asarray(values, dtype=np.float64)
+    for value, index in zip(values.tolist(), sketch.indexes(values).tolist()):
+        sketch.add(value, index)
+    return sketch
+
+
+@pytest.mark.parametrize("q", [0.01, 0.25, 0.5, 0.75, 0.95, 0.99])
+def test_quantile_within_relative_accuracy(q):
+    values = np.random.default_rng(7).lognormal(3, 1.5, 20_000)
+    exact = np.quantile(values, q, method="lower")
+    assert abs(sketch_of(values).quantile(q) - exact) <= 0.01 * abs(exact) * 1.0001
+
+
+@pytest.mark.parametrize("q", [0.05, 0.3, 0.7, 0.95])
+def test_quantile_of_negative_values(q):
+    rng = np.random.default_rng(11)
+    values = np.concatenate([rng.normal(-40, 10, 5_000), rng.normal(40, 10, 5_000)])
+    exact = np.quantile(values, q, method="lower")
+    assert abs(sketch_of(values).quantile(q) - exact) <= 0.01 * abs(exact) * 1.0001
+
+
+def test_zero_and_empty():
+    assert QuantileSketch().quantile(0.5) is None
+    sketch = sketch_of([0.0, 0.0, 1e-12, -1e-12])
+    assert sketch.zero_count == 4 and sketch.quantile(0.95) == 0.0
+
+
+def test_merge_equals_one_sketch():
+    values = np.random.default_rng(3).normal(0, 100, 10_000)
+    merged = sketch_of(values[:4_000])
+    merged.merge(sketch_of(values[4_000:]))
+    whole = sketch_of(values)
+    assert merged.bins == whole.bins
+    assert merged.negative_bins == whole.negative_bins
+    assert merged.zero_count == whole.zero_count
+    assert merged.quantile(0.95) == whole.quantile(0.95)
+
+
+def test_collapse_keeps_the_high_end():
+    values = np.random.default_rng(5).lognormal(0, 4, 20_000)
+    full, small = sketch_of(values), sketch_of(values, max_bins=256)
+    small.collapse()
+    assert len(small.bins) == 256 and small.count == full.count
+    assert small.quantile(0.999) == full.quantile(0.999)
+
+
+def test_bytes_round_trip():
+    sketch = sketch_of([-5.0, -0.5, 0.0, 2.0, 2.0, 300.0])
+    restored = QuantileSketch.from_bytes(sketch.to_bytes())
+    assert restored.bins == sketch.bins
+    assert restored.negative_bins == sketch.negative_bins
+    assert restored.zero_count == sketch.zero_count
+
+
+def test_non_finite_samples_stay_out_of_the_rollups():
+    from sqlalchemy.ext.asyncio import create_async_engine
+    from rollups import RollupWriter
+
+    writer = RollupWriter(create_async_engine("sqlite+aiosqlite://"))
+    now = 1_700_000_000.0
+    samples = [("dev", "cpu", now, 10.0), ("dev", "cpu", now, float("nan")), ("dev", "cpu", now, float("inf")),
+               ("dev", "cpu", now, -float("inf")), ("dev", "cpu", float("inf"), 5.0), ("dev", "cpu", now, 20.0)]
+    for states in writer.aggregate(samples, now=now).values():
+        (state,) = states.values()
+        assert (state.count, state.total, state.minimum, state.maximum) == (2, 30.0, 10.0, 20.0)
+        assert state.sketch.count == 2 and not state.sketch.negative_bins
+        assert abs(state.sketch.quantile(1.0) - 20.0) <= 0.2
@@ -0,0 +1,89 @@
+import random
+
+import numpy as np
+from metric_ingestion_models import DeviceMetric, DeviceMetricGroup
+
+from db import DeviceStatus
+from rules import RuleEngine, RuleSet, ThresholdRule, ANY
+
+METRICS = ["cpu_usage", "ram_usage", "disk_usage", "net_usage"]
+
+
+def check_status(value: float, warning: float = 61, critical: float = 80) -> DeviceStatus:
+    # the per metric evaluation the engine replaced
+    if value >= critical:
+        return DeviceStatus.Critical
+    elif value >= warning:
+        return DeviceStatus.Warning
+    return DeviceStatus.Normal
+
+
+def overall(statuses):
+    for status in (DeviceStatus.Critical, DeviceStatus.Warning):
+        if status in statuses:
+            return status
+    return DeviceStatus.Normal
+
+
+def random_groups(count: int, seed: int = 7):
+    rng = random.Random(seed)
+    devices = ["000-020-001", "000-020-002", "000-030-001", "001-000-000"]
+    return [DeviceMetricGroup(device_id=rng.choice(devices),
+                              metrics=[DeviceMetric(name=rng.choice(METRICS), value=rng.choice([61, 80, rng.uniform(0, 100)]),
+                                                    timestamp=1.0)
+                                       for _ in range(rng.randint(1, 6))])
+            for _ in range(count)]
+
+
+def test_defaults_match_the_per_metric_evaluation():
+    groups = random_groups(300)
+    evaluation = RuleEngine(RuleSet()).evaluate(groups)
+
+    for index, group in enumerate(groups):
+        expected = [check_status(metric.value) for metric in group.metrics]
+        assert evaluation.metric_statuses(index) == expected
+        assert evaluation.statuses()[index] == overall(expected)
+
+
+def test_rules_match_a_per_metric_lookup():
+    rule_set = RuleSet(device_groups={"storage": ["000-020-"], "edge": ["000-0"]},
+                       rules=[ThresholdRule(metric="ram_usage", warning=75, critical=90),
+                              ThresholdRule(device_group="edge", warning=50, critical=70),
+                              ThresholdRule(metric="disk_usage", device_group="storage", warning=92, critical=98)])
+
+    def thresholds(device_id: str, metric: str):
+        # the longest prefix picks the group, a group rule beats a metric rule
+        storage = device_id.startswith("000-020-")
+        edge = not storage and device_id.startswith("000-0")
+        if storage and metric == "disk_usage":
+            return 92, 98
+        if edge:
+            return 50, 70
+        if metric == "ram_usage":
+            return 75, 90
+        return 61, 80
+
+    groups = random_groups(300, seed=11)
+    evaluation = RuleEngine(rule_set).evaluate(groups)
+    for index, group in enumerate(groups):
+        expected = [check_status(metric.value, *thresholds(group.device_id, metric.name)) for metric in group.metrics]
+        assert evaluation.metric_statuses(index) == expected
+
+
+def test_critical_alerts_point_at_their_metric():
+    groups = [DeviceMetricGroup(device_id="a", metrics=[DeviceMetric(name="cpu_usage", value=10, timestamp=1.0),
+                                                        DeviceMetric(name="ram_usage", value=95, timestamp=2.0)]),
+              DeviceMetricGroup(device_id="b", metrics=[DeviceMetric(name="disk_usage", value=80, timestamp=3.0)])]
+    evaluation = RuleEngine(RuleSet()).evaluate(groups)
+
+    alerts = evaluation.critical_alerts()
+    assert [(alert.device_id, alert.metric_name, alert.value) for alert in alerts] == \
+        [("a", "ram_usage", 95), ("b", "disk_usage", 80)]
+    # only the samples that held long enough
+    sustained = np.array([False, False, True])
+    assert [alert.device_id for alert in evaluation.critical_alerts(sustained)] == ["b"]
+
+
+def test_an_empty_batch():
+    evaluation = RuleEngine(RuleSet()).evaluate([])
+    assert evaluation.statuses() == [] and evaluation.critical_alerts() == []
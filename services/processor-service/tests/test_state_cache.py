@@ -0,0 +1,68 @@
+import asyncio
+
+from fakeredis import FakeAsyncRedis
+from metric_ingestion_models import DeviceMetric, DeviceMetricGroup
+
+from db import DeviceStatus
+from state_cache import DeviceStateCache
+
+
+def group(device_id: str, ts: float, **values) -> DeviceMetricGroup:
+    return DeviceMetricGroup(device_id=device_id,
+                             metrics=[DeviceMetric(name=name, value=value, timestamp=ts) for name, value in values.items()])
+
+
+def test_the_newest_group_of_a_batch_wins():
+    async def scenario():
+        cache = DeviceStateCache(FakeAsyncRedis())
+        # out of order inside one batch
+        await cache.write([group("a", 20, cpu=2), group("a", 10, cpu=1, ram=5)],
+                          [DeviceStatus.Critical, DeviceStatus.Normal])
+        state = await cache.get("a")
+        assert state.status == DeviceStatus.Critical
+        assert state.last_seen == 20
+        assert state.metrics == {"cpu": 2, "ram": 5}
+
+    asyncio.run(scenario())
+
+
+def test_a_late_batch_does_not_rewind_a_device():
+    async def scenario():
+        cache = DeviceStateCache(FakeAsyncRedis())
+        await cache.write([group("a", 20, cpu=2)], [DeviceStatus.Warning])
+        await cache.write([group("a", 10, cpu=1)], [DeviceStatus.Critical])
+
+        state = await cache.get("a")
+        assert (state.status, state.last_seen, state.metrics) == (DeviceStatus.Warning, 20, {"cpu": 2})
+        assert await cache.stale(older_than=0, now=100) == [{"device_id": "a", "last_seen": 20}]
+
+        await cache.write([group("a", 30, cpu=3)], [DeviceStatus.Normal])
+        assert (await cache.get("a")).metrics == {"cpu": 3}
+
+    asyncio.run(scenario())
+
+
+def test_fleet_stale_and_forget():
+    async def scenario():
+        cache = DeviceStateCache(FakeAsyncRedis(), chunk_size=2)
+        await cache.write([group(f"d{index}", (index + 1) * 10, cpu=index) for index in range(5)],
+                          [DeviceStatus.Normal] * 5)
+
+        assert [state.device_id for state in await cache.fleet()] == ["d0", "d1", "d2", "d3", "d4"]
+        assert [entry["device_id"] for entry in await cache.stale(older_than=65, now=100)] == ["d0", "d1", "d2"]
+        assert len(await cache.stale(older_than=65, now=100, limit=1)) == 1
+
+        await cache.forget("d0")
+        assert await cache.get("d0") is None
+        assert len(await cache.fleet()) == 4
+
+    asyncio.run(scenario())
+
+
+def test_a_group_without_timestamps_is_seen_now():
+    async def scenario():
+        cache = DeviceStateCache(FakeAsyncRedis())
+        await cache.write([group("a", 0.0, cpu=1)], [DeviceStatus.Normal], now=50)
+        assert (await cache.get("a")).last_seen == 50
+
+    asyncio.run(scenario())
@@ -0,0 +1,117 @@
+import asyncio
+
+import pytest
+from sqlalchemy.ext.asyncio import create_async_engine
+from metric_ingestion_models import DeviceMetric, DeviceMetricGroup
+
+from timeseries import TimeSeriesStore, samples_from_groups
+
+HOUR = 3600
+# 2023-11-14 00:00 UTC
+NOW = 1_699_920_000.0
+
+
+# setup makes the partitions of the real now as well, the ones around NOW are made on top
+def store_for(tmp_path, **kwargs) -> TimeSeriesStore:
+    engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path / 'metrics.db'}")
+    return TimeSeriesStore(engine, partition_interval=HOUR, **kwargs)
+
+
+async def rows(store: TimeSeriesStore, table: str):
+    async with store.engine.connect() as conn:
+        result = await conn.exec_driver_sql(f"SELECT device_id, metric_name, ts, value FROM {table} ORDER BY ts")
+        return [tuple(row) for row in result.fetchall()]
+
+
+async def write(store: TimeSeriesStore, samples):
+    async with store.engine.begin() as conn:
+        await store.write(conn, samples)
+
+
+def test_samples_land_in_their_partition_and_show_through_the_view(tmp_path):
+    async def scenario():
+        store = store_for(tmp_path, premake=2)
+        await store.setup()
+        await store.ensure_partitions(now=NOW)
+        assert {NOW, NOW + HOUR, NOW + 2 * HOUR} <= set(store._known)
+        assert NOW + 3 * HOUR not in store._known
+        assert store.partition_name(int(NOW)) == "metrics_p2023111400"
+
+        samples = [("a", "cpu", NOW + 10, 1.0), ("a", "cpu", NOW + HOUR + 10, 2.0),
+                   ("b", "ram", NOW - HOUR, 3.0), ("b", "ram", NOW + 5 * HOUR, 4.0)]
+        await write(store, samples)
+
+        assert await rows(store, "metrics_p2023111400") == [samples[0]]
+        assert await rows(store, "metrics_p2023111401") == [samples[1]]
+        # before the first and past the last partition, the catch-all takes them
+        assert await rows(store, "metrics_default") == [samples[2], samples[3]]
+        assert await rows(store, "metrics") == sorted(samples, key=lambda sample: sample[2])
+        await store.engine.dispose()
+
+    asyncio.run(scenario())
+
+
+def test_a_new_partition_takes_its_rows_out_of_the_default(tmp_path):
+    async def scenario():
+        store = store_for(tmp_path, premake=0)
+        await store.setup()
+        await store.ensure_partitions(now=NOW)
+        ahead = ("a", "cpu", NOW + 2 * HOUR + 5, 1.0)
+        await write(store, [ahead])
+        assert await rows(store, "metrics_default") == [ahead]
+
+        await store.ensure_partitions(now=NOW + 2 * HOUR)
+        assert await rows(store, "metrics_default") == []
+        assert await rows(store, "metrics_p2023111402") == [ahead]
+        assert await rows(store, "metrics") == [ahead]
+        await store.engine.dispose()
+
+    asyncio.run(scenario())
+
+
+def test_expired_partitions_are_dropped_and_the_default_pruned(tmp_path):
+    async def scenario():
+        store = store_for(tmp_path, premake=1, retention=2 * HOUR)
+        await store.setup()
+        await store.ensure_partitions(now=NOW)
+        await write(store, [("a", "cpu", NOW + 10, 1.0), ("a", "cpu", NOW - 5 * HOUR, 2.0)])
+
+        assert await store.drop_expired(now=NOW + 2 * HOUR) == []
+        await store.ensure_partitions(now=NOW + 3 * HOUR)
+        assert await store.drop_expired(now=NOW + 3 * HOUR) == ["metrics_p2023111400"]
+        assert NOW not in store._known
+        # the view no longer names the dropped table and still answers
+        assert await rows(store, "metrics") == []
+        await store.engine.dispose()
+
+    asyncio.run(scenario())
+
+
+def test_the_partition_list_survives_a_restart(tmp_path):
+    async def scenario():
+        store = store_for(tmp_path, premake=1)
+        await store.setup()
+        await store.ensure_partitions(now=NOW)
+        await store.engine.dispose()
+
+        again = store_for(tmp_path, premake=1)
+        async with again.engine.begin() as conn:
+            await again._load_partitions(conn)
+        assert again._known == store._known
+        await again.engine.dispose()
+
+    asyncio.run(scenario())
+
+
+def test_partition_interval_is_whole_hours(tmp_path):
+    engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path / 'metrics.db'}")
+    with pytest.raises(ValueError):
+        TimeSeriesStore(engine, partition_interval=1800)
+
+
+def test_a_missing_timestamp_is_the_time_received():
+    groups = [DeviceMetricGroup(device_id="a", metrics=[DeviceMetric(name="cpu", value=1, timestamp=0.0),
+                                                        DeviceMetric(name="ram", value=2, timestamp=None),
+                                                        DeviceMetric(name="disk", value=3, timestamp=5.0)])]
+    assert samples_from_groups(groups, received_at=100.0) == [("a", "cpu", 100.0, 1.0), ("a", "ram", 100.0, 2.0),
+                                                             ("a", "disk", 5.0, 3.0)]
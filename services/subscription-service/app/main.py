@@ -1,25 +1,32 @@
-from fastapi import FastAPI, Depends, HTTPException
+from fastapi import FastAPI, Depends, HTTPException, Query, Request
 from sqlmodel import Field, SQLModel, select
-from typing import AsyncGenerator
+from sqlalchemy import Index, insert
+from typing import List, Optional
 from uuid import UUID, uuid4
 from contextlib import asynccontextmanager
-from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine, async_sessionmaker
+from sqlalchemy.ext.asyncio import AsyncSession
 import sqlalchemy.dialects.sqlite
-from datetime import datetime
+from datetime import datetime, timedelta
 
 from pydantic import BaseModel as DtoModel, Field as DtoField
 from enum import Enum 
 
-import psutil
-import threading
-import time
+import asyncio
 import logging
 import os
-import httpx
+
+from metric_ingestion import MetricIngestionClient as IngestionClient, IngestionSettings, RequestTelemetry, TelemetryMiddleware
+from shared_utils.bulk import read_items, encode_cursor, decode_cursor, upsert_statement
+from shared_utils.database import get_database
 
 logger = logging.getLogger(__name__)
 INGESTION_ENDPOINT = os.getenv("INGESTION_ENDPOINT")
 DEVICE_ID = os.getenv("DEVICE_ID")
+METRICS_INTERVAL_SECONDS = float(os.getenv("METRICS_INTERVAL_SECONDS", "60"))
+BULK_MAX_ITEMS = int(os.getenv("BULK_MAX_ITEMS", "10000"))
+LIST_MAX_LIMIT = int(os.getenv("LIST_MAX_LIMIT", "1000"))
+# keeps IN (...) under the bound parameter limit of older sqlite builds
+IDS_CHUNK_SIZE = 500
 
 class SubscriptionStatus(str, Enum):
     pending = "pending"
@@ -27,6 +34,12 @@ class SubscriptionStatus(str, Enum):
     cancelled = "cancelled"
 
 class Subscription(SQLModel, table=True):
+    # keyset listing by package or by status walks these in id order
+    __table_args__ = (
+        Index("ix_subscription_package_id_id", "package_id", "id"),
+        Index("ix_subscription_status_id", "status", "id"),
+    )
+
     id: UUID =  Field(default_factory=uuid4, primary_key=True)
     customer_name: str = Field(default="Home Basic", max_length=1024)
     phone_number: str = Field(default="0000000000")
@@ -35,65 +48,82 @@ class Subscription(SQLModel, table=True):
     status: SubscriptionStatus = Field(default =SubscriptionStatus.pending)
     
 
-sqlite_file_name = "database.db"
-sqlite_url = f"sqlite+aiosqlite:///{sqlite_file_name}"
-
-
-
-async_engine = create_async_engine(sqlite_url, echo=True, connect_args={"check_same_thread": False})
+database = get_database()
+async_engine = database.engine
+get_session = database.get_session
 
 async def create_db_and_tables():
     async with async_engine.begin() as conn:
         await conn.run_sync(SQLModel.metadata.create_all)
+        # create_all skips indexes of tables that already exist
+        for index in Subscription.__table__.indexes:
+            await conn.run_sync(index.create, checkfirst=True)
 
-async def get_session() -> AsyncGenerator[AsyncSession, None]:
-    async_session = async_sessionmaker(bind = async_engine, class_=AsyncSession, expire_on_commit=False)
-
-    async with async_session() as session:
-        yield session
-def monitor_system():
-    try:
-        while True:
-            
-            cpu = psutil.cpu_percent(interval=1)
-            ram = psutil.virtual_memory().percent
-            
-            logger.log("--- System Monitor ---")
-            logger.log(f"CPU Usage: {cpu}%")
-            logger.log(f"RAM Usage: {ram}%")
-            logger.log("-" * 22)
-
-            httpx.post(INGESTION_ENDPOINT, json = {"device_id": DEVICE_ID, "metrics": {"cpu_usage": cpu, "ram_usage": ram},})
-            time.sleep(60)
-    except KeyboardInterrupt as err:
-        logger.LogError(err, "Error while sending metrics of the device")
+# request telemetry of this worker, shipped with the host metrics every interval
+request_telemetry = RequestTelemetry()
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     # on start up
     await create_db_and_tables()
-    thread = threading.Thread(target=monitor_system, daemon=True)
-    thread.start()
+    ingestion_client = None
+    if INGESTION_ENDPOINT and DEVICE_ID:
+        ingestion_client = IngestionClient(setting = IngestionSettings(ingestion_endpoint = INGESTION_ENDPOINT,
+                                                                      device_id = DEVICE_ID,
+                                                                      interval_time = timedelta(seconds=METRICS_INTERVAL_SECONDS)))
+        ingestion_client.add_collector(request_telemetry)
+        task = asyncio.create_task(ingestion_client.start_expose())
+    else:
+        logger.warning("INGESTION_ENDPOINT or DEVICE_ID not set, metrics are not exported")
     yield
     # on shutdown 
-    thread.join()
+    if ingestion_client is not None:
+        await ingestion_client.stop_expose()
+        await task
+    await database.dispose()
 
 class CreateSubscriptionRequest(DtoModel):
-    name: str = DtoField(default="Home Basic", max_length=1024)
-    speed_mbps: int =DtoField(default=50, ge=30, le=200)
-    price_per_month: int = DtoField(default=50_000, ge=45_000, le=10_000_000)
-    description: str = DtoField(default="default-description", )
-    active: bool = DtoField(default=True)
+    customer_name: str = DtoField(default="Home Basic", max_length=1024)
+    phone_number: str = DtoField(default="0000000000")
+    package_id: UUID = DtoField(...)
+    start_date: float = DtoField(default_factory=lambda : datetime.now().timestamp())
+    status: SubscriptionStatus = DtoField(default=SubscriptionStatus.pending)
 
     
 
-class UpdateSubscriptionRequest(Subscription):
+class UpdateSubscriptionRequest(CreateSubscriptionRequest):
     pass
 
+class PartialUpdateSubscriptionRequest(DtoModel):
+    customer_name: Optional[str] = DtoField(default=None, max_length=1024)
+    phone_number: Optional[str] = DtoField(default=None)
+    package_id: Optional[UUID] = DtoField(default=None)
+    start_date: Optional[float] = DtoField(default=None)
+    status: Optional[SubscriptionStatus] = DtoField(default=None)
+
+class UpsertSubscriptionRequest(CreateSubscriptionRequest):
+    id: UUID = DtoField(...)
+
 class SubscriptionDto(Subscription):
     pass
 
+class BulkGetRequest(DtoModel):
+    ids: List[UUID] = DtoField(..., max_length=BULK_MAX_ITEMS)
+
+class BulkWriteResponse(DtoModel):
+    count: int = DtoField(default=0)
+    ids: List[UUID] = DtoField(default_factory=list)
+
+class SubscriptionPage(DtoModel):
+    items: List[SubscriptionDto] = DtoField(default_factory=list)
+    next_cursor: Optional[str] = DtoField(default=None)
+
 app = FastAPI(lifespan=lifespan, title="subscription-api") 
+app.add_middleware(TelemetryMiddleware, telemetry=request_telemetry)
+
+@app.get("/db/stats")
+async def db_stats():
+    return database.pool_stats()
 
 @app.post("/create", response_model=SubscriptionDto)
 async def create_package(req: CreateSubscriptionRequest, session: AsyncSession = Depends(get_session)):
@@ -111,71 +141,124 @@ async def create_package(req: CreateSubscriptionRequest, session: AsyncSession =
 @app.get("/get/{subscription_id}", response_model=SubscriptionDto)
 async def get_by_id(subscription_id: UUID, session: AsyncSession = Depends(get_session)):
 
-    query = select(SubscriptionDto).where(SubscriptionDto.id==subscription_id)
-
-    result = await session.execute(query)
+    record = await session.get(Subscription, subscription_id)
 
-    row = result.one()
-
-    if not row:
-        raise HTTPException(status_code=404, detail="Package not found")
+    if record is None:
+        raise HTTPException(status_code=404, detail="Subscription not found")
     
     
-    return SubscriptionDto(**Subscription(**row._mapping).model_dump())
-
-
-@app.put("/update/{package_id}", response_model=SubscriptionDto)
-async def update(package_id: UUID, update_req: UpdateSubscriptionRequest,  session: AsyncSession = Depends(get_session)):
-    query = select(Subscription).where(Subscription.id==package_id)
+    return SubscriptionDto(**record.model_dump())
 
-    row = (await session.execute(query)).one()
 
+@app.put("/update/{subscription_id}", response_model=SubscriptionDto)
+async def update(subscription_id: UUID, update_req: UpdateSubscriptionRequest,  session: AsyncSession = Depends(get_session)):
+    record = await session.get(Subscription, subscription_id)
 
-    if not row:
-        raise HTTPException(status_code=404, detail="Package not found")
+    if record is None:
+        raise HTTPException(status_code=404, detail="Subscription not found")
     
-    record =  Subscription(**row._mapping)
     record.sqlmodel_update(update_req.model_dump())
 
     session.add(record)
 
     await session.commit()
 
-    await session.refresh()
+    await session.refresh(record)
 
     return SubscriptionDto(**record.model_dump())
 
 
-@app.patch("/update/partial/{package_id}", response_model=SubscriptionDto)
-async def partial_update(package_id: UUID, update_req: UpdateSubscriptionRequest,  session: AsyncSession = Depends(get_session)):
-    query = select(Subscription).where(Subscription.id==package_id)
-
-    row = (await session.execute(query)).one()
+@app.patch("/update/partial/{subscription_id}", response_model=SubscriptionDto)
+async def partial_update(subscription_id: UUID, update_req: PartialUpdateSubscriptionRequest,  session: AsyncSession = Depends(get_session)):
+    record = await session.get(Subscription, subscription_id)
 
-    if not row:
+    if record is None:
         raise HTTPException(status_code=404, detail="Subscription not found")
-    record = Subscription(**row._mapping)
-    record.sqlmodel_update(update_req.model_dump(exclude_unset=True))
+    record.sqlmodel_update(update_req.model_dump(exclude_unset=True, exclude_none=True))
 
     session.add(record)
 
     await session.commit()
 
-    await session.refresh()
+    await session.refresh(record)
 
     return SubscriptionDto(**record.model_dump())
 
 @app.delete("/delete/{subscription_id}")
 async def delete(subscription_id: UUID,  session: AsyncSession = Depends(get_session)):
-    query = select().where(Subscription.id==subscription_id)
+    record = await session.get(Subscription, subscription_id)
 
-    row = (await session.execute(query)).one()
-
-    if not row:
+    if record is None:
         raise HTTPException(status_code=404, detail="Subscription not found")
     
 
-    session.delete(row)
+    await session.delete(record)
+    await session.commit()
+
+    return {"ok": True}
+
+
+# Bulk endpoints take a JSON array or NDJSON (Content-Type: application/x-ndjson)
+# and write everything in one transaction, all rows or none.
+@app.post("/bulk/create", response_model=BulkWriteResponse)
+async def bulk_create(request: Request, session: AsyncSession = Depends(get_session)):
+    items = await read_items(request, CreateSubscriptionRequest, max_items=BULK_MAX_ITEMS)
+    if not items:
+        return BulkWriteResponse()
+    rows = [{"id": uuid4(), **item.model_dump()} for item in items]
+
+    await session.execute(insert(Subscription), rows)
+    await session.commit()
+
+    return BulkWriteResponse(count=len(rows), ids=[row["id"] for row in rows])
+
+
+@app.post("/bulk/upsert", response_model=BulkWriteResponse)
+async def bulk_upsert(request: Request, session: AsyncSession = Depends(get_session)):
+    items = await read_items(request, UpsertSubscriptionRequest, max_items=BULK_MAX_ITEMS)
+    if not items:
+        return BulkWriteResponse()
+    # last one wins when an id shows up twice, a single statement can't touch a row twice
+    rows = list({item.id: item.model_dump() for item in items}.values())
+
+    statement = upsert_statement(Subscription.__table__, database.dialect, keys=["id"], columns=list(rows[0]))
+    await session.execute(statement, rows)
     await session.commit()
 
-    return {"ok": True}
\ No newline at end of file
+    return BulkWriteResponse(count=len(rows), ids=[row["id"] for row in rows])
+
+
+@app.post("/bulk/get", response_model=List[SubscriptionDto])
+async def bulk_get(req: BulkGetRequest, session: AsyncSession = Depends(get_session)):
+    # unknown ids are left out rather than failing the whole lookup
+    ids = list(dict.fromkeys(req.ids))
+    subscriptions: List[Subscription] = []
+    for start in range(0, len(ids), IDS_CHUNK_SIZE):
+        query = select(Subscription).where(Subscription.id.in_(ids[start:start + IDS_CHUNK_SIZE]))
+        subscriptions.extend((await session.execute(query)).scalars().all())
+    return [SubscriptionDto(**subscription.model_dump()) for subscription in subscriptions]
+
+
+@app.get("/list", response_model=SubscriptionPage)
+async def list_subscriptions(status: Optional[SubscriptionStatus] = None,
+                             package_id: Optional[UUID] = None,
+                             limit: int = Query(default=100, gt=0, le=LIST_MAX_LIMIT),
+                             cursor: Optional[str] = Query(default=None, description="next_cursor of the previous page"),
+                             session: AsyncSession = Depends(get_session)):
+    # keyset pagination on id, a page costs the same however deep it is
+    query = select(Subscription).order_by(Subscription.id).limit(limit + 1)
+    if status is not None:
+        query = query.where(Subscription.status == status)
+    if package_id is not None:
+        query = query.where(Subscription.package_id == package_id)
+    if cursor is not None:
+        try:
+            after = UUID(decode_cursor(cursor)[0])
+        except (IndexError, ValueError):
+            raise HTTPException(status_code=400, detail="Malformed cursor")
+        query = query.where(Subscription.id > after)
+
+    subscriptions = (await session.execute(query)).scalars().all()
+    next_cursor = encode_cursor([subscriptions[limit - 1].id]) if len(subscriptions) > limit else None
+    return SubscriptionPage(items=[SubscriptionDto(**subscription.model_dump()) for subscription in subscriptions[:limit]],
+                            next_cursor=next_cursor)
@@ -0,0 +1,5 @@
+import os
+import tempfile
+
+# the shared database reads this on import, the tests run on a throwaway sqlite file
+os.environ.setdefault("DATABASE_URL", f"sqlite+aiosqlite:///{tempfile.mkdtemp()}/subscription.db")
@@ -0,0 +1,85 @@
+import asyncio
+import json
+
+import httpx
+
+from app.main import app, create_db_and_tables, database
+
+PACKAGE_A = "aaaaaaaa-aaaa-aaaa-aaaa-aaaaaaaaaaaa"
+PACKAGE_B = "bbbbbbbb-bbbb-bbbb-bbbb-bbbbbbbbbbbb"
+
+
+def run(scenario):
+    async def wrapped():
+        # no lifespan over ASGITransport, the tables are made here
+        await create_db_and_tables()
+        try:
+            async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as client:
+                await scenario(client)
+        finally:
+            await database.dispose()
+
+    asyncio.run(wrapped())
+
+
+def subscription(customer: str, package_id: str = PACKAGE_A, **fields):
+    return {"customer_name": customer, "package_id": package_id, **fields}
+
+
+async def read_pages(client, params, limit):
+    seen, cursor = [], None
+    while True:
+        page = (await client.get("/list", params={**params, "limit": limit, **({"cursor": cursor} if cursor else {})})).json()
+        seen.extend(page["items"])
+        cursor = page["next_cursor"]
+        if cursor is None:
+            return seen
+
+
+def test_bulk_create_and_get():
+    async def scenario(client):
+        body = "\n".join(json.dumps(subscription(f"ndjson-{index}")) for index in range(3))
+        created = await client.post("/bulk/create", content=body, headers={"Content-Type": "application/x-ndjson"})
+        ids = created.json()["ids"]
+        assert created.json()["count"] == 3
+
+        found = await client.post("/bulk/get", json={"ids": ids + ids[:1] + ["00000000-0000-0000-0000-000000000000"]})
+        assert sorted(item["customer_name"] for item in found.json()) == ["ndjson-0", "ndjson-1", "ndjson-2"]
+
+    run(scenario)
+
+
+def test_a_bad_item_fails_the_whole_batch():
+    async def scenario(client):
+        response = await client.post("/bulk/create", json=[subscription("fine", package_id=PACKAGE_B),
+                                                            subscription("no package", package_id="nope")])
+        assert response.status_code == 422
+        assert response.json()["detail"][0]["loc"][0] == 1
+        assert await read_pages(client, {"package_id": PACKAGE_B}, limit=100) == []
+
+    run(scenario)
+
+
+def test_upsert_moves_a_subscription_between_listings():
+    async def scenario(client):
+        (existing,) = (await client.post("/bulk/create", json=[subscription("mover")])).json()["ids"]
+        await client.post("/bulk/upsert", json=[subscription("mover", id=existing, status="cancelled")])
+
+        cancelled = [item["id"] for item in await read_pages(client, {"status": "cancelled"}, limit=2)]
+        pending = [item["id"] for item in await read_pages(client, {"status": "pending"}, limit=2)]
+        assert existing in cancelled and existing not in pending
+
+    run(scenario)
+
+
+def test_list_pages_by_package_in_id_order():
+    async def scenario(client):
+        package_id = "cccccccc-cccc-cccc-cccc-cccccccccccc"
+        created = (await client.post("/bulk/create", json=[subscription(f"c-{index}", package_id=package_id)
+                                                           for index in range(7)])).json()["ids"]
+        listed = await read_pages(client, {"package_id": package_id}, limit=3)
+        assert [item["id"] for item in listed] == sorted(created)
+
+        assert (await client.get("/list", params={"cursor": "bm90IGEgbGlzdA=="})).status_code == 400
+
+    run(scenario)
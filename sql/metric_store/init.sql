@@ -0,0 +1,14 @@
+-- Narrow time series table, see services/processor-service/app/timeseries.py.
+-- The processor creates the same objects on start up and keeps range
+-- partitions (metrics_pYYYYMMDDHH) created ahead of time and dropped past retention.
+CREATE TABLE IF NOT EXISTS metrics (
+    device_id   text             NOT NULL,
+    metric_name text             NOT NULL,
+    ts          timestamptz      NOT NULL,
+    value       double precision NOT NULL
+) PARTITION BY RANGE (ts);
+
+CREATE INDEX IF NOT EXISTS metrics_device_metric_ts_idx ON metrics (device_id, metric_name, ts);
+
+-- late or far-future samples, pruned by the processor instead of dropped
+CREATE TABLE IF NOT EXISTS metrics_default PARTITION OF metrics DEFAULT;